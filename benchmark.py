@@ -0,0 +1,299 @@
+"""Офлайн-бенчмарк обработчиков кнопок на синтетической истории.
+
+Создаёт временную SQLite-базу с историей tasks_done заданного размера,
+прогоняет нажатия кнопок через button_handler с фальшивыми Update /
+CallbackQuery / context (Bot API заглушен) и печатает p50/p99 и число
+запросов к БД на нажатие. Результаты сохраняются в JSON, с --compare
+выводится сравнение с прошлым прогоном.
+
+    python benchmark.py --rows 100000 --users 30 --out bench.json
+    python benchmark.py --rows 100000 --users 300 --households 100
+    python benchmark.py --rows 100000 --compare bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+# Настройки бота читаются при импорте: своя база, профилирование для
+# подсчёта запросов, без ограничений скорости исходящих запросов
+WORKDIR = tempfile.mkdtemp(prefix='fairflat-bench-')
+os.environ.setdefault('BOT_TOKEN', '0:bench')
+os.environ['DATABASE'] = os.path.join(WORKDIR, 'bench.db')
+os.environ['DB_PROFILE'] = '1'
+os.environ['DB_SLOW_MS'] = '1e9'
+os.environ['TG_GLOBAL_RATE'] = '1e9'
+os.environ['TG_CHAT_RATE'] = '1e9'
+
+import bot
+
+
+# ==================== ЗАГЛУШКА BOT API ====================
+class FakeQuery:
+    """CallbackQuery, который только считает вызовы Bot API"""
+
+    def __init__(self, data, user, api_calls):
+        self.data = data
+        self.from_user = SimpleNamespace(
+            id=hash(user) & 0x7fffffff, username=user.lstrip('@'), first_name=user
+        )
+        self.message = SimpleNamespace(
+            chat_id=self.from_user.id, message_id=1, text='', reply_markup=None
+        )
+        self._api_calls = api_calls
+
+    async def answer(self, *args, **kwargs):
+        self._api_calls[0] += 1
+
+    async def edit_message_text(self, *args, **kwargs):
+        self._api_calls[0] += 1
+
+    async def edit_message_reply_markup(self, *args, **kwargs):
+        self._api_calls[0] += 1
+
+
+def make_update(data, user, api_calls):
+    query = FakeQuery(data, user, api_calls)
+    update = SimpleNamespace(
+        callback_query=query,
+        effective_user=query.from_user,
+        effective_chat=SimpleNamespace(id=query.from_user.id),
+        message=None,
+    )
+    return update, SimpleNamespace(user_data={}, bot=None)
+
+
+# ==================== СИНТЕТИЧЕСКИЕ ДАННЫЕ ====================
+def generate_history(rows, users, days, households=1, pending_share=0.02, penalty_share=0.05, seed=1):
+    """Квартиры с участниками и история tasks_done за последние days дней.
+
+    Участники раскладываются по квартирам по кругу; квартира 1 — та, что
+    создаётся миграцией, у остальных первый участник — админ.
+    Возвращает [(квартира, telegram)].
+    """
+    rnd = random.Random(seed)
+    bot.init_db()
+    household_ids = [1]
+    members = []
+    for i in range(users):
+        telegram, name = f'@bench_user_{i}', f'Участник {i}'
+        if 0 < i < households:
+            household_ids.append(bot.create_household(f'Квартира {i + 1}', None, None, telegram, name))
+        else:
+            bot.add_member(household_ids[i % households], telegram, name)
+        members.append((household_ids[i % households], telegram, name))
+    bot.households.invalidate()
+
+    tasks = list(bot.DEFAULT_TASKS)
+    now = bot.now_ts()
+    conn = bot.get_conn()
+    batch = []
+    for _ in range(rows):
+        household_id, telegram, name = rnd.choice(members)
+        task = rnd.choice(tasks)
+        done_at = now - rnd.randrange(days * bot.DAY)
+        is_penalty = rnd.random() < penalty_share
+        is_confirmed = rnd.random() >= pending_share
+        points = -rnd.choice((1, 2)) if is_penalty else bot.DEFAULT_TASKS[task]['points']
+        batch.append((
+            household_id, task, telegram, name, points, 'матрос' if is_confirmed else None,
+            done_at, done_at + 600 if is_confirmed else None,
+            int(is_confirmed), int(is_penalty), None,
+        ))
+        if len(batch) == 10000:
+            _insert(conn, batch)
+            batch = []
+    _insert(conn, batch)
+
+    # Производные таблицы — как после живой работы бота
+    with bot.transaction() as c:
+        c.execute("DELETE FROM daily_rollup")
+        c.execute('''INSERT INTO daily_rollup
+                     (household_id, day, user_telegram, task, is_penalty, points_sum, count)
+                     SELECT household_id, date / 86400, user_telegram, task, is_penalty,
+                            SUM(points), COUNT(*)
+                     FROM tasks_done WHERE is_confirmed = 1
+                     GROUP BY household_id, date / 86400, user_telegram, task, is_penalty''')
+        c.execute('''UPDATE users SET balance = MAX(COALESCE(
+                         (SELECT SUM(points) FROM tasks_done
+                          WHERE household_id = users.household_id
+                                AND user_telegram = users.telegram AND is_confirmed = 1), 0),
+                         (SELECT min_balance FROM households WHERE id = users.household_id))''')
+    bot.rebuild_rotation_state()
+    conn.execute("ANALYZE")
+    return [(household_id, telegram) for household_id, telegram, _ in members]
+
+def _insert(conn, batch):
+    with conn:
+        conn.executemany(
+            '''INSERT INTO tasks_done (household_id, task, user_telegram, user_name, points,
+                                       confirmed_by, date, confirmed_at, is_confirmed,
+                                       is_penalty, details)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            batch
+        )
+
+
+# ==================== СЦЕНАРИИ ====================
+def scenarios(members, rnd):
+    """(имя, функция подготовки) — подготовка возвращает (callback_data, пользователь).
+
+    Админские сценарии идут от админа квартиры 1 по её участникам.
+    """
+    admin = next(iter(bot.DEFAULT_ADMINS))
+    tasks = list(bot.DEFAULT_TASKS)
+    home = [telegram for household_id, telegram in members if household_id == 1]
+    members = [telegram for _, telegram in members]
+
+    def who():
+        return f'who_{rnd.choice(tasks)}', rnd.choice(members)
+
+    def did():
+        return f'did_{rnd.choice(tasks)}', rnd.choice(members)
+
+    def confirm():
+        # Свежая неподтверждённая запись; админ может подтвердить любую
+        task_id = bot.execute_query(
+            '''INSERT INTO tasks_done (household_id, task, user_telegram, user_name, points, date)
+               VALUES (1, ?, ?, ?, ?, ?)''',
+            (rnd.choice(tasks), rnd.choice(home), 'bench', 2, bot.now_ts())
+        )
+        return f'confirm_{task_id}_{bot.DEFAULT_USERS[admin]}', admin
+
+    def stats():
+        bot.stats_cache.invalidate()
+        return 'stats', rnd.choice(members)
+
+    def stats_cached():
+        return 'stats', rnd.choice(members)
+
+    def user_stats():
+        return f'user_stats_{rnd.choice(home)}', admin
+
+    def user_history_filter():
+        return f'uh_{rnd.choice(home)}_t{rnd.randrange(len(tasks))}_n_', admin
+
+    return [
+        ('process_who', who),
+        ('process_did', did),
+        ('process_confirmation', confirm),
+        ('show_stats', stats),
+        ('show_stats_cached', stats_cached),
+        ('show_user_stats', user_stats),
+        ('show_user_stats_task', user_history_filter),
+    ]
+
+def query_count():
+    return sum(count for _, count, *_ in bot.profiler.top(sys.maxsize))
+
+async def press(data, user):
+    """Одно нажатие: (секунды, запросов к БД, вызовов Bot API)"""
+    api_calls = [0]
+    update, context = make_update(data, user, api_calls)
+    queries = query_count()
+    started = time.perf_counter()
+    await bot.button_handler(update, context)
+    elapsed = time.perf_counter() - started
+    return elapsed, query_count() - queries, api_calls[0]
+
+def summarize(samples):
+    times = sorted(s[0] * 1000 for s in samples)
+    pick = lambda q: times[min(len(times) - 1, int(q * len(times)))]
+    return {
+        'runs': len(times),
+        'p50_ms': round(pick(0.50), 3),
+        'p99_ms': round(pick(0.99), 3),
+        'mean_ms': round(sum(times) / len(times), 3),
+        'queries_per_call': round(sum(s[1] for s in samples) / len(samples), 2),
+        'api_calls_per_call': round(sum(s[2] for s in samples) / len(samples), 2),
+    }
+
+async def run(args):
+    rnd = random.Random(args.seed)
+    started = time.perf_counter()
+    members = generate_history(args.rows, args.users, args.days, args.households, seed=args.seed)
+    print(f"📦 {args.rows} записей, {args.users} участников, {args.households} квартир: "
+          f"{time.perf_counter() - started:.1f} с")
+
+    results = {}
+    for name, prepare in scenarios(members, rnd):
+        for _ in range(args.warmup):
+            await press(*prepare())
+        samples = []
+        for _ in range(args.runs):
+            samples.append(await press(*prepare()))
+        results[name] = summarize(samples)
+
+    # Полный сброс разрушает данные: каждый прогон — на копии базы
+    admin = next(iter(bot.DEFAULT_ADMINS))
+    snapshot = os.path.join(WORKDIR, 'snapshot.db')
+    bot.get_conn().execute(f"VACUUM INTO '{snapshot}'")
+    samples = []
+    for _ in range(args.reset_runs):
+        source = bot.sqlite3.connect(snapshot)
+        source.backup(bot.get_conn())
+        source.close()
+        samples.append(await press('admin_reset_yes', admin))
+    results['admin_reset_yes'] = summarize(samples)
+    return results
+
+def print_table(results, baseline=None):
+    print(f"{'сценарий':<24}{'p50 мс':>10}{'p99 мс':>10}{'запросов':>10}{'API':>6}")
+    for name, r in results.items():
+        line = (f"{name:<24}{r['p50_ms']:>10.2f}{r['p99_ms']:>10.2f}"
+                f"{r['queries_per_call']:>10.1f}{r['api_calls_per_call']:>6.1f}")
+        old = (baseline or {}).get(name)
+        if old and old['p50_ms']:
+            line += f"   p50 {(r['p50_ms'] / old['p50_ms'] - 1) * 100:+.0f}%"
+            line += f", запросов {r['queries_per_call'] - old['queries_per_call']:+.1f}"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000, help='записей в tasks_done')
+    parser.add_argument('--users', type=int, default=20, help='синтетических участников')
+    parser.add_argument('--households', type=int, default=1, help='квартир (участники делятся по кругу)')
+    parser.add_argument('--days', type=int, default=365, help='глубина истории в днях')
+    parser.add_argument('--runs', type=int, default=200, help='замеров на сценарий')
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--reset-runs', type=int, default=3, help='замеров admin_reset_yes')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', help='сохранить результаты в JSON')
+    parser.add_argument('--compare', help='JSON прошлого прогона для сравнения')
+    args = parser.parse_args()
+
+    try:
+        results = asyncio.run(run(args))
+    finally:
+        bot.db_pool.close_all()
+        bot.db_executor.shutdown()
+        shutil.rmtree(WORKDIR, ignore_errors=True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    print_table(results, baseline)
+
+    if args.out:
+        report = {
+            'created_at': bot.now_ts(),
+            'params': {k: v for k, v in vars(args).items() if k not in ('out', 'compare')},
+            'python': platform.python_version(),
+            'sqlite': bot.sqlite3.sqlite_version,
+            'results': results,
+        }
+        with open(args.out, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"💾 {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,46 +1,172 @@
 import sqlite3
+import asyncio
+import contextvars
 import logging
 import threading
+import weakref
 import os
-from datetime import datetime, timedelta
+import time
+import json
+import hmac
+import hashlib
+import re
+import signal
+import sys
+import urllib.request
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Updater, CommandHandler, CallbackQueryHandler
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler, TypeHandler
+from telegram.error import BadRequest, RetryAfter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+try:
+    import psycopg2
+    import psycopg2.pool
+except ImportError:  # нужен только для DB_BACKEND=postgres
+    psycopg2 = None
 
 class HealthHandler(BaseHTTPRequestHandler):
     def do_GET(self):
+        """/ — процесс жив, /healthz — база отвечает, /metrics — метрики Prometheus.
+
+        У супервизора (см. ПРОЦЕССЫ) /healthz и /metrics охватывают и рабочие процессы.
+        """
+        workers = getattr(self.server, 'workers', None)
+        if self.path == '/metrics':
+            text = metrics.render(getattr(self.server, 'application', None))
+            if workers is not None:
+                text = workers.render_metrics(text)
+            self._reply(200, text, 'text/plain; version=0.0.4; charset=utf-8')
+        elif self.path == '/healthz':
+            try:
+                storage.check()
+            except Exception as e:
+                self._reply(503, f"DB: {e}")
+                return
+            try:
+                if workers is not None:
+                    workers.check()
+            except Exception as e:
+                self._reply(503, str(e))
+            else:
+                self._reply(200, "OK")
+        else:
+            self._reply(200, "OK")
+
+    def _reply(self, status, body, content_type='text/plain; charset=utf-8'):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        """Приём апдейтов Telegram в режиме webhook"""
+        application = getattr(self.server, 'application', None)
+        if application is None or self.server.loop is None or self.path != WEBHOOK_PATH:
+            self.send_response(404)
+            self.end_headers()
+            return
+        
+        secret = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(secret, WEBHOOK_SECRET):
+            self.send_response(403)
+            self.end_headers()
+            return
+        
+        length = int(self.headers.get('Content-Length', 0))
+        if not 0 < length <= WEBHOOK_MAX_BODY:
+            self.send_response(413 if length else 400)
+            self.end_headers()
+            return
+        
+        try:
+            update = Update.de_json(json.loads(self.rfile.read(length)), application.bot)
+        except ValueError:
+            self.send_response(400)
+            self.end_headers()
+            return
+        
+        # Апдейт уходит в очередь приложения в его цикле событий; ответ Telegram — сразу
+        asyncio.run_coroutine_threadsafe(application.update_queue.put(update), self.server.loop)
         self.send_response(200)
         self.end_headers()
-        self.wfile.write(b"OK")
 
-def run_http_server():
+    def log_message(self, format, *args):
+        # Не засоряем лог строкой на каждый апдейт и health check
+        pass
+
+def make_http_server(application=None, loop=None, host="0.0.0.0"):
+    """HTTP-сервер на PORT: health check и метрики, а в режиме webhook (задан loop) — приём апдейтов"""
     port = int(os.getenv("PORT", 10000))
-    server = HTTPServer(("0.0.0.0", port), HealthHandler)
-    server.serve_forever()
+    server = ThreadingHTTPServer((host, port), HealthHandler)
+    server.daemon_threads = True
+    server.application = application
+    server.loop = loop
+    return server
+
+def run_http_server(application=None):
+    make_http_server(application).serve_forever()
 
 # ==================== НАСТРОЙКИ ====================
 TOKEN = os.getenv("BOT_TOKEN")
 if not TOKEN:
     raise RuntimeError("BOT_TOKEN is not set")
 
-DATABASE = "/app/data/fairflat_fix.db"
+DATABASE = os.getenv("DATABASE", "/app/data/fairflat_fix.db")
+
+# Хранилище: sqlite (файл DATABASE, шарды — см. ШАРДЫ) или postgres (DATABASE_URL).
+# С postgres несколько процессов бота работают с общими данными, а кэши
+# настроек и статистики в памяти живут не дольше SHARED_CACHE_TTL секунд
+DB_BACKEND = os.getenv("DB_BACKEND", "sqlite")
+if DB_BACKEND not in ("sqlite", "postgres"):
+    raise RuntimeError(f"Unknown DB_BACKEND: {DB_BACKEND}")
+DATABASE_URL = os.getenv("DATABASE_URL", "")
+SHARED_CACHE_TTL = int(os.getenv("SHARED_CACHE_TTL", 30))
+
+# Адрес Bot API; для нагрузочного теста — локальная заглушка (см. loadtest.py)
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL", "").rstrip('/')
+
+# Сколько апдейтов обрабатывается одновременно; апдейты одного чата — всегда
+# по очереди (ChatOrderedUpdateProcessor, см. ПРОЦЕССЫ)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", 64))
+
+# Рабочие процессы: при WORKERS > 0 апдейты раздаются WORKERS процессам по
+# хэшу чата (см. ПРОЦЕССЫ). WORKER_INDEX выставляет супервизор своим процессам
+WORKERS = int(os.getenv("WORKERS", 0))
+WORKER_INDEX = os.getenv("WORKER_INDEX")
+
+# Операторы бота — Telegram user id через запятую. Только им доступны команды,
+# которые касаются всех квартир сразу: /archive, /dbtop, /routes
+OPERATOR_IDS = {int(user_id) for user_id in os.getenv("OPERATOR_IDS", "").replace(',', ' ').split()}
+
+# Webhook: если задан WEBHOOK_URL, апдейты приходят POST-запросами на PORT вместо polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip('/')
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(TOKEN.encode()).hexdigest()[:32]
+WEBHOOK_MAX_BODY = 1024 * 1024
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-# Участники
-USERS = {
+# Начальные данные. Участники, админы, задачи и минимальный баланс живут в БД
+# у каждой квартиры (см. КВАРТИРЫ); отсюда заполняется квартира 1 — та, что
+# была до появления квартир, — и каталог задач для новых квартир
+DEFAULT_USERS = {
     '@DILLC7': 'матрос',
     '@djumshut2000': 'Борода', 
     '@naattive': 'Даник'
 }
 
-# Админы
-ADMINS = {'@DILLC7'}
+DEFAULT_ADMINS = {'@DILLC7'}
 
-# Минимальный баланс
-MIN_BALANCE = -10
+DEFAULT_MIN_BALANCE = -10
 
-# Задачи
-TASKS = {
+DEFAULT_TASKS = {
     'санузел': {'points': 4, 'rules': '• Мойка унитаза\n• Пол в туалете'},
     'ванна': {'points': 3, 'rules': '• Мойка ванны/душа\n• Мойка раковины\n• Уборка на стиральной машине'},
     'кухня': {'points': 3, 'rules': '• Пылесос пола на кухне\n• Уборка общего стола\n• Уборка стола у раковины\n• Уборка плиты'},
@@ -51,290 +177,3182 @@ TASKS = {
     'посуда': {'points': 2, 'rules': '• Мытьё посуды после ОБЩЕЙ готовки\n• Протирка стола после еды\n• Чистка плиты если нужно'}
 }
 
-# ==================== БАЗА ДАННЫХ ====================
-def init_db():
-    """Инициализация базы данных (БЕЗ СТИРАНИЯ ДАННЫХ)"""
-    conn = sqlite3.connect(DATABASE, check_same_thread=False)
-    c = conn.cursor()
-    
-    # Создаём таблицы если их нет
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (telegram TEXT PRIMARY KEY,
-                  name TEXT,
-                  is_home BOOLEAN DEFAULT 1,
-                  balance INTEGER DEFAULT 0)''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS tasks_done
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  task TEXT,
-                  user_telegram TEXT,
-                  user_name TEXT,
-                  points INTEGER,
-                  confirmed_by TEXT,
-                  date TEXT,
-                  confirmed_at TEXT,
-                  is_confirmed BOOLEAN DEFAULT 0,
-                  is_penalty BOOLEAN DEFAULT 0,
-                  details TEXT)''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS queue
-                 (task TEXT PRIMARY KEY,
-                  last_user TEXT,
-                  last_date TEXT)''')
-    
-    # ✅ ДОБАВЛЯЕМ пользователей только если их нет
-    for telegram, name in USERS.items():
-        c.execute('''INSERT OR IGNORE INTO users (telegram, name) VALUES (?, ?)''',
-                  (telegram, name))
-    
-    # ✅ ДОБАВЛЯЕМ задачи в очередь только если их нет
-    for task in TASKS.keys():
-        c.execute('''INSERT OR IGNORE INTO queue (task, last_user, last_date) 
-                     VALUES (?, ?, ?)''',
-                  (task, 'никто', None))
-    
-    conn.commit()
-    conn.close()
-    print("✅ База данных инициализирована (данные сохранены)")
+# ==================== МЕТРИКИ ====================
+# Формат — текстовый формат Prometheus, без сторонних библиотек
+# pending_confirmations — запрос по всем базам квартир, поэтому число
+# пересчитывается не чаще раза в PENDING_METRIC_TTL секунд
+PENDING_METRIC_TTL = float(os.getenv("PENDING_METRIC_TTL", 15))
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # [счётчики по корзинам..., сумма, количество]
+                series = self._series[labels] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.labelnames + ('le',)
+        with self._lock:
+            for labels, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_format_labels(names, labels + (bound,))} {cumulative}")
+                lines.append(f"{self.name}_bucket{_format_labels(names, labels + ('+Inf',))} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {series[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {series[-1]}")
+        return lines
+
+
+class Metrics:
+    """Все метрики бота; render() собирает текст для /metrics"""
+
+    def __init__(self):
+        self.callback_seconds = Histogram(
+            'fairflat_callback_seconds', 'Время обработки нажатия кнопки', ('route',))
+        self.callback_errors = Counter(
+            'fairflat_callback_errors_total', 'Исключения в обработчиках кнопок', ('route',))
+        self.db_seconds = Histogram(
+            'fairflat_db_query_seconds', 'Время запросов к БД', ('kind',))
+        self.db_errors = Counter(
+            'fairflat_db_errors_total', 'Ошибки запросов к БД', ('kind',))
+        self.telegram_seconds = Histogram(
+            'fairflat_telegram_api_seconds', 'Время вызовов Bot API', ('method',))
+        self.telegram_errors = Counter(
+            'fairflat_telegram_api_errors_total', 'Ошибки вызовов Bot API', ('method', 'error'))
+        self._pending = (None, 0)  # (значение, когда пересчитать)
+        self._pending_lock = threading.Lock()
+
+    def pending_confirmations(self):
+        """storage.count_pending() с кэшем на PENDING_METRIC_TTL секунд"""
+        with self._pending_lock:
+            value, expires_at = self._pending
+            if value is None or time.monotonic() >= expires_at:
+                value = storage.count_pending()
+                self._pending = (value, time.monotonic() + PENDING_METRIC_TTL)
+            return value
+
+    def render(self, application=None):
+        lines = []
+        for metric in (self.callback_seconds, self.callback_errors, self.db_seconds,
+                       self.db_errors, self.telegram_seconds, self.telegram_errors):
+            lines.extend(metric.render())
+        
+        gauges = [
+            ('fairflat_outbound_backlog', 'Запросы к Bot API, ждущие отправки', outbound.backlog()),
+            ('fairflat_outbound_coalesced_total', 'Склеенные правки сообщений', outbound.coalesced),
+            ('fairflat_outbound_retries_total', 'Повторы после flood control', outbound.retried),
+        ]
+        if application is not None:
+            gauges.append(('fairflat_update_backlog', 'Апдейты в очереди приложения',
+                           application.update_queue.qsize()))
+        # База общая: у рабочих процессов это число то же, его отдаёт супервизор
+        if WORKER_INDEX is None:
+            try:
+                gauges.append(('fairflat_pending_confirmations', 'Задачи, ждущие подтверждения',
+                               self.pending_confirmations()))
+            except Exception as e:
+                logging.warning(f"⚠️ Метрика pending_confirmations недоступна: {e}")
+        
+        for name, help_text, value in gauges:
+            kind = 'counter' if name.endswith('_total') else 'gauge'
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+# ==================== ПРОФИЛИРОВАНИЕ ЗАПРОСОВ ====================
+# Включается DB_PROFILE=1: каждый запрос замеряется и сводится к «отпечатку»
+DB_PROFILE = os.getenv("DB_PROFILE", "") == "1"
+DB_SLOW_MS = float(os.getenv("DB_SLOW_MS", 50))
+
+_SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SQL_IN_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+@lru_cache(maxsize=1024)
+def fingerprint(sql):
+    """Нормализованный запрос: литералы → ?, списки IN (?, ?, ...) → (...)"""
+    sql = ' '.join(sql.split())
+    sql = _SQL_LITERALS.sub('?', sql)
+    return _SQL_IN_LISTS.sub('(...)', sql)
+
+
+class QueryProfiler:
+    """Сводка по отпечаткам запросов и журнал медленных запросов"""
+
+    def __init__(self, slow_ms=DB_SLOW_MS):
+        self.slow_ms = slow_ms
+        self._stats = {}
+        self._plans = {}
+        self._lock = threading.Lock()
+
+    def record(self, conn, sql, params, elapsed):
+        fp = fingerprint(sql)
+        with self._lock:
+            # [вызовов, суммарное время, максимум]
+            entry = self._stats.get(fp)
+            if entry is None:
+                entry = self._stats[fp] = [0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] = max(entry[2], elapsed)
+        
+        if elapsed * 1000 >= self.slow_ms:
+            logging.warning(
+                f"🐢 Медленный запрос {elapsed * 1000:.1f} мс: {fp}\n{self.plan(conn, fp, sql, params)}"
+            )
+
+    def plan(self, conn, fp, sql, params):
+        """EXPLAIN QUERY PLAN; строится один раз на отпечаток.
+
+        EXPLAIN идёт без блокировки: если два потока построят план одновременно,
+        в кэше останется первый.
+        """
+        with self._lock:
+            plan = self._plans.get(fp)
+        if plan is not None:
+            return plan
+        
+        if sql.split(None, 1)[0].upper() not in ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH'):
+            plan = '(без плана)'
+        else:
+            try:
+                # Мимо профилирующего execute, чтобы не замерять сам EXPLAIN
+                rows = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, params).fetchall()
+                plan = '\n'.join(f"  {row[-1]}" for row in rows)
+            except sqlite3.Error as e:
+                plan = f"(план недоступен: {e})"
+        with self._lock:
+            return self._plans.setdefault(fp, plan)
+
+    def top(self, limit=10):
+        """[(отпечаток, вызовов, всего мс, среднее мс, максимум мс)] по суммарному времени"""
+        with self._lock:
+            items = sorted(self._stats.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+        return [
+            (fp, count, total * 1000, total / count * 1000, peak * 1000)
+            for fp, (count, total, peak) in items
+        ]
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self._plans.clear()
+
+
+profiler = QueryProfiler()
+
+
+class ProfilingCursor(sqlite3.Cursor):
+    """Курсор, который замеряет запросы вместе с чтением строк.
+
+    SQLite выполняет SELECT по мере чтения: execute() делает только первый
+    шаг, остальное время уходит в fetch*. Поэтому время запроса копится,
+    пока его строки читаются, и записывается, когда строки кончились,
+    курсор выполнил следующий запрос или закрылся.
+    """
+
+    _pending = None  # [sql, параметры, время]
+
+    def _record(self):
+        if self._pending is not None:
+            sql, params, elapsed = self._pending
+            self._pending = None
+            profiler.record(self.connection, sql, params, elapsed)
+
+    def _timed(self, fetch, *args):
+        started = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            if self._pending is not None:
+                self._pending[2] += time.perf_counter() - started
+
+    def execute(self, sql, params=()):
+        self._record()
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            self._pending = [sql, params, time.perf_counter() - started]
+            if self.description is None:
+                # Запрос без строк уже выполнен целиком
+                self._record()
+
+    def executemany(self, sql, seq_of_params):
+        self._record()
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_params)
+        finally:
+            profiler.record(self.connection, sql, (), time.perf_counter() - started)
+
+    def fetchone(self):
+        row = self._timed(super().fetchone)
+        if row is None:
+            self._record()
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        rows = self._timed(super().fetchmany, size)
+        if len(rows) < size:
+            self._record()
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(super().fetchall)
+        self._record()
+        return rows
+
+    def __next__(self):
+        try:
+            return self._timed(super().__next__)
+        except StopIteration:
+            self._record()
+            raise
+
+    def close(self):
+        self._record()
+        super().close()
+
+    def __del__(self):
+        self._record()
+
+
+class ProfilingConnection(sqlite3.Connection):
+    """Соединение, все курсоры которого замеряют запросы"""
+
+    def cursor(self, factory=ProfilingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+# ==================== БАЗА ДАННЫХ ====================
+class ConnectionPool:
+    """Пул долгоживущих соединений с БД (по одному на поток)"""
+
+    def __init__(self, database, busy_timeout=5000, max_idle=8, cached_statements=256, profile=DB_PROFILE):
+        self.database = database
+        self.busy_timeout = busy_timeout
+        self.max_idle = max_idle
+        self.cached_statements = cached_statements
+        self.profile = profile
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def _connect(self):
+        """Открыть новое соединение с нужными PRAGMA"""
+        conn = sqlite3.connect(
+            self.database,
+            timeout=self.busy_timeout / 1000,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+            factory=ProfilingConnection if self.profile else sqlite3.Connection,
+        )
+        # В новом файле режим применяется сразу (до WAL, который пишет заголовок);
+        # существующую базу переводит только VACUUM (см. enable_incremental_vacuum)
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout)}")
+        # В режиме WAL NORMAL не делает fsync на каждый commit
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _release(self, conn):
+        """Вернуть соединение умершего потока в пул"""
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def get(self):
+        """Соединение текущего потока (создаётся при первом обращении)"""
+        lease = getattr(self._local, 'lease', None)
+        if lease is None:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                conn = self._connect()
+            lease = _Lease(self, conn)
+            self._local.lease = lease
+        return lease.conn
+
+    def close_all(self):
+        """Закрыть все свободные соединения и соединение текущего потока"""
+        lease = getattr(self._local, 'lease', None)
+        if lease is not None:
+            self._local.lease = None
+            lease.detach()
+            lease.conn.close()
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class _Lease:
+    """Привязка соединения к потоку: при завершении потока соединение возвращается в пул"""
+
+    def __init__(self, pool, conn):
+        self.conn = conn
+        self._finalizer = weakref.finalize(self, pool._release, conn)
+
+    def detach(self):
+        self._finalizer.detach()
+
+
+db_pool = ConnectionPool(DATABASE)
+
+# Область БД потока: с какой базой работают get_conn(), execute_query и transaction()
+_db_scope = threading.local()
+
+
+def get_conn():
+    """Соединение текущего потока с базой текущей области (по умолчанию — основной)"""
+    return getattr(_db_scope, 'pool', db_pool).get()
+
+@contextmanager
+def using_db(pool):
+    """Внутри блока запросы текущего потока идут в базу пула pool"""
+    previous = getattr(_db_scope, 'pool', db_pool)
+    _db_scope.pool = pool
+    try:
+        yield pool
+    finally:
+        _db_scope.pool = previous
+
+def execute_query(query, params=()):
+    """Выполнить запрос"""
+    conn = get_conn()
+    c = conn.cursor()
+    kind = query.lstrip()[:6].upper()
+    started = time.perf_counter()
+    try:
+        c.execute(query, params)
+        if conn.in_transaction:
+            conn.commit()
+        if kind == 'SELECT':
+            return c.fetchall()
+        elif kind == 'INSERT':
+            return c.lastrowid
+        return True
+    except Exception as e:
+        if conn.in_transaction:
+            conn.rollback()
+        metrics.db_errors.inc(kind)
+        print(f"❌ Ошибка БД: {e}")
+        return None
+    finally:
+        c.close()
+        metrics.db_seconds.observe(time.perf_counter() - started, kind)
+
+def check_db():
+    """Проверка готовности: база открывается и читается (исключение — если нет)"""
+    conn = get_conn()
+    conn.execute("SELECT COUNT(*) FROM schema_version").fetchone()
+
+@contextmanager
+def transaction():
+    """Транзакция на соединении текущего потока: commit при успехе, rollback при ошибке"""
+    conn = get_conn()
+    c = conn.cursor()
+    started = time.perf_counter()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        yield c
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        metrics.db_errors.inc('TRANSACTION')
+        raise
+    finally:
+        c.close()
+        metrics.db_seconds.observe(time.perf_counter() - started, 'TRANSACTION')
+
+# ==================== ШАРДЫ ====================
+# При DB_SHARDS > 0 данные каждой квартиры живут в своём файле shard_NNNN.db
+# (household_id % DB_SHARDS) в DB_SHARD_DIR, и записи разных квартир не ждут
+# одну блокировку. DATABASE остаётся каталогом: квартиры, чаты и участники.
+# Единую базу раскладывает по шардам shard_split.py
+DB_SHARDS = int(os.getenv("DB_SHARDS", 0))
+DB_SHARD_DIR = os.getenv("DB_SHARD_DIR") or os.path.join(os.path.dirname(DATABASE), 'shards')
+# Сколько соединений с шардами держит открытыми каждый поток
+DB_SHARDS_OPEN = int(os.getenv("DB_SHARDS_OPEN", 32))
+
+# Таблицы с данными квартиры (у всех есть household_id) и таблицы каталога
+HOUSEHOLD_TABLES = ('users', 'household_tasks', 'queue', 'rotation_state', 'daily_rollup',
+                    'tasks_done', 'tasks_done_archive', 'archive_summary', 'history_purge')
+DIRECTORY_TABLES = ('households', 'household_members')
+
+class ShardRouter:
+    """Квартира → пул соединений её шарда.
+
+    Пулы создаются лениво, схема нового файла накатывается миграциями.
+    Поток держит не больше max_open соединений с шардами: при переполнении
+    он сам закрывает то, к которому обращался давнее всех (LRU), так что
+    чужое соединение никогда не закрывается посреди запроса.
+    """
+
+    def __init__(self, directory, shards, max_open=DB_SHARDS_OPEN):
+        self.directory = directory
+        self.shards = shards
+        self.max_open = max_open
+        self._pools = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def shard_of(self, household_id):
+        return household_id % self.shards
+
+    def path(self, shard):
+        return os.path.join(self.directory, f"shard_{shard:04d}.db")
+
+    def pool(self, household_id):
+        """Пул шарда квартиры"""
+        return self.shard_pool(self.shard_of(household_id))
+
+    def shard_pool(self, shard):
+        """Пул шарда; в этом потоке он становится последним использованным"""
+        pool = self._pools.get(shard) or self._open(shard)
+        recent = getattr(self._local, 'recent', None)
+        if recent is None:
+            recent = self._local.recent = OrderedDict()
+        recent[shard] = pool
+        recent.move_to_end(shard)
+        while len(recent) > self.max_open:
+            _, evicted = recent.popitem(last=False)
+            evicted.close_all()
+        return pool
+
+    def create_all(self):
+        """Создать файлы всех шардов заранее: рабочие процессы (см. ПРОЦЕССЫ)
+        не должны создавать один и тот же новый файл одновременно"""
+        for shard in range(self.shards):
+            self.shard_pool(shard)
+
+    def existing(self):
+        """Номера шардов, файлы которых уже созданы"""
+        return [shard for shard in range(self.shards) if os.path.exists(self.path(shard))]
+
+    def _open(self, shard):
+        with self._lock:
+            pool = self._pools.get(shard)
+            if pool is None:
+                os.makedirs(self.directory, exist_ok=True)
+                fresh = not os.path.exists(self.path(shard))
+                # Соединение завершившегося потока закрывается, а не копится в пуле
+                pool = ConnectionPool(self.path(shard), max_idle=0)
+                init_shard(pool.get(), fresh, keep_default=self.shard_of(1) == shard)
+                if fresh:
+                    print(f"🗂 Новый шард: {self.path(shard)}")
+                self._pools[shard] = pool
+        return pool
+
+
+def init_shard(conn, fresh, keep_default):
+    """Схема файла шарда; в новом файле — без каталога и без квартиры 1, если она не его"""
+    migrate(conn, verbose=False)
+    if fresh:
+        # Миграции заполняют каталог и квартиру 1 — в шарде это лишнее
+        with conn:
+            for table in DIRECTORY_TABLES:
+                conn.execute(f"DELETE FROM {table}")
+            if not keep_default:
+                for table in HOUSEHOLD_TABLES:
+                    conn.execute(f"DELETE FROM {table} WHERE household_id = 1")
+
+
+shards = ShardRouter(DB_SHARD_DIR, DB_SHARDS) if DB_SHARDS > 0 else None
+
+def household_db(household_id):
+    """Область БД квартиры: её шард, а без шардов — основная база"""
+    return using_db(shards.pool(household_id) if shards else db_pool)
+
+def directory_db():
+    """Область каталога квартир (основная база)"""
+    return using_db(db_pool)
+
+def each_household_db():
+    """Пулы всех баз с данными квартир: созданные шарды или одна основная база"""
+    if shards is None:
+        yield db_pool
+        return
+    for shard in shards.existing():
+        yield shards.shard_pool(shard)
+
+# ==================== ИСПОЛНИТЕЛЬ БД ====================
+# Вся работа с SQLite идёт в отдельных потоках, чтобы не блокировать цикл событий.
+# У каждого потока своё соединение из пула своей области.
+DB_WORKERS = int(os.getenv("DB_WORKERS", 2))
+db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='db')
+
+# Квартира текущего апдейта: задаётся один раз (button_handler, command_household),
+# и run_db выполняет функции в области её базы
+current_household = contextvars.ContextVar('current_household', default=None)
+
+async def run_db(func, *args):
+    """Выполнить функцию работы с БД в исполнителе БД (в базе текущей квартиры)"""
+    loop = asyncio.get_running_loop()
+    household_id = current_household.get()
+    if household_id is None:
+        return await loop.run_in_executor(db_executor, func, *args)
+    return await loop.run_in_executor(db_executor, _run_in_household, household_id, func, args)
+
+def _run_in_household(household_id, func, args):
+    with household_db(household_id):
+        return func(*args)
+
+# ==================== ВРЕМЯ ====================
+# В БД время хранится целыми секундами UTC; в строку — только при выводе
+DAY = 86400
+
+def now_ts():
+    """Текущее время в секундах UTC"""
+    return int(time.time())
+
+@lru_cache(maxsize=4096)
+def _format_ts(ts, fmt):
+    return datetime.fromtimestamp(ts).strftime(fmt)
+
+def format_ts(ts, fmt='%d.%m.%Y'):
+    """Время для пользователя (локальная зона), с кэшем форматирования"""
+    if '%S' not in fmt:
+        # Без секунд в формате все моменты одной минуты дают одну строку
+        ts -= ts % 60
+    return _format_ts(ts, fmt)
+
+# ==================== МИГРАЦИИ ====================
+def migration_initial_schema(c):
+    """Начальная схема"""
+    c.execute('''CREATE TABLE IF NOT EXISTS users
+                 (telegram TEXT PRIMARY KEY,
+                  name TEXT,
+                  is_home BOOLEAN DEFAULT 1,
+                  balance INTEGER DEFAULT 0)''')
+    
+    c.execute('''CREATE TABLE IF NOT EXISTS tasks_done
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  task TEXT,
+                  user_telegram TEXT,
+                  user_name TEXT,
+                  points INTEGER,
+                  confirmed_by TEXT,
+                  date TEXT,
+                  confirmed_at TEXT,
+                  is_confirmed BOOLEAN DEFAULT 0,
+                  is_penalty BOOLEAN DEFAULT 0,
+                  details TEXT)''')
+    
+    c.execute('''CREATE TABLE IF NOT EXISTS queue
+                 (task TEXT PRIMARY KEY,
+                  last_user TEXT,
+                  last_date TEXT)''')
+
+def migration_tasks_done_indexes(c):
+    """Покрывающие индексы для статистики и истории"""
+    # SUM(points) за неделю по пользователю в show_stats
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_tasks_done_user_points
+                 ON tasks_done (user_telegram, is_confirmed, date, points)''')
+    # Частые задачи за неделю
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_tasks_done_frequent
+                 ON tasks_done (is_confirmed, is_penalty, date, task)''')
+    # История пользователя, ORDER BY date DESC в show_user_stats
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_tasks_done_user_history
+                 ON tasks_done (user_telegram, date)''')
+    c.execute("ANALYZE tasks_done")
+
+def migration_rotation_state(c):
+    """Материализованное состояние очереди: когда каждый последний раз делал задачу"""
+    c.execute('''CREATE TABLE IF NOT EXISTS rotation_state
+                 (task TEXT NOT NULL,
+                  user_telegram TEXT NOT NULL,
+                  last_done_at TEXT,
+                  PRIMARY KEY (task, user_telegram)) WITHOUT ROWID''')
+    c.execute("DELETE FROM rotation_state")
+    c.execute('''INSERT INTO rotation_state (task, user_telegram, last_done_at)
+                 SELECT task, user_telegram, MAX(date)
+                 FROM tasks_done
+                 WHERE is_confirmed = 1 AND is_penalty = 0
+                 GROUP BY task, user_telegram''')
+
+def migration_daily_rollup(c):
+    """Дневные агрегаты подтверждённых задач для статистики за неделю/месяц/всё время"""
+    c.execute('''CREATE TABLE IF NOT EXISTS daily_rollup
+                 (day TEXT NOT NULL,
+                  user_telegram TEXT NOT NULL,
+                  task TEXT NOT NULL,
+                  is_penalty INTEGER NOT NULL,
+                  points_sum INTEGER NOT NULL DEFAULT 0,
+                  count INTEGER NOT NULL DEFAULT 0,
+                  PRIMARY KEY (day, user_telegram, task, is_penalty)) WITHOUT ROWID''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_daily_rollup_user
+                 ON daily_rollup (user_telegram, day, points_sum)''')
+    # Добор «краевого» дня окна напрямую из tasks_done
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_tasks_done_confirmed_date
+                 ON tasks_done (is_confirmed, date, user_telegram, task, is_penalty, points)''')
+    c.execute("DELETE FROM daily_rollup")
+    c.execute('''INSERT INTO daily_rollup (day, user_telegram, task, is_penalty, points_sum, count)
+                 SELECT substr(date, 1, 10), user_telegram, task, is_penalty, SUM(points), COUNT(*)
+                 FROM tasks_done
+                 WHERE is_confirmed = 1
+                 GROUP BY substr(date, 1, 10), user_telegram, task, is_penalty''')
+
+def rebuild_table(c, table, create_sql, select_sql):
+    """Пересоздать таблицу с новой схемой, сохранив данные и индексы"""
+    indexes = [
+        sql for (sql,) in c.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+            (table,)
+        ).fetchall()
+    ]
+    c.execute(create_sql.format(table=f"{table}_new"))
+    c.execute(f"INSERT INTO {table}_new {select_sql}")
+    c.execute(f"DROP TABLE {table}")
+    c.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+    for sql in indexes:
+        c.execute(sql)
+
+def migration_epoch_timestamps(c):
+    """Даты строками 'YYYY-MM-DD HH:MM:SS' (локальное время) → целые секунды UTC"""
+    # 'utc' переводит локальное время, в котором писались строки, в UTC
+    to_epoch = "CAST(strftime('%s', {col}, 'utc') AS INTEGER)"
+    
+    rebuild_table(
+        c, 'tasks_done',
+        '''CREATE TABLE {table}
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            task TEXT,
+            user_telegram TEXT,
+            user_name TEXT,
+            points INTEGER,
+            confirmed_by TEXT,
+            date INTEGER,
+            confirmed_at INTEGER,
+            is_confirmed BOOLEAN DEFAULT 0,
+            is_penalty BOOLEAN DEFAULT 0,
+            details TEXT)''',
+        f'''SELECT id, task, user_telegram, user_name, points, confirmed_by,
+                  {to_epoch.format(col='date')}, {to_epoch.format(col='confirmed_at')},
+                  is_confirmed, is_penalty, details
+           FROM tasks_done'''
+    )
+    rebuild_table(
+        c, 'queue',
+        '''CREATE TABLE {table}
+           (task TEXT PRIMARY KEY,
+            last_user TEXT,
+            last_date INTEGER)''',
+        f"SELECT task, last_user, {to_epoch.format(col='last_date')} FROM queue"
+    )
+    rebuild_table(
+        c, 'rotation_state',
+        '''CREATE TABLE {table}
+           (task TEXT NOT NULL,
+            user_telegram TEXT NOT NULL,
+            last_done_at INTEGER,
+            PRIMARY KEY (task, user_telegram)) WITHOUT ROWID''',
+        f"SELECT task, user_telegram, {to_epoch.format(col='last_done_at')} FROM rotation_state"
+    )
+    # day — номер суток UTC (date / 86400)
+    rebuild_table(
+        c, 'daily_rollup',
+        '''CREATE TABLE {table}
+           (day INTEGER NOT NULL,
+            user_telegram TEXT NOT NULL,
+            task TEXT NOT NULL,
+            is_penalty INTEGER NOT NULL,
+            points_sum INTEGER NOT NULL DEFAULT 0,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, user_telegram, task, is_penalty)) WITHOUT ROWID''',
+        '''SELECT date / 86400, user_telegram, task, is_penalty, SUM(points), COUNT(*)
+           FROM tasks_done
+           WHERE is_confirmed = 1
+           GROUP BY date / 86400, user_telegram, task, is_penalty'''
+    )
+    c.execute("ANALYZE")
+
+def migration_archive(c):
+    """Архив старых подтверждённых записей и итоги по ним"""
+    c.execute('''CREATE TABLE IF NOT EXISTS tasks_done_archive
+                 (id INTEGER PRIMARY KEY,
+                  task TEXT,
+                  user_telegram TEXT,
+                  user_name TEXT,
+                  points INTEGER,
+                  confirmed_by TEXT,
+                  date INTEGER,
+                  confirmed_at INTEGER,
+                  is_penalty BOOLEAN DEFAULT 0,
+                  details TEXT)''')
+    # Итоги по архиву, чтобы пересборка очереди и всего-за-всё-время не читали архив
+    c.execute('''CREATE TABLE IF NOT EXISTS archive_summary
+                 (user_telegram TEXT NOT NULL,
+                  task TEXT NOT NULL,
+                  is_penalty INTEGER NOT NULL,
+                  count INTEGER NOT NULL DEFAULT 0,
+                  points_sum INTEGER NOT NULL DEFAULT 0,
+                  last_done_at INTEGER,
+                  PRIMARY KEY (user_telegram, task, is_penalty)) WITHOUT ROWID''')
+
+def migration_households(c):
+    """Квартиры: участники, админы, задачи и минимальный баланс — в БД по квартирам.
+
+    Все существующие данные становятся квартирой 1.
+    """
+    c.execute('''CREATE TABLE IF NOT EXISTS households
+                 (id INTEGER PRIMARY KEY,
+                  chat_id INTEGER UNIQUE,
+                  title TEXT NOT NULL,
+                  min_balance INTEGER NOT NULL)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS household_tasks
+                 (household_id INTEGER NOT NULL,
+                  task TEXT NOT NULL,
+                  points INTEGER NOT NULL,
+                  rules TEXT NOT NULL DEFAULT '',
+                  position INTEGER NOT NULL DEFAULT 0,
+                  PRIMARY KEY (household_id, task)) WITHOUT ROWID''')
+    c.execute(
+        "INSERT OR IGNORE INTO households (id, title, min_balance) VALUES (1, 'Квартира', ?)",
+        (DEFAULT_MIN_BALANCE,)
+    )
+    c.executemany(
+        "INSERT OR IGNORE INTO household_tasks (household_id, task, points, rules, position) VALUES (1, ?, ?, ?, ?)",
+        [(task, info['points'], info['rules'], i) for i, (task, info) in enumerate(DEFAULT_TASKS.items())]
+    )
+    
+    # Индексы без household_id: нужные пересоздаются ниже с ним впереди,
+    # idx_tasks_done_user_points окна статистики больше не используют
+    for index in ('idx_tasks_done_user_points', 'idx_tasks_done_user_history',
+                  'idx_tasks_done_confirmed_date', 'idx_daily_rollup_user'):
+        c.execute(f"DROP INDEX IF EXISTS {index}")
+    
+    rebuild_table(
+        c, 'users',
+        '''CREATE TABLE {table}
+           (household_id INTEGER NOT NULL,
+            telegram TEXT NOT NULL,
+            name TEXT,
+            is_admin INTEGER NOT NULL DEFAULT 0,
+            is_home BOOLEAN DEFAULT 1,
+            balance INTEGER DEFAULT 0,
+            PRIMARY KEY (household_id, telegram))''',
+        "SELECT 1, telegram, name, 0, is_home, balance FROM users ORDER BY rowid"
+    )
+    c.executemany(
+        "INSERT OR IGNORE INTO users (household_id, telegram, name) VALUES (1, ?, ?)",
+        DEFAULT_USERS.items()
+    )
+    c.executemany(
+        "UPDATE users SET is_admin = 1 WHERE household_id = 1 AND telegram = ?",
+        [(telegram,) for telegram in DEFAULT_ADMINS]
+    )
+    
+    # Добавление столбца со значением по умолчанию не переписывает таблицу
+    c.execute("ALTER TABLE tasks_done ADD COLUMN household_id INTEGER NOT NULL DEFAULT 1")
+    c.execute("ALTER TABLE tasks_done_archive ADD COLUMN household_id INTEGER NOT NULL DEFAULT 1")
+    
+    rebuild_table(
+        c, 'queue',
+        '''CREATE TABLE {table}
+           (household_id INTEGER NOT NULL,
+            task TEXT NOT NULL,
+            last_user TEXT,
+            last_date INTEGER,
+            PRIMARY KEY (household_id, task))''',
+        "SELECT 1, task, last_user, last_date FROM queue"
+    )
+    c.execute(
+        '''INSERT OR IGNORE INTO queue (household_id, task, last_user)
+           SELECT household_id, task, 'никто' FROM household_tasks'''
+    )
+    rebuild_table(
+        c, 'rotation_state',
+        '''CREATE TABLE {table}
+           (household_id INTEGER NOT NULL,
+            task TEXT NOT NULL,
+            user_telegram TEXT NOT NULL,
+            last_done_at INTEGER,
+            PRIMARY KEY (household_id, task, user_telegram)) WITHOUT ROWID''',
+        "SELECT 1, task, user_telegram, last_done_at FROM rotation_state"
+    )
+    rebuild_table(
+        c, 'daily_rollup',
+        '''CREATE TABLE {table}
+           (household_id INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            user_telegram TEXT NOT NULL,
+            task TEXT NOT NULL,
+            is_penalty INTEGER NOT NULL,
+            points_sum INTEGER NOT NULL DEFAULT 0,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (household_id, day, user_telegram, task, is_penalty)) WITHOUT ROWID''',
+        "SELECT 1, day, user_telegram, task, is_penalty, points_sum, count FROM daily_rollup"
+    )
+    rebuild_table(
+        c, 'archive_summary',
+        '''CREATE TABLE {table}
+           (household_id INTEGER NOT NULL,
+            user_telegram TEXT NOT NULL,
+            task TEXT NOT NULL,
+            is_penalty INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            points_sum INTEGER NOT NULL DEFAULT 0,
+            last_done_at INTEGER,
+            PRIMARY KEY (household_id, user_telegram, task, is_penalty)) WITHOUT ROWID''',
+        '''SELECT 1, user_telegram, task, is_penalty, count, points_sum, last_done_at
+           FROM archive_summary'''
+    )
+    
+    c.execute('''CREATE INDEX idx_tasks_done_user_history
+                 ON tasks_done (household_id, user_telegram, date)''')
+    c.execute('''CREATE INDEX idx_tasks_done_confirmed_date
+                 ON tasks_done (household_id, is_confirmed, date, user_telegram, task, is_penalty, points)''')
+    c.execute('''CREATE INDEX idx_daily_rollup_user
+                 ON daily_rollup (household_id, user_telegram, day, points_sum)''')
+    # Поиск квартиры по участнику (личные чаты)
+    c.execute("CREATE INDEX idx_users_telegram ON users (telegram)")
+    c.execute("ANALYZE")
+
+def migration_household_members(c):
+    """Каталог «участник → квартиры»: по нему ищется квартира в личном чате"""
+    c.execute('''CREATE TABLE IF NOT EXISTS household_members
+                 (telegram TEXT NOT NULL,
+                  household_id INTEGER NOT NULL,
+                  PRIMARY KEY (telegram, household_id)) WITHOUT ROWID''')
+    c.execute('''INSERT OR IGNORE INTO household_members (telegram, household_id)
+                 SELECT telegram, household_id FROM users''')
+    c.execute("DROP INDEX IF EXISTS idx_users_telegram")
+
+def migration_history_purge(c):
+    """Граница истории квартиры, которую после сброса удаляют порциями"""
+    c.execute('''CREATE TABLE IF NOT EXISTS history_purge
+                 (household_id INTEGER PRIMARY KEY,
+                  up_to_id INTEGER NOT NULL)''')
+
+def migration_member_user_ids(c):
+    """Telegram user id участников: кто есть кто, определяется по нему, а не по нику"""
+    c.execute("ALTER TABLE users ADD COLUMN user_id INTEGER")
+    c.execute('''CREATE UNIQUE INDEX idx_users_user_id ON users (household_id, user_id)
+                 WHERE user_id IS NOT NULL''')
+    c.execute("ALTER TABLE household_members ADD COLUMN user_id INTEGER")
+    c.execute('''CREATE INDEX idx_household_members_user_id ON household_members (user_id)
+                 WHERE user_id IS NOT NULL''')
+
+# Порядок важен: новые шаги добавляются только в конец
+MIGRATIONS = [
+    (1, 'Начальная схема', migration_initial_schema),
+    (2, 'Индексы tasks_done', migration_tasks_done_indexes),
+    (3, 'Таблица rotation_state', migration_rotation_state),
+    (4, 'Таблица daily_rollup', migration_daily_rollup),
+    (5, 'Даты в секундах UTC', migration_epoch_timestamps),
+    (6, 'Архив tasks_done', migration_archive),
+    (7, 'Квартиры', migration_households),
+    (8, 'Каталог участников', migration_household_members),
+    (9, 'Очистка истории', migration_history_purge),
+    (10, 'User id участников', migration_member_user_ids),
+]
+
+def get_schema_version(conn):
+    """Текущая версия схемы"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_version
+                    (version INTEGER PRIMARY KEY,
+                     description TEXT,
+                     applied_at TEXT)''')
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+def migrate(conn, verbose=True):
+    """Применить недостающие миграции, каждую в своей транзакции"""
+    current = get_schema_version(conn)
+    for version, description, step in MIGRATIONS:
+        if version <= current:
+            continue
+        c = conn.cursor()
+        try:
+            c.execute("BEGIN")
+            step(c)
+            c.execute(
+                "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                (version, description, now_ts())
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            c.close()
+        if verbose:
+            print(f"✅ Миграция {version}: {description}")
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+def init_db():
+    """Инициализация базы данных (БЕЗ СТИРАНИЯ ДАННЫХ)"""
+    conn = get_conn()
+    migrate(conn)
+    enable_incremental_vacuum(conn)
+    print("✅ База данных инициализирована (данные сохранены)")
+
+# Базу, созданную без incremental auto_vacuum, переводит в него только полный
+# VACUUM: он переписывает весь файл и всё это время держит базу. Поэтому он
+# делается лишь по DB_VACUUM_ON_START=1 — одним запуском в окно обслуживания
+DB_VACUUM_ON_START = os.getenv("DB_VACUUM_ON_START", "") == "1"
+
+def enable_incremental_vacuum(conn):
+    """Освобождённые архивом страницы возвращаются через incremental_vacuum.
+
+    Новые файлы создаются сразу в этом режиме (ConnectionPool), старую базу
+    переводит VACUUM, если он разрешён.
+    """
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return
+    if not DB_VACUUM_ON_START:
+        logging.warning("⚠️ В базе выключен incremental auto_vacuum: после архивации файл не уменьшится. "
+                        "Чтобы включить, запустите бот один раз с DB_VACUUM_ON_START=1 (полный VACUUM)")
+        return
+    logging.info("🧹 Полный VACUUM для включения incremental auto_vacuum...")
+    started = time.perf_counter()
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    logging.info(f"🧹 VACUUM завершён за {time.perf_counter() - started:.1f} с")
+
+# ==================== ГРАНИЦА СБРОСА ====================
+# После сброса квартиры её история до history_purge.up_to_id удаляется
+# порциями (см. reset_household). Пока удаление не закончено, эти записи
+# уже считаются удалёнными: все чтения истории их пропускают
+def not_purged(household=None, table='tasks_done'):
+    """Условие «запись table не попала под сброс».
+
+    household — плейсхолдер квартиры (':household'; граница читается один
+    раз); без него граница берётся по household_id каждой строки.
+    """
+    if household is not None:
+        return (f"{table}.id > (SELECT COALESCE(MAX(up_to_id), 0) FROM history_purge "
+                f"WHERE household_id = {household})")
+    return (f"NOT EXISTS (SELECT 1 FROM history_purge "
+            f"WHERE history_purge.household_id = {table}.household_id "
+            f"AND history_purge.up_to_id >= {table}.id)")
+
+# ==================== ДНЕВНЫЕ АГРЕГАТЫ ====================
+def add_to_rollup(c, household_id, done_at, user_telegram, task, is_penalty, points):
+    """Учесть подтверждённую запись в daily_rollup (внутри транзакции вызывающего)"""
+    c.execute(
+        '''INSERT INTO daily_rollup (household_id, day, user_telegram, task, is_penalty, points_sum, count)
+           VALUES (?, ?, ?, ?, ?, ?, 1)
+           ON CONFLICT (household_id, day, user_telegram, task, is_penalty)
+           DO UPDATE SET points_sum = daily_rollup.points_sum + excluded.points_sum,
+                         count = daily_rollup.count + 1''',
+        (household_id, done_at // DAY, user_telegram, task, 1 if is_penalty else 0, points)
+    )
+
+def window_bounds(since):
+    """Окно «с момента since»: целые сутки берутся из daily_rollup, первые (неполные) — из tasks_done.
+
+    Возвращает (since, номер первых суток, начало следующих за ними суток).
+    """
+    edge_day = since // DAY
+    return since, edge_day, (edge_day + 1) * DAY
+
+# Запросы окон; {user_filter} — фильтр по участнику или пусто
+WINDOW_POINTS_SELECT = '''SELECT user_telegram, SUM(points) FROM (
+                              SELECT user_telegram, points_sum AS points FROM daily_rollup
+                              WHERE household_id = :household AND day > :edge_day {user_filter}
+                              UNION ALL
+                              SELECT user_telegram, points FROM tasks_done
+                              WHERE household_id = :household AND is_confirmed = 1
+                                    AND date > :since AND date < :next_day {user_filter}
+                                    AND ''' + not_purged(':household') + '''
+                          ) AS window_points
+                          GROUP BY user_telegram'''
+
+WINDOW_TOP_TASKS_SELECT = '''SELECT task, SUM(cnt) AS total FROM (
+                                 SELECT task, count AS cnt FROM daily_rollup
+                                 WHERE household_id = :household AND day > :edge_day AND is_penalty = 0
+                                 UNION ALL
+                                 SELECT task, 1 FROM tasks_done
+                                 WHERE household_id = :household AND is_confirmed = 1
+                                       AND date > :since AND date < :next_day AND is_penalty = 0
+                                       AND ''' + not_purged(':household') + '''
+                             ) AS window_tasks
+                             GROUP BY task ORDER BY total DESC LIMIT :limit'''
+
+WINDOW_EXPIRY_SELECT = '''SELECT MIN(date) FROM tasks_done
+                          WHERE household_id = :household AND is_confirmed = 1
+                                AND date > :since AND date < :next_day
+                                AND ''' + not_purged(':household')
+
+ROLLUP_TOTAL_SELECT = "SELECT SUM(points_sum) FROM daily_rollup WHERE household_id = ? AND user_telegram = ?"
+
+def get_window_points(household_id, since, user_telegram=None):
+    """Подтверждённые баллы (со штрафами) с момента since: {telegram: сумма}"""
+    since, edge_day, next_day = window_bounds(since)
+    user_filter = "AND user_telegram = :user" if user_telegram else ""
+    rows = execute_query(
+        WINDOW_POINTS_SELECT.format(user_filter=user_filter),
+        {'household': household_id, 'edge_day': edge_day, 'since': since,
+         'next_day': next_day, 'user': user_telegram}
+    )
+    return {telegram: total or 0 for telegram, total in rows or []}
+
+def get_window_top_tasks(household_id, since, limit=3):
+    """Самые частые задачи (без штрафов) с момента since: [(задача, раз)]"""
+    since, edge_day, next_day = window_bounds(since)
+    return execute_query(
+        WINDOW_TOP_TASKS_SELECT,
+        {'household': household_id, 'edge_day': edge_day, 'since': since,
+         'next_day': next_day, 'limit': limit}
+    ) or []
+
+def get_window_expiry(household_id, since):
+    """Когда окно «с момента since» изменится: самая старая запись первых суток выпадет
+    из него, либо окно дойдёт до следующих суток"""
+    since, _, next_day = window_bounds(since)
+    result = execute_query(
+        WINDOW_EXPIRY_SELECT, {'household': household_id, 'since': since, 'next_day': next_day}
+    )
+    return window_expiry(since, next_day, result[0][0] if result else None)
+
+def window_expiry(since, next_day, oldest):
+    """Срок окна по самой старой записи его первых суток (oldest, может быть None)"""
+    shift = now_ts() - since
+    expires_at = next_day + shift
+    if oldest:
+        expires_at = min(expires_at, oldest + shift)
+    return expires_at
+
+def get_user_totals(household_id, user_telegram):
+    """Баллы пользователя за неделю, 30 дней и всё время"""
+    now = now_ts()
+    week = get_window_points(household_id, now - 7 * DAY, user_telegram).get(user_telegram, 0)
+    month = get_window_points(household_id, now - 30 * DAY, user_telegram).get(user_telegram, 0)
+    result = execute_query(ROLLUP_TOTAL_SELECT, (household_id, user_telegram))
+    total = result[0][0] if result and result[0][0] else 0
+    return week, month, total
+
+# ==================== ИСТОРИЯ ====================
+HISTORY_PAGE_SIZE = 20
+
+# Фильтры истории: код в callback_data → (подпись, условие SQL)
+HISTORY_FILTERS = {
+    'a': ('все записи', ''),
+    'p': ('только штрафы', 'AND is_penalty = 1'),
+    'w': ('ждут подтверждения', 'AND is_confirmed = 0'),
+}
+
+def _to_base36(n):
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    out = ''
+    while True:
+        n, r = divmod(n, 36)
+        out = digits[r] + out
+        if not n:
+            return out
+
+def encode_cursor(date, task_id):
+    """Компактный курсор (date, id) для callback_data"""
+    return f"{_to_base36(date)}.{_to_base36(task_id)}"
+
+def decode_cursor(cursor):
+    """Курсор из callback_data → (date, id) или None для первой страницы"""
+    if not cursor:
+        return None
+    date, task_id = cursor.split('.')
+    return int(date, 36), int(task_id, 36)
+
+def get_history_page(household_id, user_telegram, filter_code='a', direction='n', cursor=None,
+                     task=None, limit=HISTORY_PAGE_SIZE):
+    """Страница истории пользователя по курсору (date, id), от новых к старым.
+
+    direction='n' — записи старее курсора, 'p' — новее. Все варианты идут по
+    idx_tasks_done_user_history (household_id, user_telegram, date [, rowid]),
+    так что любая страница стоит как первая. Для фильтров 't<индекс>' задачу
+    передаёт вызывающий (task). Возвращает (строки, есть_новее, есть_старее).
+    """
+    query, params, position = history_query(household_id, user_telegram, filter_code, direction,
+                                            cursor, task, limit)
+    rows = execute_query(query, params) or []
+    return history_page(rows, limit, direction, position)
+
+def history_query(household_id, user_telegram, filter_code, direction, cursor, task, limit):
+    """Запрос страницы истории (LIMIT limit + 1) → (текст, параметры, позиция курсора)"""
+    params = {'household': household_id, 'user': user_telegram, 'limit': limit + 1}
+    
+    if filter_code.startswith('t'):
+        params['task'] = task
+        condition = "AND task = :task"
+    else:
+        condition = HISTORY_FILTERS[filter_code][1]
+    
+    position = decode_cursor(cursor)
+    if position:
+        params['date'], params['id'] = position
+        condition += " AND (date, id) < (:date, :id)" if direction == 'n' else " AND (date, id) > (:date, :id)"
+    order = "DESC" if direction == 'n' else "ASC"
+    
+    query = f'''SELECT id, date, task, points, confirmed_by, is_penalty, details, is_confirmed
+                FROM tasks_done
+                WHERE household_id = :household AND user_telegram = :user {condition}
+                      AND {not_purged(':household')}
+                ORDER BY date {order}, id {order}
+                LIMIT :limit'''
+    return query, params, position
+
+def history_page(rows, limit, direction, position):
+    """Строки запроса с LIMIT limit + 1 → (строки от новых к старым, есть_новее, есть_старее)"""
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    
+    if direction == 'n':
+        return rows, position is not None, has_more
+    return rows[::-1], has_more, True
+
+# ==================== АРХИВ ====================
+# Подтверждённые записи старше горизонта уезжают в tasks_done_archive
+# Архив не трогает записи моложе месяца: окна статистики (до 30 дней)
+# читают неполные первые сутки из tasks_done, а не из архива
+ARCHIVE_MIN_DAYS = 31
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", 180))
+if ARCHIVE_AFTER_DAYS < ARCHIVE_MIN_DAYS:
+    raise RuntimeError(f"ARCHIVE_AFTER_DAYS must be at least {ARCHIVE_MIN_DAYS}")
+ARCHIVE_CHUNK = int(os.getenv("ARCHIVE_CHUNK", 5000))
+
+def archive_history(after_days=ARCHIVE_AFTER_DAYS, chunk=ARCHIVE_CHUNK):
+    """Перенести старые подтверждённые записи в архив порциями и ужать файл.
+
+    Балансы хранятся в users, очередь — в rotation_state, агрегаты — в
+    daily_rollup, поэтому от архивации они не меняются. Для пересборки очереди
+    по каждому (пользователь, задача) остаётся строка в archive_summary.
+    Возвращает число перенесённых записей.
+    """
+    cutoff = now_ts() - after_days * DAY
+    batch = f'''SELECT id FROM tasks_done
+                WHERE household_id = :household AND is_confirmed = 1 AND date < :cutoff
+                      AND {not_purged(':household')}
+                ORDER BY date LIMIT :chunk'''
+    moved = 0
+    
+    with directory_db():
+        household_ids = [household_id for (household_id,) in execute_query("SELECT id FROM households") or []]
+    
+    # По квартирам, каждая в своей базе: порция выбирается по idx_tasks_done_confirmed_date
+    for household_id in household_ids:
+        with household_db(household_id):
+            # Заодно дочищается история, удаление которой прервал сброс
+            purged = _purge_history(household_id, chunk)
+            count = _archive_household(batch, {'household': household_id, 'cutoff': cutoff, 'chunk': chunk})
+            if count or purged:
+                # execute() делает только один шаг PRAGMA (одну страницу), executescript — все
+                get_conn().executescript("PRAGMA incremental_vacuum;")
+        moved += count
+    
+    return moved
+
+def _archive_household(batch, params):
+    """Архивация одной квартиры порциями"""
+    moved = 0
+    while True:
+        # Каждая порция — отдельная короткая транзакция, чтобы не держать блокировку
+        with transaction() as c:
+            c.execute("CREATE TEMP TABLE IF NOT EXISTS archive_batch (id INTEGER PRIMARY KEY)")
+            c.execute("DELETE FROM archive_batch")
+            c.execute(f"INSERT INTO archive_batch {batch}", params)
+            count = c.rowcount
+            if not count:
+                break
+            
+            c.execute(
+                '''INSERT INTO tasks_done_archive
+                   (id, household_id, task, user_telegram, user_name, points, confirmed_by,
+                    date, confirmed_at, is_penalty, details)
+                   SELECT id, household_id, task, user_telegram, user_name, points, confirmed_by,
+                          date, confirmed_at, is_penalty, details
+                   FROM tasks_done WHERE id IN (SELECT id FROM archive_batch)'''
+            )
+            c.execute(
+                '''INSERT INTO archive_summary
+                   (household_id, user_telegram, task, is_penalty, count, points_sum, last_done_at)
+                   SELECT household_id, user_telegram, task, is_penalty, COUNT(*), SUM(points), MAX(date)
+                   FROM tasks_done WHERE id IN (SELECT id FROM archive_batch)
+                   GROUP BY household_id, user_telegram, task, is_penalty
+                   ON CONFLICT (household_id, user_telegram, task, is_penalty)
+                   DO UPDATE SET count = count + excluded.count,
+                                 points_sum = points_sum + excluded.points_sum,
+                                 last_done_at = MAX(COALESCE(last_done_at, 0), excluded.last_done_at)'''
+            )
+            c.execute("DELETE FROM tasks_done WHERE id IN (SELECT id FROM archive_batch)")
+        
+        moved += count
+        if count < params['chunk']:
+            break
+    return moved
+
+async def archive_job(context):
+    """Ежедневная архивация (JobQueue)"""
+    moved = await run_db(storage.archive_history)
+    if moved:
+        logging.info(f"🗄 В архив перенесено записей: {moved}")
+
+# ==================== КЭШ СТАТИСТИКИ ====================
+# Максимальное время жизни кэша статистики, секунд
+STATS_CACHE_TTL = int(os.getenv("STATS_CACHE_TTL", 600))
+
+class StatsCache:
+    """Готовый текст статистики по квартирам; сбрасывается при записях и по времени.
+
+    Текст строится в исполнителе БД, и запись может успеть сбросить кэш
+    посреди построения. Поэтому у квартиры есть поколение: invalidate()
+    его увеличивает, а put() кладёт текст, только если поколение не
+    изменилось с generation(), взятого до построения.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._generations = {}
+        self._epoch = 0  # растёт при сбросе всего кэша
+
+    def get(self, household=None):
+        """Текст из кэша или None, если его нет или он устарел"""
+        with self._lock:
+            entry = self._entries.get(household)
+        if entry is None:
+            return None
+        payload, expires_at = entry
+        if now_ts() >= expires_at:
+            self.invalidate(household)
+            return None
+        return payload
+
+    def generation(self, household=None):
+        with self._lock:
+            return self._epoch, self._generations.get(household, 0)
+
+    def put(self, household, payload, expires_at, generation):
+        """Положить текст, если с generation кэш квартиры не сбрасывали"""
+        with self._lock:
+            if (self._epoch, self._generations.get(household, 0)) == generation:
+                self._entries[household] = (payload, expires_at)
+
+    def invalidate(self, household=None):
+        """Сбросить кэш квартиры (или весь кэш)"""
+        with self._lock:
+            if household is None:
+                self._entries.clear()
+                self._epoch += 1
+            else:
+                self._entries.pop(household, None)
+                self._generations[household] = self._generations.get(household, 0) + 1
+
+
+stats_cache = StatsCache()
+
+# ==================== СОСТОЯНИЕ ОЧЕРЕДИ ====================
+# Горячая история плюс итоги по архиву; {scope} — фильтр по квартире или пусто
+ROTATION_FROM_HISTORY = '''SELECT household_id, task, user_telegram, MAX(last_done_at) FROM (
+                               SELECT household_id, task, user_telegram, date AS last_done_at
+                               FROM tasks_done
+                               WHERE is_confirmed = 1 AND is_penalty = 0 {scope}
+                                     AND ''' + not_purged() + '''
+                               UNION ALL
+                               SELECT household_id, task, user_telegram, last_done_at
+                               FROM archive_summary
+                               WHERE is_penalty = 0 {scope}
+                           ) AS history
+                           GROUP BY household_id, task, user_telegram'''
+
+ROTATION_FROM_HISTORY_INSERT = (
+    "INSERT INTO rotation_state (household_id, task, user_telegram, last_done_at) " + ROTATION_FROM_HISTORY
+)
+
+# Баланс — сумма баллов с полом min_balance после каждого подтверждения:
+# b = старт + S - MIN(0, старт + min(S_k) - min_balance), где S_k — баллы
+# нарастающим итогом в порядке подтверждения. Порядок архивных записей не
+# хранится, поэтому архив даёт стартовое значение (его сумму, не ниже пола)
+BALANCES_FROM_HISTORY = '''SELECT telegram, current,
+                                 start + total - CASE WHEN start + low < :min_balance
+                                                      THEN start + low - :min_balance ELSE 0 END AS balance
+                          FROM (
+                              SELECT u.telegram, COALESCE(u.balance, 0) AS current,
+                                     CASE WHEN a.points IS NULL THEN 0
+                                          WHEN a.points < :min_balance THEN :min_balance
+                                          ELSE a.points END AS start,
+                                     COALESCE(l.total, 0) AS total, COALESCE(l.low, 0) AS low
+                              FROM users u
+                              LEFT JOIN (
+                                  SELECT user_telegram, SUM(points_sum) AS points FROM archive_summary
+                                  WHERE household_id = :household
+                                  GROUP BY user_telegram
+                              ) AS a ON a.user_telegram = u.telegram
+                              LEFT JOIN (
+                                  SELECT user_telegram, MIN(running) AS low, MAX(total) AS total FROM (
+                                      SELECT user_telegram,
+                                             SUM(points) OVER (PARTITION BY user_telegram
+                                                               ORDER BY COALESCE(confirmed_at, date), id)
+                                                 AS running,
+                                             SUM(points) OVER (PARTITION BY user_telegram) AS total
+                                      FROM tasks_done
+                                      WHERE household_id = :household AND is_confirmed = 1
+                                            AND ''' + not_purged(':household') + '''
+                                  ) AS steps
+                                  GROUP BY user_telegram
+                              ) AS l ON l.user_telegram = u.telegram
+                              WHERE u.household_id = :household
+                          ) AS balances'''
+
+BALANCES_FROM_HISTORY_UPDATE = '''UPDATE users SET balance = expected.balance
+                                 FROM (''' + BALANCES_FROM_HISTORY + ''') AS expected
+                                 WHERE users.household_id = :household
+                                       AND users.telegram = expected.telegram
+                                       AND expected.current <> expected.balance'''
+
+def record_rotation(c, household_id, task, user_telegram, done_at):
+    """Учесть подтверждённую задачу в rotation_state (внутри транзакции вызывающего)"""
+    c.execute(
+        '''INSERT INTO rotation_state (household_id, task, user_telegram, last_done_at)
+           VALUES (?, ?, ?, ?)
+           ON CONFLICT (household_id, task, user_telegram)
+           DO UPDATE SET last_done_at = CASE WHEN rotation_state.last_done_at > excluded.last_done_at
+                                             THEN rotation_state.last_done_at
+                                             ELSE excluded.last_done_at END''',
+        (household_id, task, user_telegram, done_at)
+    )
+
+def rebuild_rotation_state(household_id=None):
+    """Пересобрать rotation_state квартиры (или всех квартир) из истории.
+
+    Возвращает список расхождений (task, user, было, стало) до пересборки.
+    """
+    with transaction() as c:
+        return replace_rotation_state(c, household_id)
+
+def replace_rotation_state(c, household_id=None):
+    """Пересборка rotation_state (внутри транзакции вызывающего); расхождения до неё"""
+    scope = "AND household_id = :household" if household_id is not None else ""
+    where = "WHERE household_id = :household" if household_id is not None else ""
+    params = {'household': household_id}
+    expected = {
+        (hh, task, user): last
+        for hh, task, user, last in c.execute(ROTATION_FROM_HISTORY.format(scope=scope), params)
+    }
+    current = {
+        (hh, task, user): last for hh, task, user, last in c.execute(
+            f"SELECT household_id, task, user_telegram, last_done_at FROM rotation_state {where}",
+            params
+        )
+    }
+    
+    mismatches = []
+    for key in sorted(set(expected) | set(current)):
+        if current.get(key) != expected.get(key):
+            _, task, user = key
+            mismatches.append((task, user, current.get(key), expected.get(key)))
+    
+    c.execute(f"DELETE FROM rotation_state {where}", params)
+    c.execute(ROTATION_FROM_HISTORY_INSERT.format(scope=scope), params)
+    return mismatches
+
+# ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
+def telegram_of(user):
+    """Ключ нового участника в квартире: @username, а без него — имя.
+
+    Ник и имя может сменить или занять кто угодно, поэтому автор апдейта
+    определяется по user.id (Household.member_of).
+    """
+    return f"@{user.username}" if user.username else user.first_name
+
+def get_rotation(household_id, task):
+    """Кандидаты на задачу по rotation_state: кто дольше всех не делал идёт первым.
+
+    Возвращает (кандидаты, (last_user, last_date) из очереди).
+    """
+    rows = execute_query(
+        '''SELECT u.telegram, u.name, t.last_done_at,
+                  COALESCE((:now - t.last_done_at) / 86400, 999) AS days_ago,
+                  q.last_user, q.last_date
+           FROM users u
+           LEFT JOIN rotation_state t
+                  ON t.household_id = u.household_id AND t.task = :task
+                     AND t.user_telegram = u.telegram
+           LEFT JOIN queue q ON q.household_id = u.household_id AND q.task = :task
+           WHERE u.household_id = :household AND u.is_home = 1
+           ORDER BY days_ago DESC, u.rowid''',
+        {'household': household_id, 'task': task, 'now': now_ts()}
+    )
+    
+    if not rows:
+        return [], ('никто', None)
+    
+    candidates = [
+        {'telegram': telegram, 'name': name, 'last_date': last_date, 'days_ago': days_ago}
+        for telegram, name, last_date, days_ago, _, _ in rows
+    ]
+    queue_row = (rows[0][4] or 'никто', rows[0][5])
+    return candidates, queue_row
+
+def get_rotation_overview(household_id):
+    """Кто должен делать каждую задачу квартиры — один запрос по rotation_state"""
+    rows = execute_query(
+        '''SELECT task, telegram, name, last_date, days_ago, last_user, queue_date
+           FROM (
+               SELECT task, telegram, name, last_date, days_ago, last_user, queue_date,
+                      ROW_NUMBER() OVER (PARTITION BY task ORDER BY days_ago DESC, user_rowid) AS rn
+               FROM (
+                   SELECT q.task, u.telegram, u.name, u.rowid AS user_rowid,
+                          t.last_done_at AS last_date,
+                          COALESCE((:now - t.last_done_at) / 86400, 999) AS days_ago,
+                          q.last_user, q.last_date AS queue_date
+                   FROM queue q
+                   JOIN users u ON u.household_id = q.household_id
+                   LEFT JOIN rotation_state t
+                          ON t.household_id = q.household_id AND t.task = q.task
+                             AND t.user_telegram = u.telegram
+                   WHERE q.household_id = :household AND u.is_home = 1
+               )
+           )
+           WHERE rn = 1''',
+        {'household': household_id, 'now': now_ts()}
+    )
+    
+    overview = {}
+    for task, telegram, name, last_date, days_ago, last_user, queue_date in rows or []:
+        overview[task] = {
+            'telegram': telegram,
+            'name': name,
+            'last_date': last_date,
+            'days_ago': days_ago,
+            'queue': (last_user or 'никто', queue_date),
+        }
+    return overview
+
+def get_next_for_task(household_id, task):
+    """Определить кто должен делать задачу"""
+    candidates, (last_user, _) = get_rotation(household_id, task)
+    
+    if not candidates:
+        return None, None, None
+    
+    return candidates[0]['telegram'], candidates[0]['name'], last_user
+
+def get_confirmers(household_id, *exclude):
+    """Кто из квартиры дома и может подтвердить: [(telegram, имя)], кроме exclude"""
+    placeholders = ', '.join('?' * len(exclude)) or "''"
+    return execute_query(
+        f'''SELECT telegram, name FROM users
+            WHERE household_id = ? AND is_home = 1 AND telegram NOT IN ({placeholders})
+            ORDER BY rowid''',
+        (household_id, *exclude)
+    ) or []
+
+def update_queue(c, household_id, task, user_name, date):
+    """Обновить очередь после выполнения (внутри транзакции вызывающего)"""
+    c.execute(
+        "UPDATE queue SET last_user = ?, last_date = ? WHERE household_id = ? AND task = ?",
+        (user_name, date, household_id, task)
+    )
+
+def update_balance(c, household_id, telegram, points, min_balance):
+    """Изменить баланс с учётом минимального баланса квартиры (внутри транзакции вызывающего)"""
+    c.execute(
+        '''UPDATE users SET balance = CASE WHEN balance + :points > :min_balance
+                                         THEN balance + :points ELSE :min_balance END
+           WHERE household_id = :household AND telegram = :telegram RETURNING balance''',
+        {'points': points, 'min_balance': min_balance, 'household': household_id, 'telegram': telegram}
+    )
+    row = c.fetchone()
+    return row[0] if row else max(points, min_balance)
+
+TASK_EXISTS_SELECT = "SELECT 1 FROM tasks_done WHERE id = ? AND household_id = ?"
+
+def confirm_task(household, task_id, confirmer_name):
+    """Подтвердить задачу: запись, баланс, очередь и rotation_state одним коммитом.
+
+    Возвращает ('ok', данные), ('already', None) или ('missing', None).
+    Условный UPDATE не даёт двум подтверждающим засчитать баллы дважды.
+    """
+    with transaction() as c:
+        return confirm_task_record(c, household, task_id, confirmer_name)
+
+def confirm_task_record(c, household, task_id, confirmer_name):
+    """Подтверждение записи (внутри транзакции вызывающего), см. confirm_task"""
+    now = now_ts()
+    c.execute(
+        '''UPDATE tasks_done
+           SET confirmed_by = ?, is_confirmed = 1, confirmed_at = ?
+           WHERE id = ? AND household_id = ? AND is_confirmed = 0
+           RETURNING task, user_telegram, user_name, points, is_penalty, date''',
+        (confirmer_name, now, task_id, household.id)
+    )
+    row = c.fetchone()
+    
+    if row is None:
+        c.execute(TASK_EXISTS_SELECT, (task_id, household.id))
+        return ('already' if c.fetchone() else 'missing'), None
+    
+    task, doer_tg, doer_name, points, is_penalty, done_at = row
+    new_balance = update_balance(c, household.id, doer_tg, points, household.min_balance)
+    add_to_rollup(c, household.id, done_at, doer_tg, task, is_penalty, points)
+    
+    if not is_penalty:
+        record_rotation(c, household.id, task, doer_tg, done_at)
+        if task in household.tasks:
+            update_queue(c, household.id, task, doer_name, now)
+    
+    return 'ok', {
+        'task': task,
+        'doer_name': doer_name,
+        'points': points,
+        'balance': new_balance,
+    }
+
+def cancel_pending_task(household_id, task_id):
+    """Удалить неподтверждённую запись. Возвращает 'ok', 'confirmed' или 'missing'"""
+    with transaction() as c:
+        return cancel_task_record(c, household_id, task_id)
+
+def cancel_task_record(c, household_id, task_id):
+    """Отмена записи (внутри транзакции вызывающего), см. cancel_pending_task"""
+    # Неподтверждённые записи в rotation_state и daily_rollup не попадают, поэтому
+    # достаточно удалить запись, если её не успели подтвердить
+    c.execute(
+        "DELETE FROM tasks_done WHERE id = ? AND household_id = ? AND is_confirmed = 0",
+        (task_id, household_id)
+    )
+    if c.rowcount:
+        return 'ok'
+    c.execute(TASK_EXISTS_SELECT, (task_id, household_id))
+    return 'confirmed' if c.fetchone() else 'missing'
+
+TASK_RECORD_INSERT = '''INSERT INTO tasks_done
+                        (household_id, task, user_telegram, user_name, points, is_penalty, details, date)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)'''
+
+def add_task_record(household_id, task, user_telegram, user_name, points, date, details=None, is_penalty=False):
+    """Новая неподтверждённая запись; id записи или None при ошибке"""
+    return execute_query(
+        TASK_RECORD_INSERT,
+        (household_id, task, user_telegram, user_name, points, int(is_penalty), details, date)
+    )
+
+BALANCES_SELECT = "SELECT telegram, balance, is_home FROM users WHERE household_id = ?"
+HOME_SELECT = "SELECT is_home FROM users WHERE household_id = ? AND telegram = ?"
+HOME_UPDATE = "UPDATE users SET is_home = ? WHERE household_id = ? AND telegram = ?"
+
+def get_balances(household_id):
+    """Балансы участников: [(telegram, баланс, дома)]"""
+    return execute_query(BALANCES_SELECT, (household_id,)) or []
+
+def get_home(household_id, telegram):
+    """Дома ли участник; None, если его нет"""
+    rows = execute_query(HOME_SELECT, (household_id, telegram))
+    return rows[0][0] if rows else None
+
+def set_home(household_id, telegram, is_home):
+    execute_query(HOME_UPDATE, (is_home, household_id, telegram))
+
+def reset_household(household_id, chunk=ARCHIVE_CHUNK):
+    """Полный сброс квартиры: балансы, очередь и вся история.
+
+    Балансы, очередь, агрегаты и неподтверждённые записи сбрасываются одной
+    транзакцией, в ней же в history_purge записывается последний id истории.
+    Сами записи до него удаляются потом порциями (_purge_history), чтобы
+    большая история не держала блокировку записи; прерванное удаление
+    дочищает archive_history. Возвращает число удалённых записей истории.
+    """
+    with transaction() as c:
+        clear_household(c, household_id)
+
+    purged = _purge_history(household_id, chunk)
+    if purged:
+        get_conn().executescript("PRAGMA incremental_vacuum;")
+    return purged
+
+def clear_household(c, household_id):
+    """Сброс квартиры без удаления истории (внутри транзакции вызывающего), см. reset_household"""
+    hh = {'household': household_id}
+    c.execute("UPDATE users SET balance = 0 WHERE household_id = :household", hh)
+    c.execute("UPDATE queue SET last_user = 'никто', last_date = NULL WHERE household_id = :household", hh)
+    for table in ('rotation_state', 'daily_rollup', 'archive_summary'):
+        c.execute(f"DELETE FROM {table} WHERE household_id = :household", hh)
+    # Старая запись, подтверждённая после сброса, вернула бы баллы
+    c.execute("DELETE FROM tasks_done WHERE household_id = :household AND is_confirmed = 0", hh)
+
+    # id не переиспользуются (AUTOINCREMENT), а в архив записи уходят со своим id.
+    # Агрегатный MAX пропускает NULL пустой таблицы (скалярный MAX(a, b) вернул бы NULL)
+    c.execute(
+        '''INSERT INTO history_purge (household_id, up_to_id)
+           SELECT :household, up_to_id FROM (
+               SELECT MAX(id) AS up_to_id FROM (
+                   SELECT MAX(id) AS id FROM tasks_done WHERE household_id = :household
+                   UNION ALL
+                   SELECT MAX(id) FROM tasks_done_archive WHERE household_id = :household
+               ) AS ids
+           ) AS horizon
+           WHERE up_to_id IS NOT NULL
+           ON CONFLICT (household_id)
+           DO UPDATE SET up_to_id = CASE WHEN history_purge.up_to_id > excluded.up_to_id
+                                         THEN history_purge.up_to_id ELSE excluded.up_to_id END''',
+        hh
+    )
+
+def _purge_history(household_id, chunk=ARCHIVE_CHUNK, begin=transaction):
+    """Удалить порциями историю квартиры до границы из history_purge; сколько записей удалено.
+
+    begin — транзакция хранилища (у PostgresStorage — его курсор).
+    """
+    with begin() as c:
+        c.execute("SELECT up_to_id FROM history_purge WHERE household_id = ?", (household_id,))
+        row = c.fetchone()
+    if row is None:
+        return 0
+    up_to_id = row[0]
+
+    purged = 0
+    for table in ('tasks_done', 'tasks_done_archive'):
+        while True:
+            # Каждая порция — отдельная короткая транзакция, как в архивации
+            with begin() as c:
+                c.execute(
+                    f'''DELETE FROM {table} WHERE id IN (
+                            SELECT id FROM {table} WHERE household_id = ? AND id <= ? LIMIT ?)''',
+                    (household_id, up_to_id, chunk)
+                )
+                count = c.rowcount
+            purged += count
+            if count < chunk:
+                break
+
+    # Если граница успела вырасти от нового сброса, строку дочистит он
+    with begin() as c:
+        c.execute(
+            "DELETE FROM history_purge WHERE household_id = ? AND up_to_id = ?", (household_id, up_to_id)
+        )
+    return purged
+
+def recompute_balances(household):
+    """Пересчитать балансы участников квартиры из истории одним UPDATE.
+
+    Возвращает список расхождений (telegram, было, стало) до пересчёта.
+    """
+    with transaction() as c:
+        return replace_balances(c, household)
+
+def replace_balances(c, household):
+    """Пересчёт балансов (внутри транзакции вызывающего), см. recompute_balances"""
+    params = {'household': household.id, 'min_balance': household.min_balance}
+    mismatches = [row for row in c.execute(BALANCES_FROM_HISTORY, params) if row[1] != row[2]]
+    if mismatches:
+        c.execute(BALANCES_FROM_HISTORY_UPDATE, params)
+    return mismatches
+
+PENDING_COUNT = "SELECT COUNT(*) FROM tasks_done WHERE is_confirmed = 0"
+
+def count_pending():
+    """Сколько задач ждёт подтверждения во всех базах квартир"""
+    pending = 0
+    for pool in each_household_db():
+        with using_db(pool):
+            pending += execute_query(PENDING_COUNT)[0][0]
+    return pending
+
+# ==================== КЛАВИАТУРЫ ====================
+# Telegram принимает callback_data до 64 байт. Задачи, имена и ключи участников
+# входят в неё целиком (did_<задача>, confirm_<id>_<имя>, uh_<ключ>_..._<курсор>),
+# поэтому каждая такая часть — не длиннее CALLBACK_PART_BYTES
+CALLBACK_PART_BYTES = 40
+
+def fits_callback_data(text):
+    return len(text.encode()) <= CALLBACK_PART_BYTES
+
+def clip_for_callback_data(text):
+    """Обрезать до CALLBACK_PART_BYTES байт, не разрывая символ"""
+    return text.encode()[:CALLBACK_PART_BYTES].decode(errors='ignore')
+
+def task_grid(tasks, callback):
+    """Кнопки задач в две колонки; callback(индекс, задача) → callback_data"""
+    tasks = list(tasks)
+    return [
+        [InlineKeyboardButton(tasks[j], callback_data=callback(j, tasks[j]))
+         for j in range(i, min(i + 2, len(tasks)))]
+        for i in range(0, len(tasks), 2)
+    ]
+
+def build_main_keyboard(admin):
+    keyboard = [
+        [InlineKeyboardButton("🎯 Кто что должен?", callback_data='menu_who')],
+        [InlineKeyboardButton("✅ Я сделал задачу", callback_data='menu_did')],
+        [InlineKeyboardButton("🍽️ Готовка/посуда", callback_data='menu_food')],
+        [InlineKeyboardButton("⚠️ Штраф/нарушение", callback_data='menu_penalty')],
+        [InlineKeyboardButton("📊 Статистика", callback_data='stats')],
+        [InlineKeyboardButton("🚪 Отметить отъезд/возвращение", callback_data='menu_home')],
+        [InlineKeyboardButton("📋 Правила системы", callback_data='rules')],
+    ]
+    if admin:
+        keyboard.insert(6, [InlineKeyboardButton("⚙ Админка", callback_data='admin_panel')])
+    return keyboard
+
+def build_static_keyboards(household):
+    """Все неизменяемые меню квартиры: имя → список рядов кнопок"""
+    members = household.members
+    keyboards = {
+        'main_member': build_main_keyboard(False),
+        'main_admin': build_main_keyboard(True),
+        'who': task_grid(household.tasks, lambda i, task: f'who_{task}') + [
+            [InlineKeyboardButton("📋 Все задачи сразу", callback_data='who_overview')],
+            [InlineKeyboardButton("🏠 Назад", callback_data='main_menu')],
+        ],
+        'did': task_grid(household.tasks, lambda i, task: f'did_{task}') + [
+            [InlineKeyboardButton("🏠 Назад", callback_data='main_menu')],
+        ],
+        'food': [
+            [InlineKeyboardButton("🍳 Я приготовил для всех", callback_data='cooked_all')],
+            [InlineKeyboardButton("🍽️ Я помыл посуду", callback_data='washed_dishes')],
+            [InlineKeyboardButton("🏠 Назад", callback_data='main_menu')],
+        ],
+        'penalty': [
+            [InlineKeyboardButton("💧 Не убрал за собой", callback_data='penalty_mess')],
+            [InlineKeyboardButton("❌ Не сделал назначенное", callback_data='penalty_task')],
+            [InlineKeyboardButton("🚮 Оставил мусор", callback_data='penalty_trash')],
+            [InlineKeyboardButton("🏠 Назад", callback_data='main_menu')],
+        ],
+        'stats': [[InlineKeyboardButton("🔄 Обновить", callback_data='stats_refresh')]] + [
+            [InlineKeyboardButton(f"👤 {members[telegram]}", callback_data=f'user_stats_{telegram}')
+             for telegram in list(members)[i:i + 2]]
+            for i in range(0, len(members), 2)
+        ] + [[InlineKeyboardButton("🏠 Назад", callback_data='main_menu')]],
+        'admin': [
+            [InlineKeyboardButton("♻️ Пересчитать балансы", callback_data='admin_recompute')],
+            [InlineKeyboardButton("🗑️ ПОЛНЫЙ СБРОС", callback_data='admin_reset_confirm')],
+            [InlineKeyboardButton("🏠 Главное меню", callback_data='main_menu')],
+        ],
+    }
+    for telegram in members:
+        # Штраф можно выписать всем, кроме себя
+        keyboards[f'penalty_targets:{telegram}'] = [
+            [InlineKeyboardButton(f"⚠️ {name}", callback_data=f'penalty_user_{other}')]
+            for other, name in members.items() if other != telegram
+        ] + [[InlineKeyboardButton("🏠 Назад", callback_data='menu_penalty')]]
+        keyboards[f'history_tasks:{telegram}'] = task_grid(
+            household.tasks, lambda i, task: f'uh_{telegram}_t{i}_n_'
+        ) + [[InlineKeyboardButton("⬅ Назад", callback_data=f'user_stats_{telegram}')]]
+    return keyboards
+
+
+class KeyboardCache:
+    """Готовые InlineKeyboardMarkup для статичных меню.
+
+    Собираются один раз (при первом обращении или после invalidate()) и
+    переиспользуются: InlineKeyboardMarkup неизменяем, делить его между
+    запросами безопасно. У каждой квартиры свой кэш, и он уходит вместе
+    с её настройками при любой правке (см. HouseholdCache.invalidate).
+    """
+
+    def __init__(self, builder):
+        self._builder = builder
+        self._lock = threading.Lock()
+        self._markups = None
+
+    def build(self):
+        markups = {
+            name: InlineKeyboardMarkup(rows)
+            for name, rows in self._builder().items()
+        }
+        with self._lock:
+            self._markups = markups
+        return markups
+
+    def get(self, name):
+        markups = self._markups
+        if markups is None:
+            markups = self.build()
+        return markups[name]
+
+    def invalidate(self):
+        with self._lock:
+            self._markups = None
+
+# ==================== КВАРТИРЫ ====================
+# Квартира определяется по чату: групповой чат привязывается к квартире
+# командой /bind, а в личном чате квартира ищется по участнику
+class Household:
+    """Настройки квартиры: участники, админы, каталог задач, минимальный баланс.
+
+    Меняются только командами админа, поэтому держатся в памяти вместе с
+    готовыми клавиатурами. Статус «дома» и балансы сюда не входят — они
+    меняются постоянно и всегда читаются из БД.
+    """
+
+    def __init__(self, household_id, chat_id, title, min_balance, members, admins, tasks, user_ids):
+        self.id = household_id
+        self.chat_id = chat_id
+        self.title = title
+        self.min_balance = min_balance
+        self.members = members    # telegram → имя, в порядке добавления
+        self.admins = admins      # telegram админов
+        self.tasks = tasks        # задача → {'points', 'rules'}, в порядке каталога
+        self.user_ids = user_ids  # Telegram user id → telegram участника
+        self.keyboards = KeyboardCache(lambda: build_static_keyboards(self))
+
+    def member_of(self, user):
+        """telegram участника — автора апдейта, или None, если он не участник"""
+        return self.user_ids.get(user.id)
+
+    def unclaimed(self, user):
+        """Участник с ключом автора (telegram_of: @ник, а без ника — имя), ещё не
+        привязанный к user id, или None. По имени записаны участники старых баз"""
+        telegram = telegram_of(user)
+        if telegram in self.members and telegram not in self.user_ids.values():
+            return telegram
+        return None
+
+    def is_admin(self, telegram):
+        return telegram in self.admins
+
+    def points(self, task, default):
+        """Баллы за задачу из каталога квартиры"""
+        info = self.tasks.get(task)
+        return info['points'] if info else default
+
+    def admin_names(self):
+        return ', '.join(name for telegram, name in self.members.items() if telegram in self.admins)
+
+    def main_menu(self, telegram):
+        """Главное меню с учётом роли"""
+        return self.keyboards.get('main_admin' if self.is_admin(telegram) else 'main_member')
+
+
+def load_household(household_id):
+    """Настройки квартиры из хранилища; None, если квартиры нет"""
+    settings = storage.get_household(household_id)
+    return Household(household_id, *settings) if settings else None
+
+HOUSEHOLD_SELECT = "SELECT chat_id, title, min_balance FROM households WHERE id = ?"
+TASK_CATALOG_SELECT = "SELECT task, points, rules FROM household_tasks WHERE household_id = ? ORDER BY position, task"
+
+def get_household(household_id):
+    """(chat_id, название, мин. баланс, участники, админы, задачи, user id) или None, если квартиры нет"""
+    with directory_db():
+        rows = execute_query(HOUSEHOLD_SELECT, (household_id,))
+    if not rows:
+        return None
+    
+    with household_db(household_id):
+        return (*rows[0], *_get_household_catalog(household_id))
+
+def _get_household_catalog(household_id):
+    members, admins, user_ids = {}, set(), {}
+    for telegram, name, admin, user_id in execute_query(
+        "SELECT telegram, name, is_admin, user_id FROM users WHERE household_id = ? ORDER BY rowid",
+        (household_id,)
+    ) or []:
+        members[telegram] = name
+        if admin:
+            admins.add(telegram)
+        if user_id is not None:
+            user_ids[user_id] = telegram
+    
+    tasks = {
+        task: {'points': points, 'rules': rules}
+        for task, points, rules in execute_query(TASK_CATALOG_SELECT, (household_id,)) or []
+    }
+    return members, admins, tasks, user_ids
+
+HOUSEHOLD_BY_CHAT_SELECT = "SELECT id FROM households WHERE chat_id = ?"
+
+def find_household_id(chat_id, user_id, telegram):
+    """Квартира чата: привязанная к нему, иначе — первая квартира участника.
+
+    Участник ищется по user id, а среди ещё не привязанных к user id — по нику.
+    """
+    with directory_db():
+        rows = execute_query(HOUSEHOLD_BY_CHAT_SELECT, (chat_id,))
+        if not rows:
+            rows = execute_query(
+                "SELECT household_id FROM household_members WHERE user_id = ? LIMIT 1", (user_id,)
+            )
+        if not rows:
+            rows = execute_query(
+                '''SELECT household_id FROM household_members
+                   WHERE telegram = ? AND user_id IS NULL LIMIT 1''',
+                (telegram,)
+            )
+    return rows[0][0] if rows else None
+
+
+class HouseholdCache:
+    """Чат → квартира и квартира → Household, загружаются лениво.
+
+    В БД ходит только промах (через исполнитель БД); дальше настройки
+    берутся из памяти. Кэш живёт в цикле событий, блокировки не нужны.
+    После правок админом вызывается invalidate(), а с ttl кэш ещё и
+    сбрасывается целиком раз в ttl секунд — правки могли прийти из
+    другого процесса.
+
+    Как и в StatsCache, загруженное кладётся в кэш, только если за время
+    загрузки не было invalidate(): иначе кэш вернул бы настройки до правки.
+    """
+
+    def __init__(self, max_chats=10000, ttl=None):
+        self.max_chats = max_chats
+        self.ttl = ttl
+        self._chats = OrderedDict()
+        self._households = {}
+        self._expires_at = 0
+        self._generations = {}
+        self._epoch = 0        # растёт при сбросе всех квартир
+        self._chats_epoch = 0  # растёт при любом сбросе: привязки чатов сбрасываются всегда
+
+    def _generation(self, household_id):
+        return self._epoch, self._generations.get(household_id, 0)
+
+    def _expire(self):
+        if self.ttl and time.monotonic() >= self._expires_at:
+            self.invalidate()
+            self._expires_at = time.monotonic() + self.ttl
+
+    async def resolve(self, chat_id, user):
+        """Квартира, от имени которой обрабатывается апдейт, или None.
+
+        Участник, которого админ добавил по @нику, привязывается к user id
+        автора первого же его апдейта.
+        """
+        self._expire()
+        if chat_id in self._chats:
+            self._chats.move_to_end(chat_id)
+            household_id = self._chats[chat_id]
+        else:
+            chats_epoch = self._chats_epoch
+            household_id = await run_db(storage.find_household_id, chat_id, user.id, telegram_of(user))
+            if self._chats_epoch == chats_epoch:
+                self._chats[chat_id] = household_id
+                if len(self._chats) > self.max_chats:
+                    self._chats.popitem(last=False)
+        
+        if household_id is None:
+            return None
+        household = await self.get(household_id)
+        if household is not None and household.member_of(user) is None:
+            telegram = household.unclaimed(user)
+            if telegram is not None:
+                # Перечитываем и при неудаче: участника мог только что привязать
+                # параллельный апдейт того же автора (в другом чате или процессе),
+                # и в кэше он ещё числится непривязанным
+                await run_db(storage.claim_member, household_id, telegram, user.id)
+                self.invalidate(household_id)
+                household = await self.get(household_id)
+        return household
+
+    async def get(self, household_id):
+        self._expire()
+        household = self._households.get(household_id)
+        if household is None:
+            generation = self._generation(household_id)
+            household = await run_db(load_household, household_id)
+            if household is not None and self._generation(household_id) == generation:
+                self._households[household_id] = household
+        return household
+
+    def invalidate(self, household_id=None):
+        """Забыть настройки квартиры (или всех) и привязки чатов"""
+        if household_id is None:
+            self._households.clear()
+            self._epoch += 1
+        else:
+            self._households.pop(household_id, None)
+            self._generations[household_id] = self._generations.get(household_id, 0) + 1
+        # Состав участников мог поменяться — привязки по участнику тоже
+        self._chats.clear()
+        self._chats_epoch += 1
+
+
+households = HouseholdCache(ttl=SHARED_CACHE_TTL if DB_BACKEND == 'postgres' or WORKERS else None)
+
+def create_household(title, chat_id, user_id, telegram, name):
+    """Новая квартира с каталогом задач по умолчанию; создатель — её админ.
+
+    Возвращает id квартиры или None, если чат уже привязан к другой.
+    """
+    try:
+        with directory_db(), transaction() as c:
+            c.execute(
+                "INSERT INTO households (chat_id, title, min_balance) VALUES (?, ?, ?) RETURNING id",
+                (chat_id, title, DEFAULT_MIN_BALANCE)
+            )
+            household_id = c.fetchone()[0]
+    except sqlite3.IntegrityError:
+        return None
+    
+    # Данные квартиры — в её базе; с шардами это другой файл, и при сбое
+    # запись каталога убирается, чтобы не осталось квартиры без участников
+    try:
+        with household_db(household_id), transaction() as c:
+            for position, (task, info) in enumerate(DEFAULT_TASKS.items()):
+                set_task(c, household_id, task, info['points'], info['rules'], position)
+        add_member(household_id, telegram, name, is_admin=True, user_id=user_id)
+    except Exception:
+        with directory_db():
+            execute_query("DELETE FROM households WHERE id = ?", (household_id,))
+        raise
+    return household_id
+
+def bind_chat(household_id, chat_id):
+    """Привязать чат к квартире (отвязав от прежней)"""
+    with directory_db(), transaction() as c:
+        rebind_chat(c, household_id, chat_id)
+
+def rebind_chat(c, household_id, chat_id):
+    """Привязка чата (внутри транзакции вызывающего), см. bind_chat"""
+    c.execute("UPDATE households SET chat_id = NULL WHERE chat_id = ?", (chat_id,))
+    c.execute("UPDATE households SET chat_id = ? WHERE id = ?", (chat_id, household_id))
+
+MIN_BALANCE_UPDATE = "UPDATE households SET min_balance = ? WHERE id = ?"
+
+def set_min_balance(household_id, value):
+    with directory_db():
+        execute_query(MIN_BALANCE_UPDATE, (value, household_id))
+
+MEMBER_UPSERT = '''INSERT INTO users (household_id, telegram, name, is_admin, user_id) VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT (household_id, telegram)
+                   DO UPDATE SET name = excluded.name, is_admin = excluded.is_admin,
+                                 user_id = COALESCE(excluded.user_id, users.user_id)'''
+
+MEMBER_CLAIM_UPDATE = '''UPDATE users SET user_id = :user_id
+                         WHERE household_id = :household AND telegram = :telegram AND user_id IS NULL
+                               AND NOT EXISTS (SELECT 1 FROM users
+                                               WHERE household_id = :household AND user_id = :user_id)'''
+
+MEMBER_DELETE = "DELETE FROM users WHERE household_id = ? AND telegram = ?"
+
+def add_member(household_id, telegram, name, is_admin=False, user_id=None):
+    """Добавить участника или изменить его имя и роль; каталог участников — вслед за базой квартиры.
+
+    Без user_id участник привяжется к user id своим первым апдейтом (claim_member).
+    """
+    with household_db(household_id), transaction() as c:
+        c.execute(MEMBER_UPSERT, (household_id, telegram, name, int(is_admin), user_id))
+    with directory_db(), transaction() as c:
+        c.execute(
+            "INSERT OR IGNORE INTO household_members (telegram, household_id, user_id) VALUES (?, ?, ?)",
+            (telegram, household_id, user_id)
+        )
+
+def claim_member(household_id, telegram, user_id):
+    """Привязать участника к user id; False, если он уже привязан
+    или за этим user id в квартире уже есть участник"""
+    with household_db(household_id), transaction() as c:
+        c.execute(MEMBER_CLAIM_UPDATE, {'household': household_id, 'telegram': telegram, 'user_id': user_id})
+        if not c.rowcount:
+            return False
+    with directory_db(), transaction() as c:
+        c.execute(
+            "UPDATE household_members SET user_id = ? WHERE telegram = ? AND household_id = ?",
+            (user_id, telegram, household_id)
+        )
+    return True
+
+def remove_member(household_id, telegram):
+    """Убрать участника (история остаётся); False, если его не было"""
+    with household_db(household_id), transaction() as c:
+        c.execute(MEMBER_DELETE, (household_id, telegram))
+        if not c.rowcount:
+            return False
+    with directory_db(), transaction() as c:
+        c.execute(
+            "DELETE FROM household_members WHERE telegram = ? AND household_id = ?",
+            (telegram, household_id)
+        )
+    return True
+
+def set_task(c, household_id, task, points, rules, position=None):
+    """Добавить задачу в каталог квартиры или изменить её (внутри транзакции вызывающего)"""
+    if position is None:
+        c.execute(
+            "SELECT COALESCE(MAX(position) + 1, 0) FROM household_tasks WHERE household_id = ?",
+            (household_id,)
+        )
+        position = c.fetchone()[0]
+    c.execute(
+        '''INSERT INTO household_tasks (household_id, task, points, rules, position)
+           VALUES (?, ?, ?, ?, ?)
+           ON CONFLICT (household_id, task)
+           DO UPDATE SET points = excluded.points, rules = excluded.rules''',
+        (household_id, task, points, rules, position)
+    )
+    c.execute(
+        "INSERT INTO queue (household_id, task, last_user) VALUES (?, ?, 'никто') ON CONFLICT DO NOTHING",
+        (household_id, task)
+    )
+
+def save_task(household_id, task, points, rules):
+    with transaction() as c:
+        set_task(c, household_id, task, points, rules)
+
+def delete_task(household_id, task):
+    """Убрать задачу из каталога (история остаётся); False, если её не было"""
+    with transaction() as c:
+        return remove_task(c, household_id, task)
+
+def remove_task(c, household_id, task):
+    """Убрать задачу из каталога (внутри транзакции вызывающего), см. delete_task"""
+    c.execute("DELETE FROM household_tasks WHERE household_id = ? AND task = ?", (household_id, task))
+    deleted = c.rowcount
+    c.execute("DELETE FROM queue WHERE household_id = ? AND task = ?", (household_id, task))
+    return bool(deleted)
+
+# ==================== ХРАНИЛИЩЕ ====================
+# Обработчики работают с данными только через storage: квартиры и участники,
+# записи tasks_done, очередь и статистика. Методы синхронные и вызываются
+# через run_db. SQLiteStorage — функции этого файла (с шардами), PostgresStorage —
+# общая база для нескольких процессов бота (DB_BACKEND=postgres). Тексты запросов
+# и функции «внутри транзакции вызывающего» у них общие (параметры в синтаксисе
+# SQLite, для psycopg2 их переводит pg_sql); отдельно — то, в чём расходятся диалекты
+class Storage(ABC):
+    """Интерфейс хранилища.
+
+    shared — данные общие для нескольких процессов: кэши в памяти живут не
+    дольше SHARED_CACHE_TTL. Возвращаемые значения у реализаций одинаковые
+    (см. одноимённые функции SQLite).
+    """
+
+    shared = False
+
+    # Схема и состояние
+    @abstractmethod
+    def init(self):
+        """Создать или обновить схему"""
+
+    @abstractmethod
+    def check(self):
+        """Проверка готовности; исключение, если база не отвечает"""
+
+    @abstractmethod
+    def count_pending(self):
+        """Сколько записей ждёт подтверждения во всех квартирах"""
+
+    # Квартиры и участники
+    @abstractmethod
+    def find_household_id(self, chat_id, user_id, telegram):
+        """Квартира чата, иначе первая квартира участника; None, если её нет"""
+
+    @abstractmethod
+    def get_household(self, household_id):
+        """(chat_id, название, мин. баланс, участники, админы, задачи, user id) или None"""
+
+    @abstractmethod
+    def create_household(self, title, chat_id, user_id, telegram, name):
+        """id новой квартиры или None, если чат уже привязан к другой"""
+
+    @abstractmethod
+    def bind_chat(self, household_id, chat_id):
+        """Привязать чат к квартире (отвязав от прежней)"""
+
+    @abstractmethod
+    def set_min_balance(self, household_id, value):
+        """Изменить минимальный баланс квартиры"""
+
+    @abstractmethod
+    def add_member(self, household_id, telegram, name, is_admin=False, user_id=None):
+        """Добавить участника или изменить его имя и роль"""
+
+    @abstractmethod
+    def claim_member(self, household_id, telegram, user_id):
+        """Привязать участника к user id; False, если не вышло"""
+
+    @abstractmethod
+    def remove_member(self, household_id, telegram):
+        """Убрать участника; False, если его не было"""
+
+    @abstractmethod
+    def save_task(self, household_id, task, points, rules):
+        """Добавить задачу в каталог или изменить её"""
+
+    @abstractmethod
+    def delete_task(self, household_id, task):
+        """Убрать задачу из каталога; False, если её не было"""
+
+    @abstractmethod
+    def get_balances(self, household_id):
+        """[(telegram, баланс, дома)]"""
+
+    @abstractmethod
+    def get_home(self, household_id, telegram):
+        """Дома ли участник; None, если его нет"""
+
+    @abstractmethod
+    def set_home(self, household_id, telegram, is_home):
+        """Отметить отъезд или возвращение"""
+
+    @abstractmethod
+    def get_confirmers(self, household_id, *exclude):
+        """[(telegram, имя)] тех, кто дома, кроме exclude"""
+
+    # Записи tasks_done
+    @abstractmethod
+    def add_task_record(self, household_id, task, user_telegram, user_name, points, date,
+                        details=None, is_penalty=False):
+        """id новой неподтверждённой записи"""
+
+    @abstractmethod
+    def confirm_task(self, household, task_id, confirmer_name):
+        """('ok', данные), ('already', None) или ('missing', None)"""
+
+    @abstractmethod
+    def cancel_pending_task(self, household_id, task_id):
+        """'ok', 'confirmed' или 'missing'"""
+
+    @abstractmethod
+    def get_history_page(self, household_id, user_telegram, filter_code='a', direction='n',
+                         cursor=None, task=None, limit=HISTORY_PAGE_SIZE):
+        """(строки от новых к старым, есть_новее, есть_старее)"""
+
+    # Очередь
+    @abstractmethod
+    def get_rotation(self, household_id, task):
+        """(кандидаты на задачу, (last_user, last_date) из очереди)"""
+
+    @abstractmethod
+    def get_rotation_overview(self, household_id):
+        """{задача: кто должен её делать}"""
+
+    @abstractmethod
+    def rebuild_rotation_state(self, household_id=None):
+        """Пересобрать rotation_state; расхождения до пересборки"""
+
+    # Статистика
+    @abstractmethod
+    def get_window_points(self, household_id, since, user_telegram=None):
+        """{telegram: баллы с момента since}"""
+
+    @abstractmethod
+    def get_window_top_tasks(self, household_id, since, limit=3):
+        """[(задача, раз)] с момента since"""
+
+    @abstractmethod
+    def get_window_expiry(self, household_id, since):
+        """Когда окно «с момента since» изменится"""
+
+    @abstractmethod
+    def get_user_totals(self, household_id, user_telegram):
+        """Баллы за неделю, 30 дней и всё время"""
+
+    # Обслуживание
+    @abstractmethod
+    def reset_household(self, household_id, chunk=ARCHIVE_CHUNK):
+        """Полный сброс квартиры; сколько записей истории удалено"""
+
+    @abstractmethod
+    def recompute_balances(self, household):
+        """Пересчитать балансы из истории; расхождения до пересчёта"""
+
+    @abstractmethod
+    def archive_history(self, after_days=ARCHIVE_AFTER_DAYS, chunk=ARCHIVE_CHUNK):
+        """Перенести старые записи в архив; сколько перенесено"""
+
+
+class SQLiteStorage(Storage):
+    """SQLite: функции этого файла. База квартиры — из области run_db (см. ШАРДЫ)"""
+
+    # Файлы базы общие у рабочих процессов (см. ПРОЦЕССЫ)
+    shared = bool(WORKERS)
+
+    init = staticmethod(init_db)
+    check = staticmethod(check_db)
+    count_pending = staticmethod(count_pending)
+    find_household_id = staticmethod(find_household_id)
+    get_household = staticmethod(get_household)
+    create_household = staticmethod(create_household)
+    bind_chat = staticmethod(bind_chat)
+    set_min_balance = staticmethod(set_min_balance)
+    add_member = staticmethod(add_member)
+    claim_member = staticmethod(claim_member)
+    remove_member = staticmethod(remove_member)
+    save_task = staticmethod(save_task)
+    delete_task = staticmethod(delete_task)
+    get_balances = staticmethod(get_balances)
+    get_home = staticmethod(get_home)
+    set_home = staticmethod(set_home)
+    get_confirmers = staticmethod(get_confirmers)
+    add_task_record = staticmethod(add_task_record)
+    confirm_task = staticmethod(confirm_task)
+    cancel_pending_task = staticmethod(cancel_pending_task)
+    get_history_page = staticmethod(get_history_page)
+    get_rotation = staticmethod(get_rotation)
+    get_rotation_overview = staticmethod(get_rotation_overview)
+    rebuild_rotation_state = staticmethod(rebuild_rotation_state)
+    get_window_points = staticmethod(get_window_points)
+    get_window_top_tasks = staticmethod(get_window_top_tasks)
+    get_window_expiry = staticmethod(get_window_expiry)
+    get_user_totals = staticmethod(get_user_totals)
+    reset_household = staticmethod(reset_household)
+    recompute_balances = staticmethod(recompute_balances)
+    archive_history = staticmethod(archive_history)
+
+# ==================== ХРАНИЛИЩЕ POSTGRESQL ====================
+# Все квартиры в одной базе DATABASE_URL; к ней можно подключать несколько
+# процессов бота. Каждый процесс держит до PG_POOL_SIZE соединений
+PG_POOL_SIZE = int(os.getenv("PG_POOL_SIZE", DB_WORKERS + 2))
+# Ключ pg_advisory_xact_lock: процессы, стартующие вместе, мигрируют по очереди
+PG_MIGRATION_LOCK = 0x66616972
+
+# :имя и ? — параметры SQLite; «::» — приведение типа PostgreSQL, не параметр
+_SQLITE_PARAM = re.compile(r"(?<!:):(\w+)|\?")
+
+@lru_cache(maxsize=None)
+def pg_sql(query):
+    """Запрос в синтаксисе SQLite → psycopg2: :имя → %(имя)s, ? → %s, % → %%"""
+    return _SQLITE_PARAM.sub(
+        lambda m: f"%({m.group(1)})s" if m.group(1) else "%s",
+        query.replace('%', '%%')
+    )
+
+
+class PgCursor:
+    """Курсор psycopg2, принимающий запросы SQLite (см. pg_sql).
+
+    Как и у sqlite3, execute() возвращает сам курсор, а по нему можно
+    итерироваться, поэтому общие функции работают с обоими.
+    """
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, query, params=()):
+        self._cursor.execute(pg_sql(query), params)
+        return self
+
+    def executemany(self, query, params):
+        self._cursor.executemany(pg_sql(query), params)
+        return self
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def pg_migration_initial_schema(c):
+    """Схема SQLite-миграций 1–8; каталог участников не нужен — users общая"""
+    c.execute('''CREATE TABLE households
+                 (id BIGSERIAL PRIMARY KEY,
+                  chat_id BIGINT UNIQUE,
+                  title TEXT NOT NULL,
+                  min_balance INTEGER NOT NULL)''')
+    # seq — порядок добавления участников (rowid в SQLite)
+    c.execute('''CREATE TABLE users
+                 (household_id BIGINT NOT NULL,
+                  telegram TEXT NOT NULL,
+                  name TEXT,
+                  is_admin INTEGER NOT NULL DEFAULT 0,
+                  is_home INTEGER NOT NULL DEFAULT 1,
+                  balance INTEGER NOT NULL DEFAULT 0,
+                  seq BIGSERIAL,
+                  PRIMARY KEY (household_id, telegram))''')
+    c.execute("CREATE INDEX idx_users_telegram ON users (telegram, household_id)")
+    c.execute('''CREATE TABLE household_tasks
+                 (household_id BIGINT NOT NULL,
+                  task TEXT NOT NULL,
+                  points INTEGER NOT NULL,
+                  rules TEXT NOT NULL DEFAULT '',
+                  position INTEGER NOT NULL DEFAULT 0,
+                  PRIMARY KEY (household_id, task))''')
+    c.execute('''CREATE TABLE queue
+                 (household_id BIGINT NOT NULL,
+                  task TEXT NOT NULL,
+                  last_user TEXT,
+                  last_date BIGINT,
+                  PRIMARY KEY (household_id, task))''')
+    c.execute('''CREATE TABLE tasks_done
+                 (id BIGSERIAL PRIMARY KEY,
+                  household_id BIGINT NOT NULL,
+                  task TEXT,
+                  user_telegram TEXT,
+                  user_name TEXT,
+                  points INTEGER,
+                  confirmed_by TEXT,
+                  date BIGINT,
+                  confirmed_at BIGINT,
+                  is_confirmed INTEGER NOT NULL DEFAULT 0,
+                  is_penalty INTEGER NOT NULL DEFAULT 0,
+                  details TEXT)''')
+    c.execute('''CREATE INDEX idx_tasks_done_user_history
+                 ON tasks_done (household_id, user_telegram, date, id)''')
+    c.execute('''CREATE INDEX idx_tasks_done_confirmed_date
+                 ON tasks_done (household_id, is_confirmed, date)
+                 INCLUDE (user_telegram, task, is_penalty, points)''')
+    # Архивация идёт сразу по всем квартирам
+    c.execute("CREATE INDEX idx_tasks_done_archive_due ON tasks_done (date) WHERE is_confirmed = 1")
+    c.execute('''CREATE TABLE tasks_done_archive
+                 (id BIGINT PRIMARY KEY,
+                  household_id BIGINT NOT NULL,
+                  task TEXT,
+                  user_telegram TEXT,
+                  user_name TEXT,
+                  points INTEGER,
+                  confirmed_by TEXT,
+                  date BIGINT,
+                  confirmed_at BIGINT,
+                  is_penalty INTEGER NOT NULL DEFAULT 0,
+                  details TEXT)''')
+    c.execute('''CREATE TABLE archive_summary
+                 (household_id BIGINT NOT NULL,
+                  user_telegram TEXT NOT NULL,
+                  task TEXT NOT NULL,
+                  is_penalty INTEGER NOT NULL,
+                  count INTEGER NOT NULL DEFAULT 0,
+                  points_sum INTEGER NOT NULL DEFAULT 0,
+                  last_done_at BIGINT,
+                  PRIMARY KEY (household_id, user_telegram, task, is_penalty))''')
+    c.execute('''CREATE TABLE rotation_state
+                 (household_id BIGINT NOT NULL,
+                  task TEXT NOT NULL,
+                  user_telegram TEXT NOT NULL,
+                  last_done_at BIGINT,
+                  PRIMARY KEY (household_id, task, user_telegram))''')
+    c.execute('''CREATE TABLE daily_rollup
+                 (household_id BIGINT NOT NULL,
+                  day INTEGER NOT NULL,
+                  user_telegram TEXT NOT NULL,
+                  task TEXT NOT NULL,
+                  is_penalty INTEGER NOT NULL,
+                  points_sum INTEGER NOT NULL DEFAULT 0,
+                  count INTEGER NOT NULL DEFAULT 0,
+                  PRIMARY KEY (household_id, day, user_telegram, task, is_penalty))''')
+    c.execute('''CREATE INDEX idx_daily_rollup_user
+                 ON daily_rollup (household_id, user_telegram, day) INCLUDE (points_sum)''')
+
+    # Квартира 1 — как в SQLite-миграции «Квартиры»
+    c.execute(
+        "INSERT INTO households (id, title, min_balance) VALUES (1, 'Квартира', ?)",
+        (DEFAULT_MIN_BALANCE,)
+    )
+    c.execute("SELECT setval(pg_get_serial_sequence('households', 'id'), 1)")
+    c.executemany(
+        "INSERT INTO users (household_id, telegram, name, is_admin) VALUES (1, ?, ?, ?)",
+        [(telegram, name, int(telegram in DEFAULT_ADMINS)) for telegram, name in DEFAULT_USERS.items()]
+    )
+    c.executemany(
+        "INSERT INTO household_tasks (household_id, task, points, rules, position) VALUES (1, ?, ?, ?, ?)",
+        [(task, info['points'], info['rules'], i) for i, (task, info) in enumerate(DEFAULT_TASKS.items())]
+    )
+    c.execute(
+        "INSERT INTO queue (household_id, task, last_user) SELECT 1, task, 'никто' FROM household_tasks"
+    )
+
+def pg_migration_history_purge(c):
+    """Как SQLite-миграция «Очистка истории»"""
+    c.execute('''CREATE TABLE history_purge
+                 (household_id BIGINT PRIMARY KEY,
+                  up_to_id BIGINT NOT NULL)''')
+
+def pg_migration_member_user_ids(c):
+    """Как SQLite-миграция «User id участников»"""
+    c.execute("ALTER TABLE users ADD COLUMN user_id BIGINT")
+    c.execute('''CREATE UNIQUE INDEX idx_users_household_user_id ON users (household_id, user_id)
+                 WHERE user_id IS NOT NULL''')
+    c.execute("CREATE INDEX idx_users_user_id ON users (user_id) WHERE user_id IS NOT NULL")
+
+PG_MIGRATIONS = [
+    (1, 'Начальная схема', pg_migration_initial_schema),
+    (2, 'Очистка истории', pg_migration_history_purge),
+    (3, 'User id участников', pg_migration_member_user_ids),
+]
+
+
+class PostgresStorage(Storage):
+    """PostgreSQL через пул соединений psycopg2.
+
+    Каждый метод — одна транзакция на соединении из пула; id новых записей
+    и изменённые строки возвращаются через RETURNING.
+    """
+
+    shared = True
+
+    def __init__(self, dsn, pool_size=PG_POOL_SIZE):
+        if psycopg2 is None:
+            raise RuntimeError("DB_BACKEND=postgres needs psycopg2 (pip install psycopg2-binary)")
+        if not dsn:
+            raise RuntimeError("DATABASE_URL is not set")
+        self.dsn = dsn
+        self.pool_size = pool_size
+        self._pool = None
+        self._lock = threading.Lock()
+        # Пул psycopg2 при нехватке соединений не ждёт, а падает — ждём здесь
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    def _get_pool(self):
+        """Пул создаётся при первом запросе, чтобы импорт не требовал живой базы"""
+        with self._lock:
+            if self._pool is None:
+                self._pool = psycopg2.pool.ThreadedConnectionPool(self.pool_size, self.pool_size, self.dsn)
+            return self._pool
+
+    @contextmanager
+    def _cursor(self):
+        """Курсор (PgCursor) в транзакции: commit при успехе, rollback при ошибке"""
+        pool = self._get_pool()
+        with self._slots:
+            conn = pool.getconn()
+            started = time.perf_counter()
+            try:
+                with conn, conn.cursor() as c:
+                    yield PgCursor(c)
+            except Exception:
+                metrics.db_errors.inc('POSTGRES')
+                raise
+            finally:
+                # Разорванное соединение не возвращается в пул
+                pool.putconn(conn, close=bool(conn.closed))
+                metrics.db_seconds.observe(time.perf_counter() - started, 'POSTGRES')
+
+    def _fetchall(self, query, params=()):
+        with self._cursor() as c:
+            return c.execute(query, params).fetchall()
+
+    def _fetchone(self, query, params=()):
+        with self._cursor() as c:
+            return c.execute(query, params).fetchone()
+
+    # Схема и состояние
+    def init(self):
+        with self._cursor() as c:
+            c.execute("SELECT pg_advisory_xact_lock(?)", (PG_MIGRATION_LOCK,))
+            c.execute('''CREATE TABLE IF NOT EXISTS schema_version
+                         (version INTEGER PRIMARY KEY,
+                          description TEXT,
+                          applied_at BIGINT)''')
+            current = c.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+            for version, description, step in PG_MIGRATIONS:
+                if version <= current:
+                    continue
+                step(c)
+                c.execute(
+                    "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                    (version, description, now_ts())
+                )
+                print(f"✅ Миграция PostgreSQL {version}: {description}")
+        print("✅ База данных инициализирована (данные сохранены)")
+
+    def check(self):
+        self._fetchone("SELECT COUNT(*) FROM schema_version")
+
+    def count_pending(self):
+        return self._fetchone(PENDING_COUNT)[0]
+
+    # Квартиры и участники
+    def find_household_id(self, chat_id, user_id, telegram):
+        # Каталог участников не нужен: users общая для всех квартир
+        with self._cursor() as c:
+            row = c.execute(HOUSEHOLD_BY_CHAT_SELECT, (chat_id,)).fetchone()
+            if row is None:
+                row = c.execute(
+                    "SELECT household_id FROM users WHERE user_id = ? ORDER BY household_id LIMIT 1",
+                    (user_id,)
+                ).fetchone()
+            if row is None:
+                row = c.execute(
+                    '''SELECT household_id FROM users WHERE telegram = ? AND user_id IS NULL
+                       ORDER BY household_id LIMIT 1''',
+                    (telegram,)
+                ).fetchone()
+        return row[0] if row else None
+
+    def get_household(self, household_id):
+        with self._cursor() as c:
+            settings = c.execute(HOUSEHOLD_SELECT, (household_id,)).fetchone()
+            if settings is None:
+                return None
+
+            members, admins, user_ids = {}, set(), {}
+            for telegram, name, admin, user_id in c.execute(
+                "SELECT telegram, name, is_admin, user_id FROM users WHERE household_id = ? ORDER BY seq",
+                (household_id,)
+            ):
+                members[telegram] = name
+                if admin:
+                    admins.add(telegram)
+                if user_id is not None:
+                    user_ids[user_id] = telegram
+
+            tasks = {
+                task: {'points': points, 'rules': rules}
+                for task, points, rules in c.execute(TASK_CATALOG_SELECT, (household_id,))
+            }
+        return (*settings, members, admins, tasks, user_ids)
+
+    def create_household(self, title, chat_id, user_id, telegram, name):
+        with self._cursor() as c:
+            row = c.execute(
+                '''INSERT INTO households (chat_id, title, min_balance) VALUES (?, ?, ?)
+                   ON CONFLICT (chat_id) DO NOTHING RETURNING id''',
+                (chat_id, title, DEFAULT_MIN_BALANCE)
+            ).fetchone()
+            if row is None:
+                return None
+            household_id = row[0]
+            c.execute(MEMBER_UPSERT, (household_id, telegram, name, 1, user_id))
+            for position, (task, info) in enumerate(DEFAULT_TASKS.items()):
+                set_task(c, household_id, task, info['points'], info['rules'], position)
+        return household_id
+
+    def bind_chat(self, household_id, chat_id):
+        with self._cursor() as c:
+            rebind_chat(c, household_id, chat_id)
+
+    def set_min_balance(self, household_id, value):
+        with self._cursor() as c:
+            c.execute(MIN_BALANCE_UPDATE, (value, household_id))
+
+    def add_member(self, household_id, telegram, name, is_admin=False, user_id=None):
+        with self._cursor() as c:
+            c.execute(MEMBER_UPSERT, (household_id, telegram, name, int(is_admin), user_id))
+
+    def claim_member(self, household_id, telegram, user_id):
+        with self._cursor() as c:
+            c.execute(MEMBER_CLAIM_UPDATE, {'household': household_id, 'telegram': telegram, 'user_id': user_id})
+            return c.rowcount > 0
+
+    def remove_member(self, household_id, telegram):
+        with self._cursor() as c:
+            c.execute(MEMBER_DELETE, (household_id, telegram))
+            return c.rowcount > 0
+
+    def save_task(self, household_id, task, points, rules):
+        with self._cursor() as c:
+            set_task(c, household_id, task, points, rules)
+
+    def delete_task(self, household_id, task):
+        with self._cursor() as c:
+            return remove_task(c, household_id, task)
+
+    def get_balances(self, household_id):
+        return self._fetchall(BALANCES_SELECT, (household_id,))
+
+    def get_home(self, household_id, telegram):
+        row = self._fetchone(HOME_SELECT, (household_id, telegram))
+        return row[0] if row else None
+
+    def set_home(self, household_id, telegram, is_home):
+        with self._cursor() as c:
+            c.execute(HOME_UPDATE, (is_home, household_id, telegram))
+
+    def get_confirmers(self, household_id, *exclude):
+        return self._fetchall(
+            '''SELECT telegram, name FROM users
+               WHERE household_id = ? AND is_home = 1 AND telegram <> ALL(?::text[])
+               ORDER BY seq''',
+            (household_id, list(exclude))
+        )
+
+    # Записи tasks_done
+    def add_task_record(self, household_id, task, user_telegram, user_name, points, date,
+                        details=None, is_penalty=False):
+        return self._fetchone(
+            TASK_RECORD_INSERT + " RETURNING id",
+            (household_id, task, user_telegram, user_name, points, int(is_penalty), details, date)
+        )[0]
+
+    def confirm_task(self, household, task_id, confirmer_name):
+        # Второй подтверждающий ждёт блокировку строки и получает 0 строк
+        with self._cursor() as c:
+            return confirm_task_record(c, household, task_id, confirmer_name)
+
+    def cancel_pending_task(self, household_id, task_id):
+        with self._cursor() as c:
+            return cancel_task_record(c, household_id, task_id)
+
+    def get_history_page(self, household_id, user_telegram, filter_code='a', direction='n',
+                         cursor=None, task=None, limit=HISTORY_PAGE_SIZE):
+        query, params, position = history_query(household_id, user_telegram, filter_code, direction,
+                                                cursor, task, limit)
+        return history_page(self._fetchall(query, params), limit, direction, position)
+
+    # Очередь
+    def get_rotation(self, household_id, task):
+        rows = self._fetchall(
+            '''SELECT u.telegram, u.name, t.last_done_at,
+                      COALESCE((:now - t.last_done_at) / 86400, 999) AS days_ago,
+                      q.last_user, q.last_date
+               FROM users u
+               LEFT JOIN rotation_state t
+                      ON t.household_id = u.household_id AND t.task = :task
+                         AND t.user_telegram = u.telegram
+               LEFT JOIN queue q ON q.household_id = u.household_id AND q.task = :task
+               WHERE u.household_id = :household AND u.is_home = 1
+               ORDER BY days_ago DESC, u.seq''',
+            {'household': household_id, 'task': task, 'now': now_ts()}
+        )
+
+        if not rows:
+            return [], ('никто', None)
+
+        candidates = [
+            {'telegram': telegram, 'name': name, 'last_date': last_date, 'days_ago': days_ago}
+            for telegram, name, last_date, days_ago, _, _ in rows
+        ]
+        return candidates, (rows[0][4] or 'никто', rows[0][5])
+
+    def get_rotation_overview(self, household_id):
+        rows = self._fetchall(
+            '''SELECT DISTINCT ON (q.task)
+                      q.task, u.telegram, u.name, t.last_done_at,
+                      COALESCE((:now - t.last_done_at) / 86400, 999) AS days_ago,
+                      q.last_user, q.last_date
+               FROM queue q
+               JOIN users u ON u.household_id = q.household_id
+               LEFT JOIN rotation_state t
+                      ON t.household_id = q.household_id AND t.task = q.task
+                         AND t.user_telegram = u.telegram
+               WHERE q.household_id = :household AND u.is_home = 1
+               ORDER BY q.task, days_ago DESC, u.seq''',
+            {'household': household_id, 'now': now_ts()}
+        )
+
+        return {
+            task: {
+                'telegram': telegram,
+                'name': name,
+                'last_date': last_date,
+                'days_ago': days_ago,
+                'queue': (last_user or 'никто', queue_date),
+            }
+            for task, telegram, name, last_date, days_ago, last_user, queue_date in rows
+        }
+
+    def rebuild_rotation_state(self, household_id=None):
+        with self._cursor() as c:
+            return replace_rotation_state(c, household_id)
+
+    # Статистика
+    def get_window_points(self, household_id, since, user_telegram=None):
+        since, edge_day, next_day = window_bounds(since)
+        user_filter = "AND user_telegram = :user" if user_telegram else ""
+        rows = self._fetchall(
+            WINDOW_POINTS_SELECT.format(user_filter=user_filter),
+            {'household': household_id, 'edge_day': edge_day, 'since': since,
+             'next_day': next_day, 'user': user_telegram}
+        )
+        return {telegram: total or 0 for telegram, total in rows}
+
+    def get_window_top_tasks(self, household_id, since, limit=3):
+        since, edge_day, next_day = window_bounds(since)
+        return self._fetchall(
+            WINDOW_TOP_TASKS_SELECT,
+            {'household': household_id, 'edge_day': edge_day, 'since': since,
+             'next_day': next_day, 'limit': limit}
+        )
+
+    def get_window_expiry(self, household_id, since):
+        since, _, next_day = window_bounds(since)
+        oldest = self._fetchone(
+            WINDOW_EXPIRY_SELECT, {'household': household_id, 'since': since, 'next_day': next_day}
+        )[0]
+        return window_expiry(since, next_day, oldest)
+
+    def get_user_totals(self, household_id, user_telegram):
+        now = now_ts()
+        week = self.get_window_points(household_id, now - 7 * DAY, user_telegram).get(user_telegram, 0)
+        month = self.get_window_points(household_id, now - 30 * DAY, user_telegram).get(user_telegram, 0)
+        total = self._fetchone(ROLLUP_TOTAL_SELECT, (household_id, user_telegram))[0] or 0
+        return week, month, total
+
+    # Обслуживание
+    def reset_household(self, household_id, chunk=ARCHIVE_CHUNK):
+        with self._cursor() as c:
+            clear_household(c, household_id)
+        return _purge_history(household_id, chunk, self._cursor)
+
+    def recompute_balances(self, household):
+        with self._cursor() as c:
+            return replace_balances(c, household)
+
+    def archive_history(self, after_days=ARCHIVE_AFTER_DAYS, chunk=ARCHIVE_CHUNK):
+        cutoff = now_ts() - after_days * DAY
+        # Заодно дочищается история, удаление которой прервал сброс
+        for (household_id,) in self._fetchall("SELECT household_id FROM history_purge"):
+            _purge_history(household_id, chunk, self._cursor)
+
+        moved = 0
+        while True:
+            # Порция целиком — один запрос: удалённые строки (RETURNING) идут
+            # в архив и в итоги для пересборки очереди
+            count = self._fetchone(
+                f'''WITH batch AS (
+                       DELETE FROM tasks_done
+                       WHERE id IN (SELECT id FROM tasks_done
+                                    WHERE is_confirmed = 1 AND date < :cutoff
+                                          AND {not_purged()}
+                                    ORDER BY date LIMIT :chunk)
+                       RETURNING *
+                   ), archived AS (
+                       INSERT INTO tasks_done_archive
+                       (id, household_id, task, user_telegram, user_name, points, confirmed_by,
+                        date, confirmed_at, is_penalty, details)
+                       SELECT id, household_id, task, user_telegram, user_name, points, confirmed_by,
+                              date, confirmed_at, is_penalty, details
+                       FROM batch
+                   ), summary AS (
+                       INSERT INTO archive_summary
+                       (household_id, user_telegram, task, is_penalty, count, points_sum, last_done_at)
+                       SELECT household_id, user_telegram, task, is_penalty, COUNT(*), SUM(points), MAX(date)
+                       FROM batch
+                       GROUP BY household_id, user_telegram, task, is_penalty
+                       ON CONFLICT (household_id, user_telegram, task, is_penalty)
+                       DO UPDATE SET count = archive_summary.count + EXCLUDED.count,
+                                     points_sum = archive_summary.points_sum + EXCLUDED.points_sum,
+                                     last_done_at = GREATEST(archive_summary.last_done_at,
+                                                             EXCLUDED.last_done_at)
+                   )
+                   SELECT COUNT(*) FROM batch''',
+                {'cutoff': cutoff, 'chunk': chunk}
+            )[0]
+            moved += count
+            if count < chunk:
+                return moved
+
+
+storage = PostgresStorage(DATABASE_URL) if DB_BACKEND == 'postgres' else SQLiteStorage()
+
+# ==================== ИСХОДЯЩИЕ ЗАПРОСЫ ====================
+# Лимиты Bot API: ~30 сообщений в секунду на бота и ~1 в секунду на чат
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", 30))
+if WORKER_INDEX is not None:
+    # Лимит на бота делят рабочие процессы (см. ПРОЦЕССЫ)
+    TG_GLOBAL_RATE /= WORKERS
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", 1))
+TG_CHAT_BURST = int(os.getenv("TG_CHAT_BURST", 3))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", 3))
+
+class TokenBucket:
+    """Ведро токенов: reserve() занимает токен и говорит, сколько подождать"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def idle(self):
+        """Ведро заполнено — состояние чата можно забыть"""
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.burst
+
+
+class _Outgoing:
+    """Запрос в очереди чата; futures — все, кто ждёт его результата"""
+
+    __slots__ = ('key', 'method', 'call', 'futures')
+
+    def __init__(self, key, method, call, future):
+        self.key = key
+        self.method = method
+        self.call = call
+        self.futures = [future]
+
+
+class _ChatLane:
+    __slots__ = ('bucket', 'queue', 'task')
+
+    def __init__(self):
+        self.bucket = TokenBucket(TG_CHAT_RATE, TG_CHAT_BURST)
+        self.queue = deque()
+        self.task = None
+
+
+class OutboundScheduler:
+    """Очередь исходящих запросов к Bot API.
+
+    Запросы одного чата уходят по порядку и не чаще TG_CHAT_RATE, все
+    вместе — не чаще TG_GLOBAL_RATE; разные чаты не ждут друг друга.
+    На 429 (RetryAfter) чат выжидает retry_after и повторяет запрос.
+    Несколько правок одного сообщения подряд склеиваются: уходит только
+    последняя, а её результат получают все ожидающие.
+    """
+
+    def __init__(self, global_rate=TG_GLOBAL_RATE, max_retries=TG_MAX_RETRIES):
+        self._global = TokenBucket(global_rate, global_rate)
+        self._lanes = {}
+        self.max_retries = max_retries
+        self.sent = 0
+        self.coalesced = 0
+        self.retried = 0
+
+    async def send(self, chat_id, call):
+        """Выполнить call() (корутину Bot API) в очереди чата"""
+        return await self._submit(chat_id, None, 'sendMessage', call)
 
+    async def edit(self, chat_id, message_id, call):
+        """Правка сообщения; вытесняет ещё не отправленную правку того же сообщения"""
+        return await self._submit(chat_id, message_id, 'editMessage', call)
 
-def get_conn():
-    """Получить соединение с БД"""
-    conn = sqlite3.connect(DATABASE, check_same_thread=False)
-    return conn
+    def backlog(self):
+        """Сколько запросов ждёт отправки во всех чатах"""
+        return sum(len(lane.queue) for lane in list(self._lanes.values()))
 
-def execute_query(query, params=()):
-    """Выполнить запрос"""
-    conn = get_conn()
-    c = conn.cursor()
+    def _submit(self, chat_id, key, method, call):
+        lane = self._lanes.get(chat_id)
+        if lane is None:
+            if len(self._lanes) > 1000:
+                self._prune()
+            lane = self._lanes[chat_id] = _ChatLane()
+        
+        future = asyncio.get_running_loop().create_future()
+        last = lane.queue[-1] if lane.queue else None
+        if key is not None and last is not None and last.key == key:
+            last.call = call
+            last.futures.append(future)
+            self.coalesced += 1
+        else:
+            lane.queue.append(_Outgoing(key, method, call, future))
+        
+        if lane.task is None:
+            lane.task = asyncio.create_task(self._drain(chat_id, lane))
+        return future
+
+    async def _drain(self, chat_id, lane):
+        try:
+            while lane.queue:
+                delay = max(lane.bucket.reserve(), self._global.reserve())
+                if delay:
+                    await asyncio.sleep(delay)
+                # После ожидания в хвост могла приклеиться свежая правка
+                job = lane.queue.popleft()
+                try:
+                    result = await self._call(job.method, job.call)
+                except Exception as e:
+                    for future in job.futures:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    for future in job.futures:
+                        if not future.done():
+                            future.set_result(result)
+        finally:
+            lane.task = None
+
+    async def _call(self, method, call):
+        attempt = 0
+        while True:
+            try:
+                result = await timed_api_call(method, call)
+                self.sent += 1
+                return result
+            except RetryAfter as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                self.retried += 1
+                logging.warning(f"⏳ Flood control, повтор через {e.retry_after} с")
+                await asyncio.sleep(e.retry_after)
+
+    def _prune(self):
+        for chat_id, lane in list(self._lanes.items()):
+            if lane.task is None and not lane.queue and lane.bucket.idle():
+                del self._lanes[chat_id]
+
+
+async def timed_api_call(method, call):
+    """Вызов Bot API с учётом времени и ошибок в метриках"""
+    started = time.perf_counter()
     try:
-        c.execute(query, params)
-        conn.commit()
-        if query.strip().upper().startswith('SELECT'):
-            return c.fetchall()
-        elif query.strip().upper().startswith('INSERT'):
-            return c.lastrowid
-        return True
+        return await call()
+    except BadRequest as e:
+        # «not modified» — не сбой, а пустая правка
+        if 'not modified' not in str(e):
+            metrics.telegram_errors.inc(method, type(e).__name__)
+        raise
     except Exception as e:
-        print(f"❌ Ошибка БД: {e}")
-        return None
+        metrics.telegram_errors.inc(method, type(e).__name__)
+        raise
     finally:
-        conn.close()
+        metrics.telegram_seconds.observe(time.perf_counter() - started, method)
 
-# ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
-def get_user_name(telegram):
-    """Получить имя пользователя"""
-    return USERS.get(telegram, telegram)
 
-def is_admin(telegram):
-    """Проверить админ ли"""
-    return telegram in ADMINS
+outbound = OutboundScheduler()
 
-def get_next_for_task(task):
-    """Определить кто должен делать задачу"""
-    home_users = execute_query(
-        "SELECT telegram, name FROM users WHERE is_home = 1"
-    )
-    
-    if not home_users:
-        return None, None, None
-    
-    result = execute_query(
-        "SELECT last_user FROM queue WHERE task = ?", (task,)
-    )
-    last_user = result[0][0] if result else 'никто'
-    
-    user_stats = []
-    for telegram, name in home_users:
-        result = execute_query(
-            '''SELECT MAX(date) FROM tasks_done 
-               WHERE task = ? AND user_name = ? AND is_confirmed = 1
-               AND is_penalty = 0''', 
-            (task, name)
-        )
-        
-        if result and result[0][0]:
-            last_date = datetime.strptime(result[0][0], '%Y-%m-%d %H:%M:%S')
-            days_ago = (datetime.now() - last_date).days
-        else:
-            days_ago = 999
-            
-        user_stats.append({
-            'telegram': telegram,
-            'name': name,
-            'days_ago': days_ago
-        })
-    
-    user_stats.sort(key=lambda x: x['days_ago'], reverse=True)
-    return user_stats[0]['telegram'], user_stats[0]['name'], last_user
+# ==================== ОТВЕТЫ НА КНОПКИ ====================
+class Reply:
+    """Итоговое состояние сообщения после нажатия кнопки.
 
-def update_queue(task, user_name):
-    """Обновить очередь после выполнения"""
-    execute_query(
-        "UPDATE queue SET last_user = ?, last_date = ? WHERE task = ?",
-        (user_name, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), task)
-    )
+    Обработчики кнопок не ходят в Bot API сами: они возвращают Reply,
+    а button_handler отвечает на callback один раз и делает одну правку.
+    """
 
-def update_balance(telegram, points):
-    """Обновить баланс пользователя"""
-    result = execute_query(
-        "SELECT balance FROM users WHERE telegram = ?", (telegram,)
-    )
-    current_balance = result[0][0] if result else 0
+    __slots__ = ('text', 'parse_mode', 'reply_markup')
+
+    def __init__(self, text, parse_mode=None, reply_markup=None):
+        self.text = text
+        self.parse_mode = parse_mode
+        self.reply_markup = reply_markup
+
+
+async def send_reply(query, reply):
+    """Применить Reply к сообщению с кнопкой, пропуская правки без изменений"""
+    if reply is None:
+        return
     
-    new_balance = max(current_balance + points, MIN_BALANCE)
-    execute_query(
-        "UPDATE users SET balance = ? WHERE telegram = ?",
-        (new_balance, telegram)
-    )
+    message = query.message
+    if message is not None and reply.parse_mode is None and message.text == reply.text:
+        # Текст тот же — правим только клавиатуру, если она поменялась
+        if message.reply_markup == reply.reply_markup:
+            return
+        edit = lambda: query.edit_message_reply_markup(reply_markup=reply.reply_markup)
+    else:
+        edit = lambda: query.edit_message_text(
+            reply.text,
+            parse_mode=reply.parse_mode,
+            reply_markup=reply.reply_markup
+        )
     
-    return new_balance
+    try:
+        if message is None:
+            # Сообщение из inline-режима: чата у правки нет
+            await timed_api_call('editMessage', edit)
+        else:
+            await outbound.edit(message.chat_id, message.message_id, edit)
+    except BadRequest as e:
+        # Telegram отказывается «редактировать» сообщение в то же самое
+        if 'not modified' not in str(e):
+            raise
 
 # ==================== ОСНОВНЫЕ КОМАНДЫ ====================
-def start(update: Update, context):
+async def start(update: Update, context):
     """Главное меню"""
     user = update.effective_user
-    telegram = f"@{user.username}" if user.username else user.first_name
+    household = await households.resolve(update.effective_chat.id, user)
+    telegram = household.member_of(user) if household else None
 
-    if telegram not in USERS:
+    if telegram is None:
         if update.message:
-            update.message.reply_text(
+            await update.message.reply_text(
                 "👋 *Привет!*\n\n"
                 "Я бот для справедливого распределения дел в квартире.\n"
-                "Участники:\n"
-                "• матрос (@DILLC7)\n"
-                "• Борода (@djumshut2000)\n"
-                "• Даник (@naattive)",
+                "Вас пока нет ни в одной квартире: попросите админа добавить вас "
+                "(/member\\_add) или создайте свою — /household\\_new Название",
                 parse_mode='Markdown'
             )
         return
 
-    user_name = USERS[telegram]
-
-    keyboard = [
-        [InlineKeyboardButton("🎯 Кто что должен?", callback_data='menu_who')],
-        [InlineKeyboardButton("✅ Я сделал задачу", callback_data='menu_did')],
-        [InlineKeyboardButton("🍽️ Готовка/посуда", callback_data='menu_food')],
-        [InlineKeyboardButton("⚠️ Штраф/нарушение", callback_data='menu_penalty')],
-        [InlineKeyboardButton("📊 Статистика", callback_data='stats')],
-        [InlineKeyboardButton("🚪 Отметить отъезд/возвращение", callback_data='menu_home')],
-        [InlineKeyboardButton("📋 Правила системы", callback_data='rules')],
-    ]
-
-    if is_admin(telegram):
-        keyboard.insert(6, [InlineKeyboardButton("⚙ Админка", callback_data='admin_panel')])
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    user_name = household.members[telegram]
+    reply_markup = household.main_menu(telegram)
 
     chat_id = update.effective_chat.id
-    context.bot.send_message(
+    await outbound.send(chat_id, lambda: context.bot.send_message(
         chat_id=chat_id,
         text=f"🏠 *Главное меню*\n\nПривет, {user_name}! Выберите действие:",
         parse_mode='Markdown',
         reply_markup=reply_markup,
-    )
+    ))
 
-def help_command(update: Update, context):
+async def help_command(update: Update, context):
     """Команда помощи"""
-    start(update, context)
+    await start(update, context)
 
-def show_main_menu(update: Update, context):
+async def show_main_menu(update: Update, context, household):
     """Показать главное меню"""
-    query = update.callback_query
-    query.answer()
-    
-    user = query.from_user
-    telegram = f"@{user.username}" if user.username else user.first_name
+    telegram = household.member_of(update.callback_query.from_user)
     
-    if telegram not in USERS:
+    if telegram not in household.members:
         return
     
-    user_name = USERS[telegram]
-    
-    keyboard = [
-        [InlineKeyboardButton("🎯 Кто что должен?", callback_data='menu_who')],
-        [InlineKeyboardButton("✅ Я сделал задачу", callback_data='menu_did')],
-        [InlineKeyboardButton("🍽️ Готовка/посуда", callback_data='menu_food')],
-        [InlineKeyboardButton("⚠️ Штраф/нарушение", callback_data='menu_penalty')],
-        [InlineKeyboardButton("📊 Статистика", callback_data='stats')],
-        [InlineKeyboardButton("🚪 Отметить отъезд/возвращение", callback_data='menu_home')],
-        [InlineKeyboardButton("📋 Правила системы", callback_data='rules')]
-    ]
-    
-    if is_admin(telegram):
-        keyboard.insert(6, [InlineKeyboardButton("⚙ Админка", callback_data='admin_panel')])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    new_text = f"🏠 *Главное меню*\n\nПривет, {user_name}! Выберите действие:"
+    user_name = household.members[telegram]
+    reply_markup = household.main_menu(telegram)
     
-    if query.message.text != new_text:
-        query.edit_message_text(new_text, parse_mode='Markdown', reply_markup=reply_markup)
-    else:
-        query.edit_message_reply_markup(reply_markup=reply_markup)
+    return Reply(
+        f"🏠 *Главное меню*\n\nПривет, {user_name}! Выберите действие:",
+        parse_mode='Markdown',
+        reply_markup=reply_markup
+    )
 
 # ==================== МЕНЮ "КТО ЧТО ДОЛЖЕН" ====================
-def menu_who(update: Update, context):
+async def menu_who(update: Update, context, household):
     """Меню выбора задачи"""
-    query = update.callback_query
-    query.answer()
-    
-    keyboard = []
-    tasks = list(TASKS.keys())
-    
-    for i in range(0, len(tasks), 2):
-        row = []
-        if i < len(tasks):
-            row.append(InlineKeyboardButton(tasks[i], callback_data=f'who_{tasks[i]}'))
-        if i + 1 < len(tasks):
-            row.append(InlineKeyboardButton(tasks[i+1], callback_data=f'who_{tasks[i+1]}'))
-        keyboard.append(row)
+    reply_markup = household.keyboards.get('who')
     
-    keyboard.append([InlineKeyboardButton("🏠 Назад", callback_data='main_menu')])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    query.edit_message_text(
+    return Reply(
         "🎯 *Выберите задачу, чтобы узнать кто должен делать:*",
         parse_mode='Markdown',
         reply_markup=reply_markup
     )
 
-def process_who(update: Update, context):
+async def process_who(update: Update, context, household, task):
     """Обработка выбора задачи"""
-    query = update.callback_query
-    query.answer()
-    
-    task = query.data.replace('who_', '')
+    if task not in household.tasks:
+        return Reply("❌ Задача не найдена")
     
-    if task not in TASKS:
-        query.edit_message_text("❌ Задача не найдена")
-        return
-    
-    next_tg, next_name, last_user = get_next_for_task(task)
+    candidates, (q_last_user, q_last_date) = await run_db(storage.get_rotation, household.id, task)
     
-    if not next_name:
-        query.edit_message_text("❌ Все в отъезде!")
-        return
+    if not candidates:
+        return Reply("❌ Все в отъезде!")
     
-    result = execute_query(
-        '''SELECT MAX(date) FROM tasks_done 
-           WHERE task = ? AND user_name = ? AND is_confirmed = 1 AND is_penalty = 0''',
-        (task, next_name)
-    )
+    next_tg = candidates[0]['telegram']
+    next_name = candidates[0]['name']
     
-    if result and result[0][0]:
-        last_date = datetime.strptime(result[0][0], '%Y-%m-%d %H:%M:%S')
-        last_str = last_date.strftime('%d.%m.%Y')
+    if candidates[0]['last_date']:
+        last_str = format_ts(candidates[0]['last_date'], '%d.%m.%Y')
     else:
         last_str = "никогда"
     
-    queue_info = execute_query(
-        "SELECT last_user, last_date FROM queue WHERE task = ?", (task,)
-    )
-    if queue_info and queue_info[0][1]:
-        q_last_user, q_last_date = queue_info[0]
-        q_last_date_dt = datetime.strptime(q_last_date, '%Y-%m-%d %H:%M:%S')
-        q_last_date_str = q_last_date_dt.strftime('%d.%m.%Y')
+    if q_last_date:
+        q_last_date_str = format_ts(q_last_date, '%d.%m.%Y')
         queue_text = f"👥 *Последним делал:* {q_last_user} ({q_last_date_str})\n"
     else:
         queue_text = "👥 *Последним делал:* никто\n"
@@ -344,8 +3362,8 @@ def process_who(update: Update, context):
         f"👤 *Должен делать:* {next_name}\n"
         f"📅 *Последний раз он делал:* {last_str}\n"
         f"{queue_text}"
-        f"⭐ *Баллов за задачу:* {TASKS[task]['points']}\n\n"
-        f"*Что входит в задачу:*\n{TASKS[task]['rules']}\n\n"
+        f"⭐ *Баллов за задачу:* {household.tasks[task]['points']}\n\n"
+        f"*Что входит в задачу:*\n{household.tasks[task]['rules']}\n\n"
         f"{next_tg}, твоя очередь!"
     )
     
@@ -356,75 +3374,75 @@ def process_who(update: Update, context):
     ]
     
     reply_markup = InlineKeyboardMarkup(keyboard)
-    query.edit_message_text(response, parse_mode='Markdown', reply_markup=reply_markup)
+    return Reply(response, parse_mode='Markdown', reply_markup=reply_markup)
 
-# ==================== МЕНЮ "Я СДЕЛАЛ ЗАДАЧУ" ====================
-def menu_did(update: Update, context):
-    """Меню выполненных задач"""
-    query = update.callback_query
-    query.answer()
-    
-    keyboard = []
-    tasks = list(TASKS.keys())
+async def show_who_overview(update: Update, context, household):
+    """Кто должен делать каждую задачу (одним запросом)"""
+    overview = await run_db(storage.get_rotation_overview, household.id)
+    
+    if not overview:
+        return Reply("❌ Все в отъезде!")
+    
+    text = "📋 *Кто что должен:*\n\n"
+    for task in household.tasks:
+        if task not in overview:
+            continue
+        info = overview[task]
+        if info['last_date']:
+            last_str = format_ts(info['last_date'], '%d.%m')
+        else:
+            last_str = "никогда"
+        text += f"• *{task}* → {info['name']} (последний раз: {last_str})\n"
     
-    for i in range(0, len(tasks), 2):
-        row = []
-        if i < len(tasks):
-            row.append(InlineKeyboardButton(tasks[i], callback_data=f'did_{tasks[i]}'))
-        if i + 1 < len(tasks):
-            row.append(InlineKeyboardButton(tasks[i+1], callback_data=f'did_{tasks[i+1]}'))
-        keyboard.append(row)
+    keyboard = [
+        [InlineKeyboardButton("🎯 Выбрать задачу", callback_data='menu_who')],
+        [InlineKeyboardButton("🏠 Назад", callback_data='main_menu')]
+    ]
     
-    keyboard.append([InlineKeyboardButton("🏠 Назад", callback_data='main_menu')])
     reply_markup = InlineKeyboardMarkup(keyboard)
+    return Reply(text, parse_mode='Markdown', reply_markup=reply_markup)
+
+# ==================== МЕНЮ "Я СДЕЛАЛ ЗАДАЧУ" ====================
+async def menu_did(update: Update, context, household):
+    """Меню выполненных задач"""
+    reply_markup = household.keyboards.get('did')
     
-    query.edit_message_text(
+    return Reply(
         "✅ *Какую задачу вы выполнили?*\n\nВыберите из списка:",
         parse_mode='Markdown',
         reply_markup=reply_markup
     )
 
-def process_did(update: Update, context):
+async def process_did(update: Update, context, household, task):
     """Обработка выполнения задачи"""
-    query = update.callback_query
-    query.answer()
+    telegram = household.member_of(update.callback_query.from_user)
     
-    task = query.data.replace('did_', '')
-    user = query.from_user
-    telegram = f"@{user.username}" if user.username else user.first_name
+    if telegram not in household.members:
+        return Reply("❌ Вы не участник системы!")
     
-    if telegram not in USERS:
-        query.edit_message_text("❌ Вы не участник системы!")
-        return
+    if task not in household.tasks:
+        return Reply("❌ Задача не найдена")
     
-    user_name = USERS[telegram]
+    user_name = household.members[telegram]
+    points = household.tasks[task]['points']
     
-    now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    task_id = execute_query(
-        '''INSERT INTO tasks_done 
-           (task, user_telegram, user_name, points, date)
-           VALUES (?, ?, ?, ?, ?)''',
-        (task, telegram, user_name, TASKS[task]['points'], now_str)
-    )
+    now = now_ts()
+    task_id = await run_db(storage.add_task_record, household.id, task, telegram, user_name, points, now)
         
     if not task_id:
-        query.edit_message_text("❌ Ошибка при сохранении задачи")
-        return
+        return Reply("❌ Ошибка при сохранении задачи")
     
     keyboard = []
     
-    if is_admin(telegram):
+    if household.is_admin(telegram):
         keyboard.append([
             InlineKeyboardButton(
-                "✅ 👑 матрос подтверждает",
-                callback_data=f'confirm_{task_id}_матрос'
+                f"✅ 👑 {user_name} подтверждает",
+                callback_data=f'confirm_{task_id}_{user_name}'
             )
         ])
     
-    possible_confirmers = execute_query(
-        "SELECT telegram, name FROM users WHERE telegram != ? AND is_home = 1",
-        (telegram,)
-    )
+    possible_confirmers = await run_db(storage.get_confirmers, household.id, telegram)
     
     for conf_tg, conf_name in possible_confirmers:
         keyboard.append([
@@ -437,221 +3455,83 @@ def process_did(update: Update, context):
     keyboard.append([InlineKeyboardButton("❌ Отменить", callback_data=f'cancel_{task_id}')])
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    total_confirmers = len(possible_confirmers) + (1 if is_admin(telegram) else 0)
+    total_confirmers = len(possible_confirmers) + (1 if household.is_admin(telegram) else 0)
     
-    query.edit_message_text(
+    return Reply(
         f"🔄 *Требуется подтверждение*\n\n"
         f"👤 *{user_name}* выполнил(а): *{task}*\n"
-        f"⭐ Баллов: {TASKS[task]['points']}\n"
-        f"🕒 {datetime.now().strftime('%H:%M %d.%m.%Y')}\n\n"
+        f"⭐ Баллов: {points}\n"
+        f"🕒 {format_ts(now_ts(), '%H:%M %d.%m.%Y')}\n\n"
         f"✅ Доступно для подтверждения: *{total_confirmers} чел.*",
         parse_mode='Markdown',
         reply_markup=reply_markup
     )
 
-def process_confirmation(update: Update, context):
-    """Подтверждение выполнения задачи"""
-    query = update.callback_query
-    query.answer()
-    
-    data = query.data
-    
-    if not data.startswith('confirm_'):
-        query.edit_message_text("❌ Неверный формат")
-        return
-    
-    parts = data.replace('confirm_', '').split('_', 1)
-    if len(parts) < 2:
-        query.edit_message_text("❌ Ошибка данных")
-        return
-    
-    try:
-        task_id = int(parts[0])
-    except:
-        query.edit_message_text("❌ Неверный ID задачи")
-        return
-    
-    expected_confirmer = parts[1]
-    
-    confirmer = query.from_user
-    confirmertg = f"@{confirmer.username}" if confirmer.username else None
-    
-    if confirmertg == "@DILLC7":
-        confirmer_name = "матрос"
-    elif confirmertg and confirmertg.lstrip('@') in USERS:
-        confirmer_name = USERS[confirmertg.lstrip('@')]
-    else:
-        query.edit_message_text("❌ Ты не участник системы!")
-        return
-    
-    if confirmertg not in ADMINS and confirmer_name != expected_confirmer:
-        query.edit_message_text(f"❌ Эту задачу должен подтвердить {expected_confirmer}!")
-        return
-
-    result = execute_query(
-        "SELECT task, user_telegram, user_name, points, is_confirmed, is_penalty FROM tasks_done WHERE id = ?",
-        (task_id,)
-    )
-    
-    if not result:
-        query.edit_message_text(f"❌ Задача ID {task_id} не найдена!")
-        return
-    
-    task, doer_tg, doer_name, points, is_confirmed, is_penalty = result[0]
-    
-    if is_confirmed:
-        query.edit_message_text("✅ Эта задача уже подтверждена!")
-        return
-    
-    confirmed_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    execute_query(
-        "UPDATE tasks_done SET confirmed_by = ?, is_confirmed = 1, confirmed_at = ? WHERE id = ?",
-        (confirmer_name, confirmed_at, task_id)
-    )
-    
-    new_balance = update_balance(doer_tg, points)
-    
-    if not is_penalty and task in TASKS:
-        update_queue(task, doer_name)
-    
-    query.edit_message_text(
-        f"✅ *ПОДТВЕРЖДЕНО!*\n\n"
-        f"👤 {doer_name}\n"
-        f"📝 *{task}*\n"
-        f"👍 Подтвердил: {confirmer_name}\n"
-        f"⭐ Баллов: {points:+d}\n"
-        f"💰 Баланс: {new_balance}\n"
-        f"🕒 {datetime.now().strftime('%H:%M %d.%m.%Y')}",
-        parse_mode='Markdown'
-    )
-
 # ==================== ПОДТВЕРЖДЕНИЕ / ОТМЕНА ЗАДАЧ ====================
-def process_confirmation(update: Update, context):
+async def process_confirmation(update: Update, context, household, task_id, expected_confirmer):
     """Подтверждение выполнения задачи"""
-    query = update.callback_query
-    query.answer()
-    
-    data = query.data
-    
-    if not data.startswith('confirm_'):
-        query.edit_message_text("❌ Неверный формат")
-        return
-    
-    parts = data.replace('confirm_', '').split('_', 1)
-    if len(parts) < 2:
-        query.edit_message_text("❌ Ошибка данных")
-        return
+    confirmertg = household.member_of(update.callback_query.from_user)
     
-    try:
-        task_id = int(parts[0])
-    except:
-        query.edit_message_text("❌ Неверный ID задачи")
-        return
-    
-    expected_confirmer = parts[1]
-    
-    confirmer = query.from_user
-    confirmertg = f"@{confirmer.username}" if confirmer.username else None
+    if confirmertg not in household.members:
+        return Reply("❌ Ты не участник системы!")
     
-    if confirmertg == "@DILLC7":
-        confirmer_name = "матрос"
-    elif confirmertg and confirmertg.lstrip('@') in USERS:
-        confirmer_name = USERS[confirmertg.lstrip('@')]
-    else:
-        query.edit_message_text("❌ Ты не участник системы!")
-        return
+    confirmer_name = household.members[confirmertg]
     
-    if confirmertg not in ADMINS and confirmer_name != expected_confirmer:
-        query.edit_message_text(f"❌ Эту задачу должен подтвердить {expected_confirmer}!")
-        return
+    if not household.is_admin(confirmertg) and confirmer_name != expected_confirmer:
+        return Reply(f"❌ Эту задачу должен подтвердить {expected_confirmer}!")
 
-    result = execute_query(
-        "SELECT task, user_telegram, user_name, points, is_confirmed, is_penalty FROM tasks_done WHERE id = ?",
-        (task_id,)
-    )
-    
-    if not result:
-        query.edit_message_text(f"❌ Задача ID {task_id} не найдена!")
-        return
-    
-    task, doer_tg, doer_name, points, is_confirmed, is_penalty = result[0]
+    status, confirmed = await run_db(storage.confirm_task, household, task_id, confirmer_name)
     
-    if is_confirmed:
-        query.edit_message_text("✅ Эта задача уже подтверждена!")
-        return
+    if status == 'missing':
+        return Reply(f"❌ Задача ID {task_id} не найдена!")
     
-    confirmed_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    execute_query(
-        "UPDATE tasks_done SET confirmed_by = ?, is_confirmed = 1, confirmed_at = ? WHERE id = ?",
-        (confirmer_name, confirmed_at, task_id)
-    )
+    if status == 'already':
+        return Reply("✅ Эта задача уже подтверждена!")
     
-    new_balance = update_balance(doer_tg, points)
+    stats_cache.invalidate(household.id)
     
-    if not is_penalty and task in TASKS:
-        update_queue(task, doer_name)
+    task = confirmed['task']
+    doer_name = confirmed['doer_name']
+    points = confirmed['points']
+    new_balance = confirmed['balance']
     
-    query.edit_message_text(
+    return Reply(
         f"✅ *ПОДТВЕРЖДЕНО!*\n\n"
         f"👤 {doer_name}\n"
         f"📝 *{task}*\n"
         f"👍 Подтвердил: {confirmer_name}\n"
         f"⭐ Баллов: {points:+d}\n"
         f"💰 Баланс: {new_balance}\n"
-        f"🕒 {datetime.now().strftime('%H:%M %d.%m.%Y')}",
+        f"🕒 {format_ts(now_ts(), '%H:%M %d.%m.%Y')}",
         parse_mode='Markdown'
     )
 
-def cancel_task(update: Update, context):
+async def cancel_task(update: Update, context, household, task_id):
     """Отмена задачи (удаление)"""
-    query = update.callback_query
-    query.answer()
-    
-    try:
-        task_id = int(query.data.replace('cancel_', ''))
-    except:
-        query.edit_message_text("❌ Ошибка")
-        return
-    
-    result = execute_query(
-        "SELECT is_confirmed FROM tasks_done WHERE id = ?", (task_id,)
-    )
+    status = await run_db(storage.cancel_pending_task, household.id, task_id)
     
-    if not result:
-        query.edit_message_text("❌ Задача не найдена")
-        return
+    if status == 'missing':
+        return Reply("❌ Задача не найдена")
     
-    if result[0][0]:
-        query.edit_message_text("❌ Нельзя отменить подтверждённую задачу!")
-        return
+    if status == 'confirmed':
+        return Reply("❌ Нельзя отменить подтверждённую задачу!")
     
-    execute_query(
-        "DELETE FROM tasks_done WHERE id = ?", (task_id,)
-    )
+    stats_cache.invalidate(household.id)
     
-    query.edit_message_text(
+    return Reply(
         "❌ *Задача отменена*\n\nЗапись удалена из системы.",
         parse_mode='Markdown'
     )
 
 # ==================== ГОТОВКА И ПОСУДА ====================
-def menu_food(update: Update, context):
+async def menu_food(update: Update, context, household):
     """Меню готовки/посуды"""
-    query = update.callback_query
-    query.answer()
-    
-    keyboard = [
-        [InlineKeyboardButton("🍳 Я приготовил для всех", callback_data='cooked_all')],
-        [InlineKeyboardButton("🍽️ Я помыл посуду", callback_data='washed_dishes')],
-        [InlineKeyboardButton("🏠 Назад", callback_data='main_menu')]
-    ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = household.keyboards.get('food')
     
     rules = (
         "🍽️ *ПРАВИЛА ГОТОВКИ И ПОСУДЫ*\n\n"
         "1. *Если готовил ДЛЯ ВСЕХ:*\n"
-        "   • Получаешь 3 балла за готовку\n"
+        f"   • Получаешь {household.points('готовка', 3)} балла за готовку\n"
         "   • Посуду моет ТОТ, КТО КУШАЛ\n"
         "   • Кто не кушал → не обязан мыть\n\n"
         "2. *Если готовил ТОЛЬКО ДЛЯ СЕБЯ:*\n"
@@ -660,48 +3540,36 @@ def menu_food(update: Update, context):
         "Выберите действие:"
     )
     
-    query.edit_message_text(rules, parse_mode='Markdown', reply_markup=reply_markup)
+    return Reply(rules, parse_mode='Markdown', reply_markup=reply_markup)
 
-def cooked_all(update: Update, context):
+async def cooked_all(update: Update, context, household):
     """Запись готовки для всех"""
-    query = update.callback_query
-    query.answer()
+    telegram = household.member_of(update.callback_query.from_user)
     
-    user = query.from_user
-    telegram = f"@{user.username}" if user.username else user.first_name
+    if telegram not in household.members:
+        return Reply("❌ Вы не участник!")
     
-    if telegram not in USERS:
-        query.edit_message_text("❌ Вы не участник!")
-        return
-    
-    user_name = USERS[telegram]
+    user_name = household.members[telegram]
+    points = household.points('готовка', 3)
     
-    now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    cook_id = execute_query(
-        '''INSERT INTO tasks_done 
-           (task, user_telegram, user_name, points, details, date)
-           VALUES (?, ?, ?, ?, ?, ?)''',
-        ('готовка', telegram, user_name, 3, 'для всех', now_str)
+    now = now_ts()
+    cook_id = await run_db(
+        storage.add_task_record, household.id, 'готовка', telegram, user_name, points, now, 'для всех'
     )
         
     if not cook_id:
-        query.edit_message_text("❌ Ошибка при сохранении")
-        return
+        return Reply("❌ Ошибка при сохранении")
     
-    possible_confirmers = execute_query(
-        "SELECT telegram, name FROM users WHERE telegram != ? AND is_home = 1",
-        (telegram,)
-    )
+    possible_confirmers = await run_db(storage.get_confirmers, household.id, telegram)
     
     if not possible_confirmers:
-        query.edit_message_text(
+        return Reply(
             f"✅ *Готовка записана!*\n\n"
             f"👤 {user_name} приготовил(а) для всех\n"
-            f"⭐ 3 балла\n\n"
+            f"⭐ {points} балла\n\n"
             f"Нет других дома для подтверждения.",
             parse_mode='Markdown'
         )
-        return
     
     keyboard = []
     for conf_tg, conf_name in possible_confirmers:
@@ -720,58 +3588,44 @@ def cooked_all(update: Update, context):
     keyboard.append([InlineKeyboardButton("🏠 Назад", callback_data='menu_food')])
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    query.edit_message_text(
+    return Reply(
         f"✅ *Готовка записана!*\n\n"
         f"👤 {user_name} приготовил(а) для всех\n"
-        f"⭐ 3 балла (нужно подтверждение)\n\n"
+        f"⭐ {points} балла (нужно подтверждение)\n\n"
         f"Посуду должен мыть ТОТ, КТО КУШАЛ.",
         parse_mode='Markdown',
         reply_markup=reply_markup
     )
 
-def dishes_after_cooking(update: Update, context):
+async def dishes_after_cooking(update: Update, context, household, cook_id):
     """Помыл посуду после конкретной готовки"""
-    query = update.callback_query
-    query.answer()
-    
-    data = query.data
-    cook_id = int(data.replace('dishes_', ''))
-    
-    user = query.from_user
-    telegram = f"@{user.username}" if user.username else user.first_name
+    telegram = household.member_of(update.callback_query.from_user)
     
-    if telegram not in USERS:
-        query.edit_message_text("❌ Вы не участник!")
-        return
+    if telegram not in household.members:
+        return Reply("❌ Вы не участник!")
     
-    user_name = USERS[telegram]
+    user_name = household.members[telegram]
+    points = household.points('посуда', 2)
     
-    now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    task_id = execute_query(
-        '''INSERT INTO tasks_done 
-           (task, user_telegram, user_name, points, details, date)
-           VALUES (?, ?, ?, ?, ?, ?)''',
-        ('посуда', telegram, user_name, 2, f'после готовки #{cook_id}', now_str)
+    now = now_ts()
+    task_id = await run_db(
+        storage.add_task_record, household.id, 'посуда', telegram, user_name, points, now,
+        f'после готовки #{cook_id}'
     )
         
     if not task_id:
-        query.edit_message_text("❌ Ошибка при сохранении")
-        return
+        return Reply("❌ Ошибка при сохранении")
     
-    possible_confirmers = execute_query(
-        "SELECT telegram, name FROM users WHERE telegram != ? AND is_home = 1",
-        (telegram,)
-    )
+    possible_confirmers = await run_db(storage.get_confirmers, household.id, telegram)
     
     if not possible_confirmers:
-        query.edit_message_text(
+        return Reply(
             f"✅ *Записано!*\n\n"
             f"👤 {user_name} помыл(а) посуду\n"
-            f"⭐ 2 балла\n\n"
+            f"⭐ {points} балла\n\n"
             f"Нет других дома для подтверждения.",
             parse_mode='Markdown'
         )
-        return
     
     keyboard = []
     for conf_tg, conf_name in possible_confirmers:
@@ -784,55 +3638,41 @@ def dishes_after_cooking(update: Update, context):
     
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    query.edit_message_text(
+    return Reply(
         f"🔄 *Подтвердите мытьё посуды*\n\n"
         f"👤 {user_name} помыл(а) посуду после готовки\n"
-        f"⭐ 2 балла\n\n"
+        f"⭐ {points} балла\n\n"
         f"Подтвердить может тот, кто тоже кушал:",
         parse_mode='Markdown',
         reply_markup=reply_markup
     )
 
-def washed_dishes(update: Update, context):
+async def washed_dishes(update: Update, context, household):
     """Общая функция для мытья посуды"""
-    query = update.callback_query
-    query.answer()
-    
-    user = query.from_user
-    telegram = f"@{user.username}" if user.username else user.first_name
+    telegram = household.member_of(update.callback_query.from_user)
     
-    if telegram not in USERS:
-        query.edit_message_text("❌ Вы не участник!")
-        return
+    if telegram not in household.members:
+        return Reply("❌ Вы не участник!")
     
-    user_name = USERS[telegram]
+    user_name = household.members[telegram]
+    points = household.points('посуда', 2)
     
-    now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    task_id = execute_query(
-        '''INSERT INTO tasks_done 
-           (task, user_telegram, user_name, points, date)
-           VALUES (?, ?, ?, ?, ?)''',
-        ('посуда', telegram, user_name, 2, now_str)
-    )
+    now = now_ts()
+    task_id = await run_db(storage.add_task_record, household.id, 'посуда', telegram, user_name, points, now)
         
     if not task_id:
-        query.edit_message_text("❌ Ошибка при сохранении")
-        return
+        return Reply("❌ Ошибка при сохранении")
     
-    possible_confirmers = execute_query(
-        "SELECT telegram, name FROM users WHERE telegram != ? AND is_home = 1",
-        (telegram,)
-    )
+    possible_confirmers = await run_db(storage.get_confirmers, household.id, telegram)
     
     if not possible_confirmers:
-        query.edit_message_text(
+        return Reply(
             f"✅ *Записано!*\n\n"
             f"👤 {user_name} помыл(а) посуду\n"
-            f"⭐ 2 балла\n\n"
+            f"⭐ {points} балла\n\n"
             f"Нет других дома для подтверждения.",
             parse_mode='Markdown'
         )
-        return
     
     keyboard = []
     for conf_tg, conf_name in possible_confirmers:
@@ -845,48 +3685,35 @@ def washed_dishes(update: Update, context):
     
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    query.edit_message_text(
+    return Reply(
         f"🔄 *Подтвердите мытьё посуды*\n\n"
         f"👤 {user_name} помыл(а) посуду\n"
-        f"⭐ 2 балла\n\n"
+        f"⭐ {points} балла\n\n"
         f"Подтвердить может другой участник:",
-        parse_mode='Markdown',
-        reply_markup=reply_markup
-    )
-
-# ==================== ШТРАФЫ ====================
-def menu_penalty(update: Update, context):
-    """Меню штрафов"""
-    query = update.callback_query
-    query.answer()
-    
-    keyboard = [
-        [InlineKeyboardButton("💧 Не убрал за собой", callback_data='penalty_mess')],
-        [InlineKeyboardButton("❌ Не сделал назначенное", callback_data='penalty_task')],
-        [InlineKeyboardButton("🚮 Оставил мусор", callback_data='penalty_trash')],
-        [InlineKeyboardButton("🏠 Назад", callback_data='main_menu')]
-    ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+        parse_mode='Markdown',
+        reply_markup=reply_markup
+    )
+
+# ==================== ШТРАФЫ ====================
+async def menu_penalty(update: Update, context, household):
+    """Меню штрафов"""
+    reply_markup = household.keyboards.get('penalty')
     
-    query.edit_message_text(
+    return Reply(
         "⚠️ *ШТРАФНАЯ СИСТЕМА*\n\n"
         "• Не убрал за собой → -1 балл\n"
         "• Не сделал назначенное → -2 балла\n"
         "• Оставил мусор → -1 балл\n\n"
-        "👑 *матрос всегда может подтвердить любой штраф!*\n\n"
-        f"Баланс не ниже: {MIN_BALANCE} баллов.\n\n"
+        f"👑 *{household.admin_names() or 'Админ'} всегда может подтвердить любой штраф!*\n\n"
+        f"Баланс не ниже: {household.min_balance} баллов.\n\n"
         "Выберите нарушение:",
         parse_mode='Markdown',
         reply_markup=reply_markup
     )
 
-def penalty_type_selected(update: Update, context):
+async def penalty_type_selected(update: Update, context, household, penalty_type):
     """Выбор типа штрафа"""
     query = update.callback_query
-    query.answer()
-    
-    penalty_type = query.data
     
     penalties = {
         'penalty_mess': ('Не убрал за собой', -1),
@@ -895,8 +3722,7 @@ def penalty_type_selected(update: Update, context):
     }
     
     if penalty_type not in penalties:
-        query.edit_message_text("❌ Ошибка")
-        return
+        return Reply("❌ Ошибка")
     
     penalty_name, points = penalties[penalty_type]
     
@@ -905,65 +3731,56 @@ def penalty_type_selected(update: Update, context):
         'points': points
     }
     
-    user = query.from_user
-    user_tg = f"@{user.username}" if user.username else user.first_name
+    user_tg = household.member_of(query.from_user)
     
-    keyboard = []
-    for telegram, name in USERS.items():
-        if telegram != user_tg:
-            keyboard.append([InlineKeyboardButton(f"⚠️ {name}", callback_data=f'penalty_user_{telegram}')])
+    if user_tg not in household.members:
+        return
     
-    keyboard.append([InlineKeyboardButton("🏠 Назад", callback_data='menu_penalty')])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = household.keyboards.get(f'penalty_targets:{user_tg}')
     
-    query.edit_message_text(
+    return Reply(
         f"⚠️ *Кто нарушил?*\n\n"
         f"Нарушение: {penalty_name}\n"
         f"Штраф: {points} баллов\n\n"
-        f"Баланс не ниже: {MIN_BALANCE} баллов.",
+        f"Баланс не ниже: {household.min_balance} баллов.",
         parse_mode='Markdown',
         reply_markup=reply_markup
     )
 
-def create_penalty(update: Update, context):
+async def create_penalty(update: Update, context, household, user_tg):
     """Создание штрафа"""
     query = update.callback_query
-    query.answer()
-    
-    data = query.data
-    user_tg = data.replace('penalty_user_', '')
     
     if 'penalty_info' not in context.user_data:
-        query.edit_message_text("❌ Информация о штрафе потеряна")
-        return
+        return Reply("❌ Информация о штрафе потеряна")
+    
+    if user_tg not in household.members:
+        return Reply("❌ Пользователь не найден")
     
     penalty_info = context.user_data['penalty_info']
     penalty_name = penalty_info['name']
     points = penalty_info['points']
     
-    user_name = USERS.get(user_tg, user_tg)
-    creator_tg = f"@{query.from_user.username}" if query.from_user.username else query.from_user.first_name
-    creator_name = USERS.get(creator_tg, creator_tg)
+    user_name = household.members[user_tg]
+    creator_tg = household.member_of(query.from_user)
+    creator_name = household.members.get(creator_tg, creator_tg)
+    creator_is_admin = household.is_admin(creator_tg)
     
-    now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    penalty_id = execute_query(
-        "INSERT INTO tasks_done (task, user_telegram, user_name, points, is_penalty, details, date) VALUES (?, ?, ?, ?, 1, ?, ?)",
-        (f"Штраф: {penalty_name}", user_tg, user_name, points, f"Назначил: {creator_name}", now_str)
+    now = now_ts()
+    penalty_id = await run_db(
+        storage.add_task_record, household.id, f"Штраф: {penalty_name}", user_tg, user_name, points, now,
+        f"Назначил: {creator_name}", True
     )
     
     if not penalty_id:
-        query.edit_message_text("❌ Ошибка создания штрафа")
-        return
+        return Reply("❌ Ошибка создания штрафа")
     
     keyboard = []
     
-    if creator_tg.lstrip('@') in ADMINS:
-        keyboard.append([InlineKeyboardButton("✅ 👑 матрос подтверждает штраф", callback_data=f'confirm_{penalty_id}_матрос')])
+    if creator_is_admin:
+        keyboard.append([InlineKeyboardButton(f"✅ 👑 {creator_name} подтверждает штраф", callback_data=f'confirm_{penalty_id}_{creator_name}')])
     
-    possible_confirmers = execute_query(
-        "SELECT telegram, name FROM users WHERE telegram != ? AND telegram != ? AND is_home = 1",
-        (creator_tg, user_tg)
-    )
+    possible_confirmers = await run_db(storage.get_confirmers, household.id, creator_tg, user_tg)
     
     for conf_tg, conf_name in possible_confirmers:
         keyboard.append([InlineKeyboardButton(f"✅ {conf_name} подтверждает штраф", callback_data=f'confirm_{penalty_id}_{conf_name}')])
@@ -971,123 +3788,122 @@ def create_penalty(update: Update, context):
     keyboard.append([InlineKeyboardButton("❌ Отменить", callback_data=f'cancel_{penalty_id}')])
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    total_confirmers = len(possible_confirmers) + (1 if creator_tg.lstrip('@') in ADMINS else 0)
+    total_confirmers = len(possible_confirmers) + (1 if creator_is_admin else 0)
     
-    query.edit_message_text(
+    return Reply(
         f"⚠️ *Штраф создан!*\n\n"
         f"👤 {user_name}\n"
         f"📝 {penalty_name}\n"
         f"⭐ Штраф: {points} баллов\n"
         f"👮 Назначил: {creator_name}\n\n"
         f"✅ Подтвердить: *{total_confirmers} чел.*\n"
-        f"Баланс ≥ {MIN_BALANCE}",
+        f"Баланс ≥ {household.min_balance}",
         parse_mode='Markdown',
         reply_markup=reply_markup
     )
 
 # ==================== СТАТИСТИКА ====================
-def show_stats(update: Update, context):
-    """Показать статистику"""
-    query = update.callback_query
-    query.answer()
+def build_stats_text(household):
+    """Собрать текст статистики квартиры. Возвращает (текст, когда он устареет)"""
+    now = now_ts()
+    current_time = format_ts(now, '%H:%M:%S')
+    week_ago = now - 7 * DAY
     
-    current_time = datetime.now().strftime('%H:%M:%S')
+    # Окно «за неделю» сдвигается, когда из него выпадает самая старая запись
+    ttl = SHARED_CACHE_TTL if storage.shared else STATS_CACHE_TTL
+    expires_at = min(now + ttl, storage.get_window_expiry(household.id, week_ago))
     
     stats_text = (
         f"📊 *СТАТИСТИКА И БАЛАНСЫ*\n"
         f"🕒 Обновлено: {current_time}\n"
-        f"🔻 Баланс не ниже: {MIN_BALANCE}\n\n"
+        f"🔻 Баланс не ниже: {household.min_balance}\n\n"
     )
     
-    for telegram, name in USERS.items():
-        result = execute_query(
-            "SELECT balance, is_home FROM users WHERE telegram = ?", (telegram,)
-        )
-        
-        if result:
-            balance, is_home = result[0]
+    users = {
+        telegram: (balance, is_home)
+        for telegram, balance, is_home in storage.get_balances(household.id)
+    }
+    week_points = storage.get_window_points(household.id, week_ago)
+    
+    for telegram, name in household.members.items():
+        if telegram in users:
+            balance, is_home = users[telegram]
             status = "🏠" if is_home else "✈️"
             
-            week_ago = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d %H:%M:%S')
-            week_result = execute_query(
-                '''SELECT SUM(points) FROM tasks_done 
-                   WHERE user_telegram = ? AND is_confirmed = 1 AND date > ?''',
-                (telegram, week_ago)
-            )
-            
-            week_points = week_result[0][0] if week_result and week_result[0][0] else 0
-            
             stats_text += f"{status} *{name}:*\n"
             stats_text += f"  📊 Баланс: {balance} баллов\n"
-            stats_text += f"  📈 За неделю: {week_points} баллов\n\n"
+            stats_text += f"  📈 За неделю: {week_points.get(telegram, 0)} баллов\n\n"
     
-    week_ago = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d %H:%M:%S')
-    frequent_result = execute_query(
-        '''SELECT task, COUNT(*) as cnt FROM tasks_done 
-           WHERE is_confirmed = 1 AND date > ? AND is_penalty = 0
-           GROUP BY task ORDER BY cnt DESC LIMIT 3''', (week_ago,)
-    )
+    frequent_result = storage.get_window_top_tasks(household.id, week_ago)
     
     if frequent_result:
         stats_text += "🎯 *Частые задачи за неделю:*\n"
         for task, cnt in frequent_result:
             stats_text += f"• {task}: {cnt} раз\n"
     
-    keyboard = [
-        [InlineKeyboardButton("🔄 Обновить", callback_data='stats_refresh')],
-        [
-            InlineKeyboardButton("👤 матрос", callback_data='user_stats_@DILLC7'),
-            InlineKeyboardButton("👤 Борода", callback_data='user_stats_@djumshut2000')
-        ],
-        [InlineKeyboardButton("👤 Даник", callback_data='user_stats_@naattive')],
-        [InlineKeyboardButton("🏠 Назад", callback_data='main_menu')]
-    ]
+    return stats_text, expires_at
+
+async def show_stats(update: Update, context, household):
+    """Показать статистику"""
+    stats_text = stats_cache.get(household.id)
+    if stats_text is None:
+        generation = stats_cache.generation(household.id)
+        stats_text, expires_at = await run_db(build_stats_text, household)
+        stats_cache.put(household.id, stats_text, expires_at, generation)
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = household.keyboards.get('stats')
     
-    query.edit_message_text(
+    return Reply(
         stats_text,
         parse_mode='Markdown',
         reply_markup=reply_markup
     )
 
-def refresh_stats(update: Update, context):
+async def refresh_stats(update: Update, context, household):
     """Обновить статистику"""
-    query = update.callback_query
-    query.answer()
-    show_stats(update, context)
+    return await show_stats(update, context, household)
 
-def show_user_stats(update: Update, context):
-    """Подробная статистика по конкретному пользователю"""
-    query = update.callback_query
-    query.answer()
-    
-    data = query.data
-    user_tg = data.replace('user_stats_', '')
+async def show_user_stats(update: Update, context, household, user_tg, filter_code='a', direction='n', cursor=''):
+    """Подробная статистика по конкретному пользователю с листанием истории.
+
+    callback_data: user_stats_<tg> — первая страница,
+    uh_<tg>_<фильтр>_<n|p>_<курсор> — листание по курсору.
+    """
+    if user_tg not in household.members:
+        return Reply("❌ Пользователь не найден")
+    
+    task = None
+    if filter_code.startswith('t'):
+        try:
+            task = filter_title = list(household.tasks)[int(filter_code[1:])]
+        except (ValueError, IndexError):
+            return Reply("❌ Ошибка")
+    elif filter_code in HISTORY_FILTERS:
+        filter_title = HISTORY_FILTERS[filter_code][0]
+    else:
+        return Reply("❌ Ошибка")
     
-    if user_tg not in USERS:
-        query.edit_message_text("❌ Пользователь не найден")
-        return
+    user_name = household.members[user_tg]
     
-    user_name = USERS[user_tg]
+    week_points, month_points, total_points = await run_db(storage.get_user_totals, household.id, user_tg)
     
-    stats_text = f"📊 *Статистика: {user_name}*\n\n"
+    stats_text = (
+        f"📊 *Статистика: {user_name}*\n\n"
+        f"📈 За неделю: {week_points} балл.\n"
+        f"📅 За 30 дней: {month_points} балл.\n"
+        f"🏆 За всё время: {total_points} балл.\n\n"
+        f"🔎 Показаны: {filter_title}\n\n"
+    )
     
-    rows = execute_query(
-        '''SELECT date, task, points, confirmed_by, is_penalty, details, is_confirmed
-           FROM tasks_done
-           WHERE user_telegram = ?
-           ORDER BY date DESC
-           LIMIT 20''',
-        (user_tg,)
+    rows, has_newer, has_older = await run_db(
+        storage.get_history_page, household.id, user_tg, filter_code, direction, cursor, task
     )
     
     if not rows:
         stats_text += "Пока нет записей.\n"
     else:
-        for date_str, task, points, confirmed_by, is_penalty, details, is_confirmed in rows:
-            dt = datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S')
-            date_human = dt.strftime('%d.%m %H:%M')
+        for _, date_ts, task, points, confirmed_by, is_penalty, details, is_confirmed in rows:
+            date_human = format_ts(date_ts, '%d.%m %H:%M')
             kind = "штраф" if is_penalty else "задача"
             status = "✅" if is_confirmed else "⏳"
             conf_text = f" / подтверждён {confirmed_by}" if confirmed_by else ""
@@ -1098,42 +3914,66 @@ def show_user_stats(update: Update, context):
                 f"({points} балл.){conf_text}{details_text}\n"
             )
     
-    keyboard = [
-        [InlineKeyboardButton("⬅ Назад к статистике", callback_data='stats')],
-        [InlineKeyboardButton("🏠 В главное меню", callback_data='main_menu')]
-    ]
+    keyboard = []
+    
+    pages = []
+    if rows and has_newer:
+        first_id, first_date = rows[0][0], rows[0][1]
+        pages.append(InlineKeyboardButton(
+            "⬅ Новее", callback_data=f'uh_{user_tg}_{filter_code}_p_{encode_cursor(first_date, first_id)}'
+        ))
+    if rows and has_older:
+        last_id, last_date = rows[-1][0], rows[-1][1]
+        pages.append(InlineKeyboardButton(
+            "Старее ➡", callback_data=f'uh_{user_tg}_{filter_code}_n_{encode_cursor(last_date, last_id)}'
+        ))
+    if pages:
+        keyboard.append(pages)
+    
+    keyboard.append([
+        InlineKeyboardButton("📋 Все", callback_data=f'uh_{user_tg}_a_n_'),
+        InlineKeyboardButton("⚠️ Штрафы", callback_data=f'uh_{user_tg}_p_n_'),
+        InlineKeyboardButton("⏳ Ждут", callback_data=f'uh_{user_tg}_w_n_'),
+    ])
+    keyboard.append([InlineKeyboardButton("🔎 По задаче", callback_data=f'uhf_{user_tg}')])
+    keyboard.append([InlineKeyboardButton("⬅ Назад к статистике", callback_data='stats')])
+    keyboard.append([InlineKeyboardButton("🏠 В главное меню", callback_data='main_menu')])
     
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    query.edit_message_text(
+    return Reply(
         stats_text,
         parse_mode='Markdown',
         reply_markup=reply_markup
     )
 
+async def menu_history_task_filter(update: Update, context, household, user_tg):
+    """Выбор задачи для фильтра истории пользователя"""
+    if user_tg not in household.members:
+        return Reply("❌ Пользователь не найден")
+    
+    reply_markup = household.keyboards.get(f'history_tasks:{user_tg}')
+    
+    return Reply(
+        f"🔎 *История: {household.members[user_tg]}*\n\nВыберите задачу:",
+        parse_mode='Markdown',
+        reply_markup=reply_markup
+    )
+
 # ==================== ОТЪЕЗД/ВОЗВРАЩЕНИЕ ====================
-def menu_home(update: Update, context):
+async def menu_home(update: Update, context, household):
     """Меню смены статуса дома"""
-    query = update.callback_query
-    query.answer()
+    telegram = household.member_of(update.callback_query.from_user)
     
-    user = query.from_user
-    telegram = f"@{user.username}" if user.username else user.first_name
-    
-    if telegram not in USERS:
-        query.edit_message_text("❌ Вы не участник!")
-        return
+    if telegram not in household.members:
+        return Reply("❌ Вы не участник!")
     
-    result = execute_query(
-        "SELECT is_home FROM users WHERE telegram = ?", (telegram,)
-    )
+    is_home = await run_db(storage.get_home, household.id, telegram)
     
-    if not result:
-        query.edit_message_text("❌ Ошибка базы данных")
-        return
+    if is_home is None:
+        return Reply("❌ Ошибка базы данных")
     
-    is_home = result[0][0]
-    user_name = USERS[telegram]
+    user_name = household.members[telegram]
     
     action = "Уехать ✈️" if is_home else "Вернуться 🏠"
     callback = "leave" if is_home else "return"
@@ -1147,7 +3987,7 @@ def menu_home(update: Update, context):
     
     status = "дома 🏠" if is_home else "в отъезде ✈️"
     
-    query.edit_message_text(
+    return Reply(
         f"👤 *{user_name}*\n"
         f"Сейчас вы: {status}\n\n"
         f"Нажмите кнопку чтобы изменить статус:",
@@ -1155,32 +3995,27 @@ def menu_home(update: Update, context):
         reply_markup=reply_markup
     )
 
-def toggle_home(update: Update, context):
+async def toggle_home(update: Update, context, household, new_status):
     """Смена статуса дома"""
-    query = update.callback_query
-    query.answer()
+    telegram = household.member_of(update.callback_query.from_user)
     
-    action = query.data
-    user = query.from_user
-    telegram = f"@{user.username}" if user.username else user.first_name
+    if telegram not in household.members:
+        return Reply("❌ Вы не участник!")
     
-    new_status = 0 if action == 'leave' else 1
     status_text = "уехал(а) ✈️" if new_status == 0 else "вернулся(ась) 🏠"
     
-    execute_query(
-        "UPDATE users SET is_home = ? WHERE telegram = ?",
-        (new_status, telegram)
-    )
+    await run_db(storage.set_home, household.id, telegram, new_status)
+    stats_cache.invalidate(household.id)
     
-    user_name = USERS[telegram]
-    query.edit_message_text(f"✅ {user_name} {status_text}!")
+    user_name = household.members[telegram]
+    return Reply(f"✅ {user_name} {status_text}!")
 
 # ==================== ПРАВИЛА ====================
-def show_rules(update: Update, context):
+async def show_rules(update: Update, context, household):
     """Показать полные правила"""
-    query = update.callback_query
-    query.answer()
-    
+    points_text = "".join(
+        f"• {task.capitalize()} → {info['points']} балл.\n" for task, info in household.tasks.items()
+    )
     rules_text = (
         "📋 *ПОЛНЫЕ ПРАВИЛА СИСТЕМЫ*\n\n"
         "🎯 *Логика распределения задач:*\n"
@@ -1190,70 +4025,52 @@ def show_rules(update: Update, context):
         "✅ *Подтверждение задач:*\n"
         "• Подтверждает 1 другой участник\n"
         "• Нельзя подтверждать свою задачу\n"
-        "• матрос (админ) может всё подтвердить\n\n"
+        f"• {household.admin_names() or 'Админ'} (админ) может всё подтвердить\n\n"
         "🍽️ *ПРАВИЛА ГОТОВКИ И ПОСУДЫ:*\n"
-        "1. *Готовил для всех:* +3 балла за готовку\n"
+        f"1. *Готовил для всех:* +{household.points('готовка', 3)} балла за готовку\n"
         "2. *Готовил для себя:* 0 баллов\n\n"
         "⚠️ *ШТРАФНАЯ СИСТЕМА:*\n"
         "• Не убрал за собой → -1 балл\n"
         "• Не сделал назначенное → -2 балла\n"
         "• Оставил мусор → -1 балл\n\n"
         "⚖️ *БАЛЛЬНАЯ СИСТЕМА:*\n"
-        "• Санузел → 4 балла\n"
-        "• Ванна → 3 балла\n"
-        "• Кухня → 3 балла\n"
-        "• Готовка для всех → 3 балла\n"
-        "• Коридор/пылесос/посуда → 2 балла\n"
-        "• Мусор → 1 балл\n"
+        f"{points_text}"
     )
     
     keyboard = [[InlineKeyboardButton("🏠 Главное меню", callback_data='main_menu')]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    query.edit_message_text(rules_text, parse_mode='Markdown', reply_markup=reply_markup)
+    return Reply(rules_text, parse_mode='Markdown', reply_markup=reply_markup)
 
 # ==================== АДМИНКА ====================
-def admin_panel(update: Update, context):
+async def admin_panel(update: Update, context, household):
     """Админ панель"""
-    query = update.callback_query
-    query.answer()
-    
-    user = query.from_user
-    telegram = f"@{user.username}" if user.username else user.first_name
-    
-    if not is_admin(telegram):
-        query.edit_message_text("❌ Нет доступа!")
-        return
+    telegram = household.member_of(update.callback_query.from_user)
     
-    keyboard = [
-        [InlineKeyboardButton("🗑️ СБРОСИТЬ ВСЕХ БАЛАНСЫ", callback_data='admin_reset_confirm')],
-        [InlineKeyboardButton("🏠 Главное меню", callback_data='main_menu')]
-    ]
+    if not household.is_admin(telegram):
+        return Reply("❌ Нет доступа!")
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = household.keyboards.get('admin')
     
-    query.edit_message_text(
+    return Reply(
         "⚙️ *АДМИН ПАНЕЛЬ*\n\n"
-        "🔴 СБРОС ВСЕХ БАЛАНСОВ\n"
+        "♻️ ПЕРЕСЧЁТ БАЛАНСОВ\n"
+        "   • Балансы заново по истории задач\n\n"
+        "🔴 ПОЛНЫЙ СБРОС\n"
         "   • Все балансы = 0\n"
-        "   • История задач сохраняется\n"
-        "   • Очередь задач сбрасывается\n\n"
-        "*ВНИМАНИЕ: Это необратимо!*",
+        "   • Очередь задач сбрасывается\n"
+        "   • История задач удаляется\n\n"
+        "*ВНИМАНИЕ: Сброс необратим!*",
         parse_mode='Markdown',
         reply_markup=reply_markup
     )
 
-def admin_reset_confirm(update: Update, context):
+async def admin_reset_confirm(update: Update, context, household):
     """Подтверждение сброса"""
-    query = update.callback_query
-    query.answer()
+    telegram = household.member_of(update.callback_query.from_user)
     
-    user = query.from_user
-    telegram = f"@{user.username}" if user.username else user.first_name
-    
-    if not is_admin(telegram):
-        query.edit_message_text("❌ Нет доступа!")
-        return
+    if not household.is_admin(telegram):
+        return Reply("❌ Нет доступа!")
     
     keyboard = [
         [InlineKeyboardButton("🔴 ДА, СБРОСИТЬ ВСЁ", callback_data='admin_reset_yes')],
@@ -1262,40 +4079,28 @@ def admin_reset_confirm(update: Update, context):
     
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    query.edit_message_text(
+    return Reply(
         "⚠️ *ПОДТВЕРЖДЕНИЕ СБРОСА*\n\n"
         "🗑️ Сбросит:\n"
         "• Все балансы = 0\n"
-        "• Очередь задач = пустая\n\n"
-        "*Это НЕ удалит историю задач!*\n\n"
+        "• Очередь задач = пустая\n"
+        "• История задач и штрафов удаляется\n\n"
         "*Ты уверен?*",
         parse_mode='Markdown',
         reply_markup=reply_markup
     )
 
-def admin_reset_yes(update: Update, context):
-    """Выполнить полный сброс"""
-    query = update.callback_query
-    query.answer()
-    
-    user = query.from_user
-    telegram = f"@{user.username}" if user.username else user.first_name
+async def admin_reset_yes(update: Update, context, household):
+    """Выполнить полный сброс квартиры"""
+    telegram = household.member_of(update.callback_query.from_user)
     
-    if not is_admin(telegram):
-        query.edit_message_text("❌ Нет доступа!")
-        return
-    
-    # ✅ 1. СБРОС ВСЕХ БАЛАНСОВ = 0
-    for tg in USERS.keys():
-        execute_query("UPDATE users SET balance = 0 WHERE telegram = ?", (tg,))
+    if not household.is_admin(telegram):
+        return Reply("❌ Нет доступа!")
     
-    # ✅ 2. ОЧИСТКА ТАБЛИЦЫ ОЧЕРЕДИ
-    execute_query("UPDATE queue SET last_user = 'никто', last_date = NULL")
+    await run_db(storage.reset_household, household.id)
+    stats_cache.invalidate(household.id)
     
-    # ✅ 3. ПОЛНАЯ ОЧИСТКА ИСТОРИИ ЗАДАЧ
-    execute_query("DELETE FROM tasks_done")
-    
-    query.edit_message_text(
+    return Reply(
         "✅ *ПОЛНЫЙ СБРОС ЗАВЕРШЁН!*\n\n"
         "🗑️ Удалено:\n"
         "• Все балансы = 0\n"
@@ -1308,92 +4113,815 @@ def admin_reset_yes(update: Update, context):
     )
 
 
-def admin_reset_no(update: Update, context):
+async def admin_reset_no(update: Update, context, household):
     """Отмена сброса"""
-    query = update.callback_query
-    query.answer()
-    admin_panel(update, context)
+    return await admin_panel(update, context, household)
+
+async def admin_recompute(update: Update, context, household):
+    """Пересчитать балансы из истории и показать расхождения"""
+    telegram = household.member_of(update.callback_query.from_user)
+    
+    if not household.is_admin(telegram):
+        return Reply("❌ Нет доступа!")
+    
+    mismatches = await run_db(storage.recompute_balances, household)
+    reply_markup = household.keyboards.get('admin')
+    
+    if not mismatches:
+        return Reply("✅ Балансы сходятся с историей.", reply_markup=reply_markup)
+    
+    stats_cache.invalidate(household.id)
+    lines = [
+        f"• {household.members.get(user_tg, user_tg)}: {before} → {after}"
+        for user_tg, before, after in mismatches
+    ]
+    return Reply(
+        f"♻️ Балансы пересчитаны, исправлено: {len(mismatches)}\n\n" + "\n".join(lines),
+        reply_markup=reply_markup
+    )
+
+async def command_household(update: Update):
+    """Квартира автора команды, если он в ней админ; иначе отвечает «Нет доступа» и возвращает None"""
+    user = update.effective_user
+    household = await households.resolve(update.effective_chat.id, user)
+    
+    if household is None or not household.is_admin(household.member_of(user)):
+        await update.message.reply_text("❌ Нет доступа!")
+        return None
+    # Дальнейшие run_db этого апдейта работают в базе квартиры
+    current_household.set(household.id)
+    return household
+
+async def operator_command(update: Update):
+    """Автор команды — оператор бота (OPERATOR_IDS); иначе отвечает «Нет доступа»"""
+    if update.effective_user.id in OPERATOR_IDS:
+        return True
+    await update.message.reply_text("❌ Нет доступа!")
+    return False
+
+async def rebuild_rotation_command(update: Update, context):
+    """/rebuild_rotation — пересобрать очередь квартиры из истории и показать расхождения"""
+    household = await command_household(update)
+    if household is None:
+        return
+    
+    mismatches = await run_db(storage.rebuild_rotation_state, household.id)
+    
+    if not mismatches:
+        await update.message.reply_text("✅ Очередь пересобрана, расхождений нет.")
+        return
+    
+    lines = [
+        f"• {task} / {user_tg}: {before or '—'} → {after or '—'}"
+        for task, user_tg, before, after in mismatches[:30]
+    ]
+    await update.message.reply_text(
+        f"⚠️ Очередь пересобрана, исправлено расхождений: {len(mismatches)}\n\n" + "\n".join(lines)
+    )
+
+async def archive_command(update: Update, context):
+    """/archive [дней] — перенести старые записи в архив сейчас"""
+    if not await operator_command(update):
+        return
+    
+    try:
+        after_days = int(context.args[0]) if context.args else ARCHIVE_AFTER_DAYS
+    except ValueError:
+        await update.message.reply_text("❌ Укажите число дней: /archive 180")
+        return
+    if after_days < ARCHIVE_MIN_DAYS:
+        await update.message.reply_text(f"❌ Не меньше {ARCHIVE_MIN_DAYS} дн.: /archive 180")
+        return
+    
+    moved = await run_db(storage.archive_history, after_days)
+    await update.message.reply_text(
+        f"🗄 Перенесено в архив: {moved} записей старше {after_days} дн."
+    )
+
+async def dbtop_command(update: Update, context):
+    """/dbtop [N | reset] — самые дорогие запросы по суммарному времени"""
+    if not await operator_command(update):
+        return
+    
+    if DB_BACKEND == 'postgres':
+        await update.message.reply_text("ℹ️ Профилирование запросов есть только у SQLite (DB_BACKEND=sqlite)")
+        return
+    
+    if not db_pool.profile:
+        await update.message.reply_text("ℹ️ Профилирование выключено, запустите бота с DB_PROFILE=1")
+        return
+    
+    if context.args and context.args[0] == 'reset':
+        profiler.reset()
+        await update.message.reply_text("🧹 Статистика запросов сброшена")
+        return
+    
+    try:
+        limit = int(context.args[0]) if context.args else 10
+    except ValueError:
+        await update.message.reply_text("❌ Использование: /dbtop [N | reset]")
+        return
+    
+    lines = [
+        f"{total:.0f} мс = {count} × {avg:.2f} мс (макс. {peak:.1f})\n{fp[:200]}"
+        for fp, count, total, avg, peak in profiler.top(limit)
+    ]
+    text = "🗃 Запросы по суммарному времени:\n\n" + ("\n\n".join(lines) or "Пока нет данных.")
+    await update.message.reply_text(text[:4000])
+
+# ==================== НАСТРОЙКА КВАРТИРЫ ====================
+# Правки состава и каталога сбрасывают кэш настроек квартиры и её статистики
+def household_changed(household_id):
+    households.invalidate(household_id)
+    stats_cache.invalidate(household_id)
+
+async def household_command(update: Update, context):
+    """/household — участники, админы и задачи квартиры"""
+    household = await command_household(update)
+    if household is None:
+        return
+    
+    members = "\n".join(
+        f"• {name} ({telegram}){' 👑' if household.is_admin(telegram) else ''}"
+        for telegram, name in household.members.items()
+    )
+    tasks = "\n".join(f"• {task} — {info['points']}" for task, info in household.tasks.items())
+    chat = household.chat_id if household.chat_id is not None else "не привязан (/bind)"
+    await update.message.reply_text(
+        f"🏠 {household.title} (#{household.id})\n"
+        f"💬 Чат: {chat}\n"
+        f"🔻 Баланс не ниже: {household.min_balance}\n\n"
+        f"👥 Участники:\n{members}\n\n"
+        f"📝 Задачи:\n{tasks}\n\n"
+        "Команды: /member_add @ник Имя [admin], /member_del @ник, "
+        "/task_set задача баллы [правило; правило], /task_del задача, /min_balance N, /bind"
+    )
+
+async def household_new_command(update: Update, context):
+    """/household_new Название — создать квартиру; автор команды становится её админом"""
+    user = update.effective_user
+    # Имя в Telegram бывает до 64 символов, а в кнопки уходит до CALLBACK_PART_BYTES байт
+    telegram = clip_for_callback_data(telegram_of(user))
+    name = clip_for_callback_data(user.first_name)
+    title = " ".join(context.args).strip()
+    
+    if not title:
+        await update.message.reply_text("❌ Использование: /household_new Название")
+        return
+    
+    # Групповой чат сразу привязывается к новой квартире
+    chat = update.effective_chat
+    chat_id = chat.id if chat.type != 'private' else None
+    
+    household_id = await run_db(storage.create_household, title, chat_id, user.id, telegram, name)
+    if household_id is None:
+        await update.message.reply_text("❌ Этот чат уже привязан к другой квартире")
+        return
+    household_changed(household_id)
+    await update.message.reply_text(
+        f"✅ Квартира «{title}» создана, вы в ней админ. Добавьте соседей: /member_add @ник Имя"
+    )
+
+async def bind_command(update: Update, context):
+    """/bind — привязать текущий групповой чат к квартире админа"""
+    household = await command_household(update)
+    if household is None:
+        return
+    
+    await run_db(storage.bind_chat, household.id, update.effective_chat.id)
+    households.invalidate()
+    await update.message.reply_text(f"✅ Этот чат теперь чат квартиры «{household.title}»")
+
+async def member_add_command(update: Update, context):
+    """/member_add @ник Имя [admin] — добавить участника или изменить его имя и роль"""
+    household = await command_household(update)
+    if household is None:
+        return
+    
+    args = list(context.args)
+    is_admin = bool(args) and args[-1] == 'admin'
+    if is_admin:
+        args.pop()
+    if len(args) < 2 or not args[0].startswith('@'):
+        await update.message.reply_text("❌ Использование: /member_add @ник Имя [admin]")
+        return
+    telegram, name = args[0], " ".join(args[1:])
+    if not fits_callback_data(telegram) or not fits_callback_data(name):
+        await update.message.reply_text(f"❌ Ник и имя — не длиннее {CALLBACK_PART_BYTES} байт (они уходят в кнопки)")
+        return
+    
+    await run_db(storage.add_member, household.id, telegram, name, is_admin)
+    household_changed(household.id)
+    await update.message.reply_text(f"✅ {name} ({telegram}) в квартире{' 👑' if is_admin else ''}")
+
+async def member_del_command(update: Update, context):
+    """/member_del @ник — убрать участника (его история остаётся)"""
+    household = await command_household(update)
+    if household is None:
+        return
+    
+    telegram = context.args[0] if context.args else ''
+    if telegram == household.member_of(update.effective_user):
+        await update.message.reply_text("❌ Себя удалить нельзя")
+        return
+    
+    if not await run_db(storage.remove_member, household.id, telegram):
+        await update.message.reply_text("❌ Участник не найден")
+        return
+    household_changed(household.id)
+    await update.message.reply_text(f"✅ {telegram} больше не в квартире")
+
+async def task_set_command(update: Update, context):
+    """/task_set задача баллы [правило; правило] — добавить или изменить задачу"""
+    household = await command_household(update)
+    if household is None:
+        return
+    
+    try:
+        task, points = context.args[0].lower(), int(context.args[1])
+    except (IndexError, ValueError):
+        await update.message.reply_text("❌ Использование: /task_set задача баллы [правило; правило]")
+        return
+    if not fits_callback_data(task):
+        await update.message.reply_text("❌ Слишком длинное название задачи")
+        return
+    rules = "\n".join(
+        f"• {rule.strip()}" for rule in " ".join(context.args[2:]).split(';') if rule.strip()
+    )
+    
+    await run_db(storage.save_task, household.id, task, points, rules)
+    household_changed(household.id)
+    await update.message.reply_text(f"✅ Задача «{task}»: {points} балл.")
+
+async def task_del_command(update: Update, context):
+    """/task_del задача — убрать задачу из каталога (история остаётся)"""
+    household = await command_household(update)
+    if household is None:
+        return
+    
+    task = context.args[0].lower() if context.args else ''
+    
+    if not await run_db(storage.delete_task, household.id, task):
+        await update.message.reply_text("❌ Задача не найдена")
+        return
+    household_changed(household.id)
+    await update.message.reply_text(f"✅ Задача «{task}» удалена")
+
+async def min_balance_command(update: Update, context):
+    """/min_balance N — минимальный баланс квартиры"""
+    household = await command_household(update)
+    if household is None:
+        return
+    
+    try:
+        value = int(context.args[0])
+    except (IndexError, ValueError):
+        await update.message.reply_text("❌ Использование: /min_balance -10")
+        return
+    
+    await run_db(storage.set_min_balance, household.id, value)
+    household_changed(household.id)
+    await update.message.reply_text(f"✅ Баланс не ниже: {value}")
+
+# ==================== МАРШРУТИЗАЦИЯ КНОПОК ====================
+class Route:
+    """Маршрут callback_data: обработчик, разбор аргументов и счётчики"""
+
+    __slots__ = ('name', 'handler', 'parse', 'args', 'hits', 'errors', 'total_time', 'max_time')
+
+    def __init__(self, name, handler, parse=None, args=()):
+        self.name = name
+        self.handler = handler
+        self.parse = parse
+        self.args = args
+        self.hits = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+
+class CallbackRouter:
+    """Точные callback_data ищутся в dict, префиксы — в префиксном дереве.
+
+    Аргументы разбираются один раз в resolve() и передаются обработчику.
+    """
+
+    def __init__(self):
+        self._exact = {}
+        self._trie = {}
+        self.routes = []
+
+    def exact(self, data, handler, *args):
+        """Маршрут для точного значения callback_data с фиксированными аргументами"""
+        route = Route(data, handler, args=args)
+        self._exact[data] = route
+        self.routes.append(route)
+
+    def prefix(self, prefix, handler, parse=lambda rest: (rest,)):
+        """Маршрут по префиксу; parse(остаток) → кортеж аргументов или ValueError"""
+        node = self._trie
+        for char in prefix:
+            node = node.setdefault(char, {})
+        route = Route(prefix + '*', handler, parse=parse)
+        node[None] = route
+        self.routes.append(route)
+
+    def resolve(self, data):
+        """(маршрут, аргументы) или (None, None); ValueError — если аргументы не разобрались"""
+        route = self._exact.get(data)
+        if route is not None:
+            return route, route.args
+        
+        # Самый длинный зарегистрированный префикс
+        node, found, found_at = self._trie, None, 0
+        for i, char in enumerate(data):
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                found, found_at = node[None], i + 1
+        if found is None:
+            return None, None
+        return found, found.parse(data[found_at:])
+
+    async def dispatch(self, route, update, context, household, args):
+        """Вызвать обработчик маршрута для квартиры, учитывая время; возвращает его Reply"""
+        started = time.perf_counter()
+        try:
+            return await route.handler(update, context, household, *args)
+        except Exception:
+            route.errors += 1
+            metrics.callback_errors.inc(route.name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.callback_seconds.observe(elapsed, route.name)
+            route.hits += 1
+            route.total_time += elapsed
+            route.max_time = max(route.max_time, elapsed)
+
+    def stats(self):
+        """[(маршрут, вызовов, ошибок, среднее мс, максимум мс)] по убыванию суммарного времени"""
+        return [
+            (r.name, r.hits, r.errors,
+             r.total_time / r.hits * 1000 if r.hits else 0.0, r.max_time * 1000)
+            for r in sorted(self.routes, key=lambda r: r.total_time, reverse=True)
+        ]
+
+
+def parse_confirm(rest):
+    """confirm_<id>_<имя подтверждающего>"""
+    task_id, confirmer = rest.split('_', 1)
+    return int(task_id), confirmer
+
+def parse_history(rest):
+    """uh_<tg>_<фильтр>_<n|p>_<курсор>"""
+    user_tg, filter_code, direction, cursor = rest.rsplit('_', 3)
+    if direction not in ('n', 'p'):
+        raise ValueError(direction)
+    return user_tg, filter_code, direction, cursor
+
+def parse_int(rest):
+    return (int(rest),)
+
+
+callback_router = CallbackRouter()
+callback_router.exact('main_menu', show_main_menu)
+callback_router.exact('menu_who', menu_who)
+callback_router.exact('who_overview', show_who_overview)
+callback_router.prefix('who_', process_who)
+callback_router.exact('menu_did', menu_did)
+callback_router.prefix('did_', process_did)
+callback_router.prefix('confirm_', process_confirmation, parse_confirm)
+callback_router.prefix('cancel_', cancel_task, parse_int)
+callback_router.exact('menu_food', menu_food)
+callback_router.exact('cooked_all', cooked_all)
+callback_router.prefix('dishes_', dishes_after_cooking, parse_int)
+callback_router.exact('washed_dishes', washed_dishes)
+callback_router.exact('menu_penalty', menu_penalty)
+for penalty_type in ('penalty_mess', 'penalty_task', 'penalty_trash'):
+    callback_router.exact(penalty_type, penalty_type_selected, penalty_type)
+callback_router.prefix('penalty_user_', create_penalty)
+callback_router.exact('stats', show_stats)
+callback_router.exact('stats_refresh', refresh_stats)
+callback_router.prefix('user_stats_', show_user_stats)
+callback_router.prefix('uh_', show_user_stats, parse_history)
+callback_router.prefix('uhf_', menu_history_task_filter)
+callback_router.exact('menu_home', menu_home)
+callback_router.exact('leave', toggle_home, 0)
+callback_router.exact('return', toggle_home, 1)
+callback_router.exact('rules', show_rules)
+callback_router.exact('admin_panel', admin_panel)
+callback_router.exact('admin_reset_confirm', admin_reset_confirm)
+callback_router.exact('admin_reset_yes', admin_reset_yes)
+callback_router.exact('admin_reset_no', admin_reset_no)
+callback_router.exact('admin_recompute', admin_recompute)
+
+async def routes_command(update: Update, context):
+    """/routes — статистика обработчиков кнопок"""
+    if not await operator_command(update):
+        return
+    
+    lines = [
+        f"{name}: {hits} выз., {errors} ош., ср. {avg:.1f} мс, макс. {peak:.1f} мс"
+        for name, hits, errors, avg, peak in callback_router.stats()
+        if hits
+    ]
+    await update.message.reply_text("📈 Обработчики кнопок:\n\n" + ("\n".join(lines) or "Пока нет вызовов."))
 
 # ==================== ГЛАВНЫЙ ОБРАБОТЧИК КНОПОК ====================
-def button_handler(update: Update, context):
-    """Общий обработчик всех кнопок"""
+async def button_handler(update: Update, context):
+    """Общий обработчик всех кнопок.
+
+    Владеет жизненным циклом callback: отвечает на него ровно один раз
+    (сразу, чтобы у пользователя пропали «часики»), один раз определяет
+    квартиру, вызывает обработчик маршрута и применяет его Reply одной
+    правкой сообщения.
+    """
     query = update.callback_query
-    query.answer()
+    await timed_api_call('answerCallbackQuery', query.answer)
+    
+    try:
+        route, args = callback_router.resolve(query.data)
+    except ValueError:
+        await send_reply(query, Reply("❌ Ошибка данных"))
+        return
     
-    data = query.data
+    if route is None:
+        await send_reply(query, Reply("❌ Неизвестная команда!"))
+        return
     
     try:
-        if data == 'main_menu':
-            show_main_menu(update, context)
-        elif data == 'menu_who':
-            menu_who(update, context)
-        elif data.startswith('who_'):
-            process_who(update, context)
-        elif data == 'menu_did':
-            menu_did(update, context)
-        elif data.startswith('did_'):
-            process_did(update, context)
-        elif data.startswith('confirm_'):
-            process_confirmation(update, context)
-        elif data.startswith('cancel_'):
-            cancel_task(update, context)
-        elif data == 'menu_food':
-            menu_food(update, context)
-        elif data == 'cooked_all':
-            cooked_all(update, context)
-        elif data.startswith('dishes_'):
-            dishes_after_cooking(update, context)
-        elif data == 'washed_dishes':
-            washed_dishes(update, context)
-        elif data == 'menu_penalty':
-            menu_penalty(update, context)
-        elif data in ['penalty_mess', 'penalty_task', 'penalty_trash']:
-            penalty_type_selected(update, context)
-        elif data.startswith('penalty_user_'):
-            create_penalty(update, context)
-        elif data == 'stats':
-            show_stats(update, context)
-        elif data == 'stats_refresh':
-            refresh_stats(update, context)
-        elif data.startswith('user_stats_'):
-            show_user_stats(update, context)
-        elif data == 'menu_home':
-            menu_home(update, context)
-        elif data in ['leave', 'return']:
-            toggle_home(update, context)
-        elif data == 'rules':
-            show_rules(update, context)
-        elif data == 'admin_panel':
-            admin_panel(update, context)
-        elif data == 'admin_reset_confirm':
-            admin_reset_confirm(update, context)
-        elif data == 'admin_reset_yes':
-            admin_reset_yes(update, context)
-        elif data == 'admin_reset_no':
-            admin_reset_no(update, context)
-        else:
-            query.edit_message_text("❌ Неизвестная команда!")
+        chat_id = query.message.chat_id if query.message else query.from_user.id
+        household = await households.resolve(chat_id, query.from_user)
+        if household is None:
+            await send_reply(query, Reply("❌ Вы не участник системы!"))
+            return
+        # Дальнейшие run_db этого апдейта работают в базе квартиры
+        current_household.set(household.id)
+        
+        reply = await callback_router.dispatch(route, update, context, household, args)
+        await send_reply(query, reply)
     except Exception as e:
         print(f"❌ Ошибка обработчика: {e}")
-        query.edit_message_text("❌ Произошла ошибка! Попробуйте позже.")
+        await send_reply(query, Reply("❌ Произошла ошибка! Попробуйте позже."))
+
+# ==================== ПРОЦЕССЫ ====================
+# WORKERS > 0: этот процесс — супервизор. Он получает апдейты (polling или
+# webhook) и раздаёт их WORKERS рабочим процессам bot.py по хэшу чата, так
+# что апдейты одного чата всегда обрабатывает один процесс и по порядку.
+# Рабочий процесс читает апдейты из stdin (JSON в строке) и отвечает в Telegram
+# сам; его health и метрики на 127.0.0.1:WORKER_PORT_BASE + номер супервизор
+# собирает на своём PORT
+WORKER_PORT_BASE = int(os.getenv("WORKER_PORT_BASE", int(os.getenv("PORT", 10000)) + 1))
+# Сколько ждать рабочие процессы при остановке, секунд
+WORKER_STOP_TIMEOUT = float(os.getenv("WORKER_STOP_TIMEOUT", 10))
+
+def chat_key(update):
+    """Чат апдейта (для апдейтов без чата — пользователь)"""
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return 0
+
+def worker_of(chat_id, workers=WORKERS):
+    return hash(chat_id) % workers
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Апдейты разных чатов обрабатываются параллельно, одного чата — по очереди.
+
+    Задачи создаются в порядке поступления апдейтов, а asyncio.Lock пускает
+    ждущих в порядке очереди, так что порядок внутри чата сохраняется.
+
+    PTB занимает свой семафор до вызова do_process_update, и апдейт, ждущий
+    блокировку своего чата, держал бы место, нужное другим чатам. Поэтому
+    семафор PTB фактически без предела, а max_concurrent_updates ограничивает
+    свой семафор, который берётся уже под блокировкой чата.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(sys.maxsize)
+        self._running = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._chats = {}  # чат → [Lock, сколько апдейтов ждёт или выполняется]
+
+    async def do_process_update(self, update, coroutine):
+        chat_id = chat_key(update) if isinstance(update, Update) else None
+        entry = self._chats.setdefault(chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0], self._running:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[chat_id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+def merge_metrics(texts):
+    """Тексты /metrics нескольких процессов → один; ряды рабочих процессов получают метку worker"""
+    families = OrderedDict()  # метрика → (строки HELP/TYPE, ряды)
+    for worker, text in texts:
+        family = None
+        for line in text.splitlines():
+            if line.startswith('# '):
+                family = line.split()[2]
+                meta, _ = families.setdefault(family, ([], []))
+                if line not in meta:
+                    meta.append(line)
+            elif line and family is not None:
+                name, value = line.rsplit(' ', 1)
+                if worker is not None:
+                    label = f'worker="{worker}"'
+                    name = name.replace('{', '{' + label + ',', 1) if '{' in name else f'{name}{{{label}}}'
+                families[family][1].append(f"{name} {value}")
+    lines = []
+    for meta, samples in families.values():
+        lines += meta + samples
+    return '\n'.join(lines) + '\n'
+
+
+class WorkerPool:
+    """Рабочие процессы супервизора: запуск, перезапуск упавших и раздача апдейтов"""
+
+    def __init__(self, count=WORKERS, port_base=WORKER_PORT_BASE):
+        self.count = count
+        self.ports = [port_base + index for index in range(count)]
+        self.forwarded = [0] * count
+        self.dropped = [0] * count
+        self.restarts = [0] * count
+        self._procs = [None] * count
+        self._watchers = []
+        self._stopping = False
+
+    async def start(self):
+        for index in range(self.count):
+            await self._spawn(index)
+        self._watchers = [asyncio.create_task(self._watch(index)) for index in range(self.count)]
+        logging.info(f"👷 Рабочих процессов: {self.count}, порты {self.ports[0]}–{self.ports[-1]}")
+
+    async def _spawn(self, index):
+        env = dict(os.environ, WORKER_INDEX=str(index), PORT=str(self.ports[index]))
+        self._procs[index] = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), env=env, stdin=asyncio.subprocess.PIPE,
+        )
+
+    async def _watch(self, index):
+        """Перезапуск упавшего рабочего процесса; апдейты его чатов тем временем теряются"""
+        while True:
+            code = await self._procs[index].wait()
+            if self._stopping:
+                return
+            logging.error(f"💥 Рабочий процесс {index} завершился с кодом {code}, перезапуск")
+            self.restarts[index] += 1
+            await asyncio.sleep(1)
+            if self._stopping:
+                return
+            await self._spawn(index)
+
+    async def forward(self, update, context):
+        """Обработчик супервизора: апдейт уходит рабочему процессу своего чата.
+
+        Супервизор обрабатывает апдейты последовательно, а stdin — канал FIFO,
+        поэтому рабочий процесс получает апдейты чата в исходном порядке.
+        """
+        index = worker_of(chat_key(update), self.count)
+        line = json.dumps(update.to_dict(), ensure_ascii=False).encode() + b'\n'
+        try:
+            self._procs[index].stdin.write(line)
+            await self._procs[index].stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            self.dropped[index] += 1
+            logging.warning(f"⚠️ Рабочий процесс {index} недоступен, апдейт {update.update_id} потерян")
+            return
+        self.forwarded[index] += 1
+
+    async def stop(self):
+        """Закрыть stdin: рабочие процессы доделывают принятые апдейты и выходят"""
+        self._stopping = True
+        for proc in self._procs:
+            proc.stdin.close()
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(proc.wait() for proc in self._procs)), WORKER_STOP_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            for proc in self._procs:
+                if proc.returncode is None:
+                    proc.kill()
+        for watcher in self._watchers:
+            watcher.cancel()
+
+    def _fetch(self, index, path):
+        with urllib.request.urlopen(f"http://127.0.0.1:{self.ports[index]}{path}", timeout=2) as response:
+            return response.read().decode()
+
+    def check(self):
+        """Проверка готовности всех рабочих процессов (исключение — если кто-то не готов)"""
+        failed = []
+        for index in range(self.count):
+            try:
+                self._fetch(index, '/healthz')
+            except Exception as e:
+                failed.append(f"{index}: {e}")
+        if failed:
+            raise RuntimeError("workers " + "; ".join(failed))
+
+    def render_metrics(self, own):
+        """Метрики супервизора, его рабочих процессов (с меткой worker) и раздачи апдейтов"""
+        texts = [(None, own)]
+        up = []
+        for index in range(self.count):
+            try:
+                texts.append((index, self._fetch(index, '/metrics')))
+                up.append(1)
+            except Exception:
+                up.append(0)
+
+        lines = []
+        for name, help_text, values in (
+            ('fairflat_worker_up', 'Рабочий процесс отвечает', up),
+            ('fairflat_worker_updates_total', 'Апдейты, переданные рабочему процессу', self.forwarded),
+            ('fairflat_worker_dropped_total', 'Апдейты, потерянные из-за недоступного процесса', self.dropped),
+            ('fairflat_worker_restarts_total', 'Перезапуски рабочего процесса', self.restarts),
+        ):
+            kind = 'counter' if name.endswith('_total') else 'gauge'
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            lines += [f'{name}{{worker="{index}"}} {value}' for index, value in enumerate(values)]
+        texts.append((None, '\n'.join(lines)))
+        return merge_metrics(texts)
+
+
+def stop_event(signals=(signal.SIGINT, signal.SIGTERM)):
+    """Событие, которое выставляют сигналы остановки"""
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in signals:
+        loop.add_signal_handler(sig, stop.set)
+    return stop
+
+async def run_worker(application):
+    """Рабочий процесс: апдейты от супервизора из stdin, пока тот не закроет канал"""
+    loop = asyncio.get_running_loop()
+    # Ctrl+C в терминале получает вся группа процессов, а рабочий процесс
+    # останавливает супервизор, закрыв stdin
+    loop.add_signal_handler(signal.SIGINT, lambda: None)
+    stop = stop_event((signal.SIGTERM,))
+    reader = asyncio.StreamReader(limit=2 * WEBHOOK_MAX_BODY)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+
+    async with application:
+        await application.start()
+        server = make_http_server(application, host="127.0.0.1")
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        read = asyncio.ensure_future(reader.readline())
+        stopping = asyncio.ensure_future(stop.wait())
+        while True:
+            await asyncio.wait((read, stopping), return_when=asyncio.FIRST_COMPLETED)
+            if stopping.done():
+                read.cancel()
+                break
+            line = read.result()
+            if not line:
+                stopping.cancel()
+                break
+            await application.update_queue.put(Update.de_json(json.loads(line), application.bot))
+            read = asyncio.ensure_future(reader.readline())
+
+        server.shutdown()
+        await application.stop()
+
+async def run_supervisor(application, pool):
+    """Супервизор: получает апдейты и раздаёт их рабочим процессам"""
+    stop = stop_event()
+    await pool.start()
+
+    async with application:
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                WEBHOOK_URL + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+            )
+            server = make_http_server(application, asyncio.get_running_loop())
+        else:
+            await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+            server = make_http_server(application)
+        await application.start()
+        server.workers = pool
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        await stop.wait()
+
+        server.shutdown()
+        if application.updater.running:
+            await application.updater.stop()
+        await application.stop()
+    await pool.stop()
 
 # ==================== ЗАПУСК БОТА ====================
+async def run_webhook(application):
+    """Режим webhook: апдейты принимает тот же HTTP-сервер, что отвечает на health check"""
+    loop = asyncio.get_running_loop()
+    stop = stop_event()
+    
+    async with application:
+        await application.bot.set_webhook(
+            WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        await application.start()
+        
+        server = make_http_server(application, loop)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info(f"🌐 Webhook: {WEBHOOK_URL}{WEBHOOK_PATH}")
+        
+        await stop.wait()
+        
+        server.shutdown()
+        await application.stop()
+
+def application_builder():
+    """Builder приложения с токеном и адресом Bot API"""
+    builder = Application.builder().token(TOKEN)
+    if TELEGRAM_BASE_URL:
+        builder = (
+            builder
+            .base_url(f"{TELEGRAM_BASE_URL}/bot")
+            .base_file_url(f"{TELEGRAM_BASE_URL}/file/bot")
+        )
+    return builder
+
+def add_handlers(application):
+    application.add_handler(CommandHandler('start', start))
+    application.add_handler(CommandHandler('help', help_command))
+    application.add_handler(CommandHandler('rebuild_rotation', rebuild_rotation_command))
+    application.add_handler(CommandHandler('archive', archive_command))
+    application.add_handler(CommandHandler('routes', routes_command))
+    application.add_handler(CommandHandler('dbtop', dbtop_command))
+    application.add_handler(CommandHandler('household', household_command))
+    application.add_handler(CommandHandler('household_new', household_new_command))
+    application.add_handler(CommandHandler('bind', bind_command))
+    application.add_handler(CommandHandler('member_add', member_add_command))
+    application.add_handler(CommandHandler('member_del', member_del_command))
+    application.add_handler(CommandHandler('task_set', task_set_command))
+    application.add_handler(CommandHandler('task_del', task_del_command))
+    application.add_handler(CommandHandler('min_balance', min_balance_command))
+    application.add_handler(CallbackQueryHandler(button_handler))
+
 def main():
     """Запуск бота"""
-    init_db()
+    storage.init()
+    
+    if WORKER_INDEX is not None:
+        # Рабочий процесс: апдейты только от супервизора, архив ведёт супервизор
+        application = (
+            application_builder().updater(None)
+            .concurrent_updates(ChatOrderedUpdateProcessor(CONCURRENT_UPDATES))
+            .build()
+        )
+        add_handlers(application)
+        logging.info(f"👷 Рабочий процесс {WORKER_INDEX} запущен")
+        asyncio.run(run_worker(application))
+        db_executor.shutdown()
+        return
     
-    updater = Updater(TOKEN, use_context=True)
-    dp = updater.dispatcher
-
-    dp.add_handler(CommandHandler('start', start))
-    dp.add_handler(CommandHandler('help', help_command))
-    dp.add_handler(CallbackQueryHandler(button_handler))
+    if WORKERS > 0:
+        # Супервизор обрабатывает апдейты по одному, чтобы порядок в чате сохранился
+        if shards:
+            shards.create_all()
+        application = application_builder().concurrent_updates(False).build()
+        pool = WorkerPool()
+        application.add_handler(TypeHandler(Update, pool.forward))
+    else:
+        application = (
+            application_builder()
+            .concurrent_updates(ChatOrderedUpdateProcessor(CONCURRENT_UPDATES))
+            .build()
+        )
+        add_handlers(application)
+    
+    application.job_queue.run_repeating(archive_job, interval=24 * 60 * 60, first=10 * 60)
 
     logging.info("🚀 Бот запущен!")
-    updater.start_polling()
-    updater.idle()
+    if WORKERS > 0:
+        asyncio.run(run_supervisor(application, pool))
+    elif WEBHOOK_URL:
+        asyncio.run(run_webhook(application))
+    else:
+        threading.Thread(target=run_http_server, args=(application,), daemon=True).start()
+        application.run_polling()
+    db_executor.shutdown()
 
 
 if __name__ == "__main__":
-    threading.Thread(target=run_http_server, daemon=True).start()
     main()
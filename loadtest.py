@@ -0,0 +1,396 @@
+"""Нагрузочный тест: локальный заглушечный Bot API и виртуальные участники.
+
+Поднимает на 127.0.0.1 подмену Telegram Bot API (getMe, getUpdates,
+answerCallbackQuery, editMessageText, sendMessage, ...), запускает bot.py
+без изменений с TELEGRAM_BASE_URL на неё и моделирует много чатов, в которых
+участники одновременно жмут кнопки. Каждый виртуальный участник отправляет
+/start, затем ходит по меню: жмёт случайную кнопку из последней клавиатуры и
+ждёт правку сообщения. Апдейты идут через getUpdates, то есть через тот же
+run_polling и button_handler, что подключает main().
+
+    python loadtest.py --clients 300 --duration 30
+    python loadtest.py --no-spawn --port 8081   # бот запущен вручную
+    python loadtest.py --global-rate 10000 --chat-rate 10000 --chat-burst 100  # без лимитов Bot API
+    WORKERS=4 python loadtest.py --clients 300  # супервизор и 4 рабочих процесса
+
+В отчёте — лимиты Bot API, с которыми запущен бот, апдейтов в секунду,
+задержка от выдачи апдейта до правки (p50/p95/p99), потерянные и лишние
+правки, ответы на callback не ровно по одному и вызовы Bot API по методам.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, deque
+from urllib.parse import parse_qsl, urlsplit
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'FairFlat', 'username': 'fairflat_bot'}
+
+# Кнопки, которые не трогаем: полный сброс стирает данные посреди теста, а
+# повторная сверка балансов даёт тот же текст, и правки (по праву) не будет
+SKIP_CALLBACKS = ('admin_reset_', 'admin_recompute')
+
+
+# ==================== ЗАГЛУШКА BOT API ====================
+class FakeBotAPI:
+    """Состояние «сервера Telegram»: очередь апдейтов и сообщения чатов"""
+
+    def __init__(self):
+        self.updates = deque()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.callback_ids = itertools.count(1)
+        self.new_update = asyncio.Event()
+        self.calls = Counter()
+        self.messages = {}
+        # Кто ждёт правку: (chat_id, message_id) → future
+        self.waiters = {}
+        self.answers = Counter()
+        self.extra_edits = 0
+        self.polled = asyncio.Event()
+
+    # --- апдейты ---
+    def push(self, **payload):
+        payload['update_id'] = next(self.update_ids)
+        payload['_queued_at'] = time.perf_counter()
+        self.updates.append(payload)
+        self.new_update.set()
+
+    async def get_updates(self, params):
+        self.polled.set()
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', 100))
+        timeout = float(params.get('timeout', 0))
+        # offset подтверждает всё, что раньше
+        while self.updates and self.updates[0]['update_id'] < offset:
+            self.updates.popleft()
+        if not self.updates and timeout:
+            self.new_update.clear()
+            try:
+                await asyncio.wait_for(self.new_update.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return [
+            {k: v for k, v in update.items() if not k.startswith('_')}
+            for update in itertools.islice(self.updates, limit)
+        ]
+
+    # --- сообщения ---
+    def message(self, chat_id, message_id, text, reply_markup=None, user=None):
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': user or BOT_USER,
+            'text': text,
+        }
+        if reply_markup:
+            message['reply_markup'] = reply_markup
+        return message
+
+    def send_message(self, params):
+        chat_id = int(params['chat_id'])
+        message = self.message(
+            chat_id, next(self.message_ids), params.get('text', ''),
+            json.loads(params['reply_markup']) if 'reply_markup' in params else None
+        )
+        self.messages[(chat_id, message['message_id'])] = message
+        self._deliver(('chat', chat_id), message)
+        return message
+
+    def edit_message(self, params):
+        key = (int(params['chat_id']), int(params['message_id']))
+        message = self.messages.get(key)
+        if message is None:
+            raise LookupError('message to edit not found')
+        if 'text' in params:
+            message['text'] = params['text']
+        if 'reply_markup' in params:
+            message['reply_markup'] = json.loads(params['reply_markup'])
+        else:
+            message.pop('reply_markup', None)
+        if not self._deliver(key, message):
+            # Правка, которую никто не ждал: дубль или запоздавшая
+            self.extra_edits += 1
+        return message
+
+    def answer_callback(self, params):
+        self.answers[params['callback_query_id']] += 1
+        return True
+
+    def _deliver(self, key, message):
+        future = self.waiters.pop(key, None)
+        if future is None or future.done():
+            return False
+        future.set_result(message)
+        return True
+
+    async def dispatch(self, method, params):
+        self.calls[method] += 1
+        if method == 'getUpdates':
+            return await self.get_updates(params)
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'sendMessage':
+            return self.send_message(params)
+        if method in ('editMessageText', 'editMessageReplyMarkup'):
+            return self.edit_message(params)
+        if method == 'answerCallbackQuery':
+            return self.answer_callback(params)
+        # deleteWebhook, setWebhook, close и прочее — просто «ок»
+        return True
+
+
+async def serve_api(api, host, port):
+    """Минимальный HTTP/1.1-сервер с keep-alive: POST /bot<token>/<метод>"""
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, target, _ = request_line.decode().split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode().partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                url = urlsplit(target)
+                method = url.path.rsplit('/', 1)[-1]
+                params = dict(parse_qsl(url.query))
+                if body:
+                    if headers.get('content-type', '').startswith('application/json'):
+                        params.update(json.loads(body))
+                    else:
+                        params.update(parse_qsl(body.decode()))
+                try:
+                    payload = {'ok': True, 'result': await api.dispatch(method, params)}
+                    status = 200
+                except LookupError as e:
+                    payload = {'ok': False, 'error_code': 400, 'description': f'Bad Request: {e}'}
+                    status = 400
+
+                data = json.dumps(payload, ensure_ascii=False).encode()
+                writer.write(
+                    f'HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n'
+                    f'Content-Length: {len(data)}\r\nConnection: keep-alive\r\n\r\n'.encode() + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port, limit=2 ** 20)
+
+
+# ==================== ВИРТУАЛЬНЫЕ УЧАСТНИКИ ====================
+class Client:
+    """Участник в своём чате: /start, потом случайные кнопки по порядку.
+
+    Клиентов больше, чем участников, поэтому у одного участника (user id)
+    бывает несколько чатов.
+    """
+
+    def __init__(self, api, chat_id, user_id, username, rnd, stats, think, edit_timeout):
+        self.api = api
+        self.chat_id = chat_id
+        self.user = {'id': user_id, 'is_bot': False, 'first_name': username, 'username': username.lstrip('@')}
+        self.rnd = rnd
+        self.stats = stats
+        self.think = think
+        self.edit_timeout = edit_timeout
+
+    def _expect(self, key):
+        future = asyncio.get_running_loop().create_future()
+        self.api.waiters[key] = future
+        return future
+
+    async def start(self):
+        future = self._expect(('chat', self.chat_id))
+        self.api.push(message={
+            'message_id': next(self.api.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': self.chat_id, 'type': 'private'},
+            'from': self.user,
+            'text': '/start',
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+        })
+        return await asyncio.wait_for(future, self.edit_timeout)
+
+    async def press(self, message):
+        buttons = [
+            button['callback_data']
+            for row in message.get('reply_markup', {}).get('inline_keyboard', [])
+            for button in row
+            if not button['callback_data'].startswith(SKIP_CALLBACKS)
+        ]
+        data = self.rnd.choice(buttons) if buttons else 'main_menu'
+        key = (self.chat_id, message['message_id'])
+        callback_id = str(next(self.api.callback_ids))
+
+        future = self._expect(key)
+        queued_at = time.perf_counter()
+        self.api.push(callback_query={
+            'id': callback_id,
+            'from': self.user,
+            'chat_instance': str(self.chat_id),
+            'data': data,
+            'message': message,
+        })
+        try:
+            edited = await asyncio.wait_for(future, self.edit_timeout)
+        except asyncio.TimeoutError:
+            self.api.waiters.pop(key, None)
+            self.stats['lost'] += 1
+            return message
+        self.stats['latencies'].append(time.perf_counter() - queued_at)
+        self.stats['answers'].append(callback_id)
+        if edited.get('text', '').startswith('❌ Произошла ошибка'):
+            self.stats['errors'] += 1
+        return edited
+
+    async def run(self, until):
+        try:
+            message = await self.start()
+        except asyncio.TimeoutError:
+            self.stats['lost'] += 1
+            return
+        while time.perf_counter() < until:
+            message = await self.press(message)
+            if self.think:
+                await asyncio.sleep(self.rnd.expovariate(1 / self.think))
+
+
+# ==================== ЗАПУСК ====================
+def rate_limits(args):
+    """Лимиты исходящих запросов бота для отчёта и окружения: {переменная: значение}"""
+    return {
+        'TG_GLOBAL_RATE': args.global_rate,
+        'TG_CHAT_RATE': args.chat_rate,
+        'TG_CHAT_BURST': args.chat_burst,
+    }
+
+async def spawn_bot(port, health_port, workdir, limits):
+    env = dict(os.environ)
+    env.update({
+        'BOT_TOKEN': env.get('BOT_TOKEN', '1:loadtest'),
+        'TELEGRAM_BASE_URL': f'http://127.0.0.1:{port}',
+        'DATABASE': env.get('DATABASE', os.path.join(workdir, 'loadtest.db')),
+        'PORT': str(health_port),
+        **{name: str(value) for name, value in limits.items()},
+    })
+    env.pop('WEBHOOK_URL', None)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')
+    # Вывод бота (и трассировки рабочих процессов) — в bot.log рядом с базой
+    with open(os.path.join(workdir, 'bot.log'), 'w') as log:
+        return await asyncio.create_subprocess_exec(
+            sys.executable, script, env=env, stdout=log, stderr=asyncio.subprocess.STDOUT,
+        )
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))] * 1000 if values else 0.0
+
+async def run(args):
+    api = FakeBotAPI()
+    server = await serve_api(api, '127.0.0.1', args.port)
+    workdir = tempfile.mkdtemp(prefix='fairflat-load-')
+    bot_process = None
+    if not args.no_spawn:
+        bot_process = await spawn_bot(args.port, args.health_port, workdir, rate_limits(args))
+    try:
+        await asyncio.wait_for(api.polled.wait(), args.startup_timeout)
+    except asyncio.TimeoutError:
+        raise SystemExit(f"❌ Бот не начал опрос getUpdates, см. {workdir}/bot.log")
+
+    rnd = random.Random(args.seed)
+    stats = {'latencies': [], 'answers': [], 'lost': 0, 'errors': 0}
+    usernames = args.usernames.split(',')
+    started = time.perf_counter()
+    until = started + args.duration
+    clients = [
+        Client(api, 10_000 + i, 1_000 + i % len(usernames), usernames[i % len(usernames)],
+               random.Random(rnd.random()), stats, args.think, args.edit_timeout)
+        for i in range(args.clients)
+    ]
+    await asyncio.gather(*(client.run(until) for client in clients))
+    elapsed = time.perf_counter() - started
+
+    # Запоздавшие правки ещё могут прийти — даём им шанс попасть в «лишние»
+    await asyncio.sleep(1)
+    if bot_process is not None:
+        bot_process.terminate()
+        await bot_process.wait()
+    server.close()
+
+    latencies = sorted(stats['latencies'])
+    answered = Counter(api.answers)
+    report = {
+        'clients': args.clients,
+        # Внешнему боту (--no-spawn) лимиты не передаются
+        'rate_limits': None if args.no_spawn else rate_limits(args),
+        'duration_s': round(elapsed, 2),
+        'presses': len(latencies),
+        'updates_per_s': round(len(latencies) / elapsed, 1),
+        'latency_ms': {
+            'p50': round(percentile(latencies, 0.50), 2),
+            'p95': round(percentile(latencies, 0.95), 2),
+            'p99': round(percentile(latencies, 0.99), 2),
+        },
+        'lost_edits': stats['lost'],
+        'extra_edits': api.extra_edits,
+        'error_replies': stats['errors'],
+        'callbacks_not_answered_once': sum(
+            1 for callback_id in stats['answers'] if answered[callback_id] != 1
+        ),
+        'api_calls': dict(api.calls),
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+def default_usernames():
+    os.environ.setdefault('BOT_TOKEN', '1:loadtest')
+    import bot
+    return ','.join(bot.DEFAULT_USERS)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=100, help='виртуальных участников (чатов)')
+    parser.add_argument('--duration', type=float, default=20, help='секунд нагрузки')
+    parser.add_argument('--think', type=float, default=0.5, help='средняя пауза между нажатиями, с')
+    parser.add_argument('--edit-timeout', type=float, default=10, help='сколько ждать правку, с')
+    parser.add_argument('--usernames', help='логины участников через запятую (по умолчанию участники квартиры 1)')
+    # По умолчанию — лимиты Telegram, как у бота; с большими значениями
+    # замеряется сам бот, а не ожидание в ограничителе
+    parser.add_argument('--global-rate', type=float, default=float(os.getenv('TG_GLOBAL_RATE', 30)),
+                        help='TG_GLOBAL_RATE бота, запросов в секунду')
+    parser.add_argument('--chat-rate', type=float, default=float(os.getenv('TG_CHAT_RATE', 1)),
+                        help='TG_CHAT_RATE бота, запросов в секунду на чат')
+    parser.add_argument('--chat-burst', type=int, default=int(os.getenv('TG_CHAT_BURST', 3)),
+                        help='TG_CHAT_BURST бота')
+    parser.add_argument('--port', type=int, default=8081, help='порт заглушки Bot API')
+    parser.add_argument('--health-port', type=int, default=18080, help='PORT health-сервера бота')
+    parser.add_argument('--no-spawn', action='store_true', help='не запускать bot.py, ждать внешний')
+    parser.add_argument('--startup-timeout', type=float, default=30)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', help='сохранить отчёт в JSON')
+    args = parser.parse_args()
+    args.usernames = args.usernames or default_usernames()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Разбиение единой базы бота по шардам квартир.
+
+Основная база (DATABASE) остаётся каталогом квартир, а данные каждой
+квартиры копируются в её шард shard_NNNN.db (household_id % --shards) в
+DB_SHARD_DIR. Бот на время разбиения должен быть остановлен; после — он
+запускается с DB_SHARDS, равным --shards.
+
+    DATABASE=/app/data/fairflat_fix.db python shard_split.py --shards 16
+    DATABASE=/app/data/fairflat_fix.db python shard_split.py --shards 16 --prune
+
+Повторный запуск не трогает квартиры, данные которых уже есть в шарде
+(--force перезаписывает их), и квартиры без данных в основной базе. С --prune данные квартир удаляются из
+основной базы, и она сжимается VACUUM.
+"""
+import argparse
+import os
+import sys
+
+
+def has_rows(conn, schema, tables, household_id):
+    """Есть ли у квартиры строки хотя бы в одной из таблиц схемы"""
+    return any(
+        conn.execute(
+            f"SELECT 1 FROM {schema}.{table} WHERE household_id = ? LIMIT 1", (household_id,)
+        ).fetchone()
+        for table in tables
+    )
+
+def columns(conn, schema, table):
+    """Столбцы таблицы схемы в порядке объявления"""
+    return [row[1] for row in conn.execute(f"PRAGMA {schema}.table_info({table})")]
+
+def split_household(bot, household_id, force):
+    """Скопировать данные квартиры в её шард.
+
+    Возвращает ({таблица: строк}, None) или (None, причина пропуска): квартиры
+    без данных в основной базе не трогаются никогда (иначе повторный запуск
+    после --prune стёр бы шард), уже перенесённые — только с --force.
+    """
+    conn = bot.shards.pool(household_id).get()
+    conn.execute("ATTACH DATABASE ? AS source", (bot.DATABASE,))
+    try:
+        if not has_rows(conn, 'source', bot.HOUSEHOLD_TABLES, household_id):
+            return None, f"нет данных в {bot.DATABASE}"
+        if not force and has_rows(conn, 'main', bot.HOUSEHOLD_TABLES, household_id):
+            return None, "уже в шарде (--force перезапишет)"
+
+        counts = {}
+        with conn:
+            for table in bot.HOUSEHOLD_TABLES:
+                # Порядок столбцов в шарде и основной базе может различаться
+                # (таблицу пересоздавали, столбец добавляли позже) — только по именам
+                source_columns = set(columns(conn, 'source', table))
+                names = ", ".join(name for name in columns(conn, 'main', table) if name in source_columns)
+                conn.execute(f"DELETE FROM main.{table} WHERE household_id = ?", (household_id,))
+                counts[table] = conn.execute(
+                    f"INSERT INTO main.{table} ({names}) SELECT {names} FROM source.{table} WHERE household_id = ?",
+                    (household_id,)
+                ).rowcount
+    finally:
+        conn.execute("DETACH DATABASE source")
+    return counts, None
+
+def prune(bot):
+    """Удалить данные квартир из основной базы, оставив каталог"""
+    conn = bot.db_pool.get()
+    with conn:
+        for table in bot.HOUSEHOLD_TABLES:
+            conn.execute(f"DELETE FROM {table}")
+    conn.execute("VACUUM")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--shards', type=int, required=True, help='число шардов (DB_SHARDS)')
+    parser.add_argument('--dir', help='каталог шардов (по умолчанию DB_SHARD_DIR)')
+    parser.add_argument('--force', action='store_true', help='перезаписать квартиры, уже перенесённые в шарды')
+    parser.add_argument('--prune', action='store_true', help='после переноса удалить данные квартир из основной базы')
+    args = parser.parse_args()
+    if args.shards < 1:
+        parser.error('--shards должно быть больше 0')
+
+    # Настройки бота читаются при импорте
+    os.environ['DB_SHARDS'] = str(args.shards)
+    if args.dir:
+        os.environ['DB_SHARD_DIR'] = args.dir
+    os.environ.setdefault('BOT_TOKEN', '0:split')
+    import bot
+
+    if not os.path.exists(bot.DATABASE):
+        sys.exit(f"❌ Нет базы {bot.DATABASE}")
+    bot.init_db()
+
+    # В новых файлах шардов строки квартиры 1 заполнены миграциями, а не
+    # перенесены: их можно перезаписывать без --force
+    created = {shard for shard in range(args.shards) if not os.path.exists(bot.shards.path(shard))}
+    household_ids = [
+        household_id for (household_id,) in
+        bot.execute_query("SELECT id FROM households ORDER BY id") or []
+    ]
+    for household_id in household_ids:
+        shard = bot.shards.shard_of(household_id)
+        path = bot.shards.path(shard)
+        counts, skipped = split_household(bot, household_id, args.force or shard in created)
+        if counts is None:
+            print(f"⏭ Квартира {household_id} ({path}): {skipped}")
+            continue
+        copied = ", ".join(f"{table} {count}" for table, count in counts.items() if count)
+        print(f"🏠 Квартира {household_id} → {path}: {copied or 'пусто'}")
+
+    if args.prune:
+        prune(bot)
+        print(f"🧹 Данные квартир удалены из {bot.DATABASE}")
+    print(f"✅ Квартир: {len(household_ids)}, шардов: {args.shards}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""Тесты работают с bot.py на временной SQLite-базе: настройки читаются при импорте"""
+import itertools
+import os
+import sys
+import tempfile
+import threading
+
+import pytest
+
+os.environ.setdefault('BOT_TOKEN', '0:test')
+os.environ['DATABASE'] = os.path.join(tempfile.mkdtemp(prefix='fairflat-test-'), 'test.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+@pytest.fixture(scope='session', autouse=True)
+def database():
+    bot.storage.init()
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Отдельная чистая база вместо общей тестовой"""
+    pool = bot.ConnectionPool(str(tmp_path / 'test.db'))
+    monkeypatch.setattr(bot, 'db_pool', pool)
+    # Область БД потока могла запомнить пул прошлого теста
+    monkeypatch.setattr(bot, '_db_scope', threading.local())
+    bot.init_db()
+    yield pool
+    pool.close_all()
+
+
+chat_ids = itertools.count(-1000, -1)
+
+
+@pytest.fixture
+def household():
+    """Новая квартира с тремя участниками; данные квартиры — в её базе"""
+    household_id = bot.storage.create_household('Тест', next(chat_ids), 1, '@admin', 'Админ')
+    for telegram, name in (('@a', 'Аня'), ('@b', 'Боря')):
+        bot.storage.add_member(household_id, telegram, name)
+    with bot.household_db(household_id):
+        yield bot.load_household(household_id)
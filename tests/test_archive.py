@@ -0,0 +1,61 @@
+import os
+import subprocess
+import sys
+
+import bot
+
+
+def add_record(age_days, points=1, is_confirmed=1, is_penalty=0, user='@DILLC7'):
+    """Запись в tasks_done возрастом age_days с тем же учётом в rotation_state, что у бота"""
+    date = bot.now_ts() - age_days * bot.DAY
+    with bot.transaction() as c:
+        c.execute(
+            '''INSERT INTO tasks_done (task, user_telegram, user_name, points, date, is_confirmed, is_penalty)
+               VALUES ('мусор', ?, 'матрос', ?, ?, ?, ?)''',
+            (user, points, date, is_confirmed, is_penalty)
+        )
+        if is_confirmed and not is_penalty:
+            bot.record_rotation(c, 1, 'мусор', user, date)
+        return c.lastrowid
+
+def ids(table):
+    return [row[0] for row in bot.execute_query(f"SELECT id FROM {table} ORDER BY id")]
+
+
+def test_moves_only_old_confirmed_records(db):
+    old = [add_record(400), add_record(300, points=2), add_record(250, points=-1, is_penalty=1)]
+    pending = add_record(400, is_confirmed=0)
+    fresh = add_record(10)
+
+    assert bot.archive_history(after_days=180, chunk=2) == 3
+    assert ids('tasks_done_archive') == old
+    assert ids('tasks_done') == [pending, fresh]
+    assert bot.execute_query(
+        "SELECT is_penalty, count, points_sum FROM archive_summary ORDER BY is_penalty"
+    ) == [(0, 2, 3), (1, 1, -1)]
+
+
+def test_second_run_moves_nothing(db):
+    add_record(400)
+    assert bot.archive_history(after_days=180) == 1
+    assert bot.archive_history(after_days=180) == 0
+    assert bot.execute_query("SELECT count FROM archive_summary") == [(1,)]
+
+
+def test_rotation_rebuild_still_sees_archived_records(db):
+    add_record(400, user='@a')
+    add_record(300, user='@b')
+    add_record(5, user='@b')
+    before = bot.execute_query("SELECT * FROM rotation_state ORDER BY user_telegram")
+
+    bot.archive_history(after_days=180)
+    assert bot.rebuild_rotation_state() == []
+    assert bot.execute_query("SELECT * FROM rotation_state ORDER BY user_telegram") == before
+
+
+def test_archive_horizon_below_stats_window_is_rejected_at_startup():
+    env = dict(os.environ, ARCHIVE_AFTER_DAYS=str(bot.ARCHIVE_MIN_DAYS - 1))
+    result = subprocess.run([sys.executable, '-c', 'import bot'], cwd=os.path.dirname(bot.__file__),
+                            env=env, capture_output=True, text=True)
+    assert result.returncode != 0
+    assert 'ARCHIVE_AFTER_DAYS must be at least' in result.stderr
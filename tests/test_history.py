@@ -0,0 +1,58 @@
+import bot
+
+
+def add_record(date, task='мусор', is_penalty=0, is_confirmed=1):
+    return bot.execute_query(
+        '''INSERT INTO tasks_done (task, user_telegram, user_name, points, date, is_confirmed, is_penalty)
+           VALUES (?, '@DILLC7', 'матрос', 1, ?, ?, ?)''',
+        (task, date, is_confirmed, is_penalty)
+    )
+
+def walk_older(filter_code='a', limit=2, task=None):
+    """Пройти все страницы от новых к старым, собирая id"""
+    seen, cursor = [], None
+    while True:
+        rows, _, has_older = bot.get_history_page(1, '@DILLC7', filter_code, 'n', cursor, task, limit)
+        seen += [row[0] for row in rows]
+        if not has_older:
+            return seen
+        cursor = bot.encode_cursor(rows[-1][1], rows[-1][0])
+
+
+def test_cursor_round_trip():
+    assert bot.decode_cursor(bot.encode_cursor(1709287200, 12345)) == (1709287200, 12345)
+    assert bot.decode_cursor('') is None
+
+
+def test_pages_cover_equal_dates_once(db):
+    # Три записи с одной датой: порядок внутри неё держит id
+    ids = [add_record(date) for date in (100, 200, 200, 200, 300)]
+    assert walk_older() == [ids[4], ids[3], ids[2], ids[1], ids[0]]
+    assert walk_older(limit=1) == [ids[4], ids[3], ids[2], ids[1], ids[0]]
+
+
+def test_newer_page_returns_to_previous(db):
+    ids = [add_record(date) for date in (100, 200, 200, 300, 400)]
+    first, has_newer, has_older = bot.get_history_page(1, '@DILLC7', limit=2)
+    assert [row[0] for row in first] == [ids[4], ids[3]]
+    assert not has_newer and has_older
+
+    cursor = bot.encode_cursor(first[-1][1], first[-1][0])
+    second, has_newer, has_older = bot.get_history_page(1, '@DILLC7', 'a', 'n', cursor, limit=2)
+    assert [row[0] for row in second] == [ids[2], ids[1]]
+    assert has_newer and has_older
+
+    cursor = bot.encode_cursor(second[0][1], second[0][0])
+    back, has_newer, _ = bot.get_history_page(1, '@DILLC7', 'a', 'p', cursor, limit=2)
+    assert back == first
+    assert not has_newer
+
+
+def test_filters(db):
+    penalty = add_record(100, is_penalty=1)
+    pending = add_record(200, is_confirmed=0)
+    other = add_record(300, task='ванна')
+    assert walk_older('p') == [penalty]
+    assert walk_older('w') == [pending]
+    assert walk_older('t1', task='ванна') == [other]
+    assert walk_older() == [other, pending, penalty]
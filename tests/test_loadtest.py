@@ -0,0 +1,40 @@
+"""Нагрузочный прогон через заглушку Bot API: бот запускается отдельным процессом"""
+import argparse
+import asyncio
+import socket
+
+import pytest
+
+import loadtest
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def load_args(**overrides):
+    args = argparse.Namespace(
+        clients=30, duration=5, think=0.05, edit_timeout=10, usernames='@DILLC7,@djumshut2000,@naattive',
+        port=free_port(), health_port=free_port(), no_spawn=False, startup_timeout=30, seed=1, out=None,
+        # Лимиты Bot API здесь ни при чём: проверяется, что правки не теряются
+        global_rate=10000, chat_rate=10000, chat_burst=100,
+    )
+    for name, value in overrides.items():
+        setattr(args, name, value)
+    return args
+
+
+@pytest.mark.parametrize('workers', ['0', '2'])
+def test_every_press_is_answered_and_edited(workers, tmp_path, monkeypatch):
+    monkeypatch.setenv('WORKERS', workers)
+    monkeypatch.setenv('DATABASE', str(tmp_path / 'load.db'))
+
+    report = asyncio.run(loadtest.run(load_args()))
+    calls = report['api_calls']
+    assert report['rate_limits']['TG_GLOBAL_RATE'] == 10000
+    assert report['presses'] > 0
+    assert report['lost_edits'] == 0
+    assert report['error_replies'] == 0
+    assert report['callbacks_not_answered_once'] == 0
+    assert calls['answerCallbackQuery'] == calls.get('editMessageText', 0) + calls.get('editMessageReplyMarkup', 0)
@@ -0,0 +1,97 @@
+import asyncio
+from types import SimpleNamespace
+
+import bot
+
+
+def user(user_id, username=None, first_name='Аня'):
+    return SimpleNamespace(id=user_id, username=username, first_name=first_name)
+
+def resolve(household, author):
+    bot.households.invalidate()
+    return asyncio.run(bot.households.resolve(household.chat_id, author))
+
+
+def test_creator_is_admin_by_user_id(household):
+    assert household.member_of(user(1)) == '@admin'
+    assert household.is_admin(household.member_of(user(1)))
+    # Чужой аккаунт с тем же ником или именем — не участник
+    assert household.member_of(user(2, 'admin', 'Админ')) is None
+
+
+def test_member_added_by_username_is_bound_on_first_update(household):
+    assert household.member_of(user(10, 'a')) is None
+
+    bound = resolve(household, user(10, 'a'))
+    assert bound.member_of(user(10)) == '@a'
+
+    # Ник занят другим аккаунтом — участник остаётся за первым
+    assert resolve(household, user(11, 'a')).member_of(user(11, 'a')) is None
+    assert resolve(household, user(10, 'renamed')).member_of(user(10)) == '@a'
+
+
+def test_member_without_username_is_bound_by_first_name(household):
+    # Участник старой базы: ключ — имя, ника у автора нет
+    bot.storage.add_member(household.id, 'Вася', 'Вася')
+
+    bound = resolve(household, user(40, first_name='Вася'))
+    assert bound.member_of(user(40)) == 'Вася'
+    assert resolve(household, user(41, first_name='Вася')).member_of(user(41)) is None
+
+
+def test_private_chat_finds_household_by_user_id(household):
+    resolve(household, user(20, 'b'))
+    found = asyncio.run(bot.households.resolve(20, user(20, 'other_name')))
+    assert found.id == household.id
+    other = asyncio.run(bot.households.resolve(21, user(21, 'b')))
+    assert other is None or other.id != household.id
+
+
+def test_cache_drops_household_loaded_before_invalidation(household, monkeypatch):
+    cache = bot.HouseholdCache()
+    run_db = bot.run_db
+
+    async def edited_meanwhile(func, *args):
+        result = await run_db(func, *args)
+        cache.invalidate(household.id)  # /member_add, пока шла загрузка
+        return result
+
+    monkeypatch.setattr(bot, 'run_db', edited_meanwhile)
+    assert asyncio.run(cache.get(household.id)).id == household.id
+    assert household.id not in cache._households
+
+    monkeypatch.setattr(bot, 'run_db', run_db)
+    asyncio.run(cache.get(household.id))
+    assert household.id in cache._households
+
+
+def test_member_bound_by_another_process_is_recognised(household):
+    # Два процесса держат в кэше квартиру, где @b ещё не привязан
+    this, other = bot.HouseholdCache(), bot.HouseholdCache()
+    for cache in (this, other):
+        asyncio.run(cache.get(household.id))
+
+    # Первый апдейт автора обработал другой процесс и привязал участника
+    assert asyncio.run(other.resolve(household.chat_id, user(30, 'b'))).member_of(user(30)) == '@b'
+    # Здесь привязка не проходит, но автор всё равно участник, а не чужой
+    assert asyncio.run(this.resolve(household.chat_id, user(30, 'b'))).member_of(user(30)) == '@b'
+
+
+def test_longest_allowed_names_fit_in_callback_data(household):
+    longest = 'Ж' * (bot.CALLBACK_PART_BYTES // 2)
+    assert bot.fits_callback_data(longest) and not bot.fits_callback_data(longest + 'ж')
+    assert bot.clip_for_callback_data('Ж' * 64) == longest
+
+    bot.storage.add_member(household.id, longest, longest)
+    for position in range(12):
+        bot.storage.save_task(household.id, f'{position:02}' + longest[1:], 1, '')
+    loaded = bot.load_household(household.id)
+
+    datas = [
+        button.callback_data
+        for rows in bot.build_static_keyboards(loaded).values() for row in rows for button in row
+    ]
+    # Даты до 2039 года, id до 36 ** 7
+    cursor = bot.encode_cursor(36 ** 6 - 1, 36 ** 7 - 1)
+    datas += [f'confirm_{2 ** 32}_{longest}', f'uh_{longest}_t11_p_{cursor}', f'uh_{longest}_a_n_{cursor}']
+    assert max(len(data.encode()) for data in datas) <= 64
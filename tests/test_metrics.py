@@ -0,0 +1,79 @@
+import asyncio
+import sqlite3
+import threading
+
+import pytest
+from telegram.error import BadRequest, TimedOut
+
+import bot
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = bot.Histogram('t_seconds', 'тест', ('route',), buckets=(0.1, 1))
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value, 'stats')
+    lines = histogram.render()
+    assert 't_seconds_bucket{route="stats",le="0.1"} 1' in lines
+    assert 't_seconds_bucket{route="stats",le="1"} 2' in lines
+    assert 't_seconds_bucket{route="stats",le="+Inf"} 3' in lines
+    assert 't_seconds_sum{route="stats"} 5.55' in lines
+    assert 't_seconds_count{route="stats"} 3' in lines
+
+
+def test_counter_escapes_label_values():
+    counter = bot.Counter('t_total', 'тест', ('error',))
+    counter.inc('say "hi"\\')
+    counter.inc('say "hi"\\', amount=2)
+    assert counter.render()[-1] == 't_total{error="say \\"hi\\"\\\\"} 3'
+
+
+def test_api_errors_except_not_modified(monkeypatch):
+    monkeypatch.setattr(bot, 'metrics', bot.Metrics())
+
+    async def fail(error):
+        raise error
+
+    async def main():
+        for error in (BadRequest('Message is not modified'), TimedOut()):
+            with pytest.raises(type(error)):
+                await bot.timed_api_call('editMessageText', lambda: fail(error))
+
+    asyncio.run(main())
+    assert bot.metrics.telegram_errors.render()[2:] == [
+        'fairflat_telegram_api_errors_total{method="editMessageText",error="TimedOut"} 1'
+    ]
+    assert 'fairflat_telegram_api_seconds_count{method="editMessageText"} 2' in bot.metrics.telegram_seconds.render()
+
+
+def test_render_reports_pending_confirmations(db):
+    bot.execute_query(
+        '''INSERT INTO tasks_done (task, user_telegram, user_name, points, date, is_confirmed)
+           VALUES ('мусор', '@DILLC7', 'матрос', 1, 0, 0)'''
+    )
+    text = bot.Metrics().render()
+    assert 'fairflat_pending_confirmations 1\n' in text
+    assert '# TYPE fairflat_outbound_retries_total counter' in text
+
+
+def test_query_plan_is_cached_once_across_threads(tmp_path):
+    profiler = bot.QueryProfiler()
+    sql = "SELECT * FROM t WHERE a = ?"
+    plans = []
+
+    def explain():
+        conn = sqlite3.connect(tmp_path / 'plan.db')
+        for _ in range(50):
+            plans.append(profiler.plan(conn, bot.fingerprint(sql), sql, (1,)))
+        conn.close()
+
+    sqlite3.connect(tmp_path / 'plan.db').execute("CREATE TABLE t (a INTEGER)")
+    threads = [threading.Thread(target=explain) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(plans) == 200 and len({id(plan) for plan in plans}) == 1
+    assert 'SCAN' in plans[0]
+
+    profiler.reset()
+    assert profiler._plans == {}
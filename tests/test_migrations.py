@@ -0,0 +1,122 @@
+import sqlite3
+import time
+
+import pytest
+
+import bot
+
+# Схема, которую создавал init_db до миграций (без schema_version)
+LEGACY_SCHEMA = '''
+CREATE TABLE users
+    (telegram TEXT PRIMARY KEY,
+     name TEXT,
+     is_home BOOLEAN DEFAULT 1,
+     balance INTEGER DEFAULT 0);
+CREATE TABLE tasks_done
+    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+     task TEXT,
+     user_telegram TEXT,
+     user_name TEXT,
+     points INTEGER,
+     confirmed_by TEXT,
+     date TEXT,
+     confirmed_at TEXT,
+     is_confirmed BOOLEAN DEFAULT 0,
+     is_penalty BOOLEAN DEFAULT 0,
+     details TEXT);
+CREATE TABLE queue
+    (task TEXT PRIMARY KEY,
+     last_user TEXT,
+     last_date TEXT);
+INSERT INTO users (telegram, name, is_home, balance) VALUES ('@DILLC7', 'матрос', 1, 7);
+INSERT INTO tasks_done (task, user_telegram, user_name, points, confirmed_by, date, confirmed_at, is_confirmed)
+    VALUES ('мусор', '@DILLC7', 'матрос', 1, 'Борода', '2024-03-01 10:00:00', '2024-03-01 11:00:00', 1);
+INSERT INTO queue (task, last_user, last_date) VALUES ('мусор', 'матрос', '2024-03-01 10:00:00');
+'''
+
+
+def connect(tmp_path, name='test.db'):
+    return bot.ConnectionPool(str(tmp_path / name)).get()
+
+def versions(conn):
+    return [version for (version,) in conn.execute("SELECT version FROM schema_version ORDER BY version")]
+
+def schema(conn):
+    return conn.execute("SELECT type, name, sql FROM sqlite_master ORDER BY name").fetchall()
+
+
+def test_new_database_gets_every_migration(tmp_path):
+    conn = connect(tmp_path)
+    bot.migrate(conn)
+    assert versions(conn) == [version for version, _, _ in bot.MIGRATIONS]
+
+
+def test_second_run_changes_nothing(tmp_path, capsys):
+    conn = connect(tmp_path)
+    bot.migrate(conn)
+    before = schema(conn)
+    capsys.readouterr()
+
+    bot.migrate(conn)
+    assert schema(conn) == before
+    assert versions(conn) == [version for version, _, _ in bot.MIGRATIONS]
+    assert 'Миграция' not in capsys.readouterr().out
+
+
+def test_legacy_database_keeps_its_data(tmp_path):
+    conn = connect(tmp_path)
+    conn.executescript(LEGACY_SCHEMA)
+    bot.migrate(conn)
+
+    assert versions(conn) == [version for version, _, _ in bot.MIGRATIONS]
+    assert conn.execute("SELECT name, balance FROM users WHERE telegram = '@DILLC7'").fetchall() == [('матрос', 7)]
+    assert conn.execute("SELECT task, user_telegram, points FROM tasks_done").fetchall() == [('мусор', '@DILLC7', 1)]
+    assert conn.execute("SELECT last_user FROM queue WHERE task = 'мусор'").fetchall() == [('матрос',)]
+
+
+def test_failed_step_is_rolled_back(tmp_path, monkeypatch):
+    conn = connect(tmp_path)
+
+    def broken(c):
+        c.execute("CREATE TABLE half_done (id INTEGER)")
+        raise RuntimeError("сбой посреди миграции")
+
+    monkeypatch.setattr(bot, 'MIGRATIONS', bot.MIGRATIONS + [(bot.MIGRATIONS[-1][0] + 1, 'Сбой', broken)])
+    with pytest.raises(RuntimeError):
+        bot.migrate(conn)
+    assert versions(conn) == [version for version, _, _ in bot.MIGRATIONS[:-1]]
+    assert not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'half_done'").fetchall()
+
+
+def test_legacy_dates_become_utc_epoch(tmp_path):
+    conn = connect(tmp_path)
+    conn.executescript(LEGACY_SCHEMA)
+    bot.migrate(conn)
+
+    # Строки писались в локальном времени — mktime переводит так же
+    done_at = int(time.mktime(time.strptime('2024-03-01 10:00:00', '%Y-%m-%d %H:%M:%S')))
+    assert conn.execute("SELECT date, confirmed_at FROM tasks_done").fetchall() == [(done_at, done_at + 3600)]
+    assert conn.execute("SELECT last_date FROM queue WHERE task = 'мусор'").fetchall() == [(done_at,)]
+    assert conn.execute("SELECT day, points_sum, count FROM daily_rollup").fetchall() == [(done_at // bot.DAY, 1, 1)]
+
+
+def test_new_database_gets_incremental_vacuum_without_full_vacuum(tmp_path):
+    conn = connect(tmp_path)
+    bot.migrate(conn, verbose=False)
+    assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+
+def test_existing_database_is_vacuumed_only_on_request(tmp_path, monkeypatch):
+    # База, созданная до включения режима
+    legacy = sqlite3.connect(tmp_path / 'test.db')
+    legacy.executescript(LEGACY_SCHEMA)
+    legacy.close()
+    conn = connect(tmp_path)
+    assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 0
+
+    bot.enable_incremental_vacuum(conn)
+    assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 0
+
+    monkeypatch.setattr(bot, 'DB_VACUUM_ON_START', True)
+    bot.enable_incremental_vacuum(conn)
+    assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
@@ -0,0 +1,96 @@
+import asyncio
+
+import pytest
+from telegram.error import RetryAfter
+
+import bot
+
+
+@pytest.fixture
+def fast_lanes(monkeypatch):
+    """Лимиты чата, которые не тормозят тесты"""
+    monkeypatch.setattr(bot, 'TG_CHAT_RATE', 1e6)
+    monkeypatch.setattr(bot, 'TG_CHAT_BURST', 1000)
+
+
+def recorder(log, value):
+    async def call():
+        log.append(value)
+        return value
+    return call
+
+
+def test_chat_requests_keep_order(fast_lanes):
+    log = []
+
+    async def main():
+        scheduler = bot.OutboundScheduler(global_rate=1e6)
+        return await asyncio.gather(*(
+            scheduler.send(chat_id, recorder(log, (chat_id, n)))
+            for n in range(5) for chat_id in (1, 2)
+        ))
+
+    results = asyncio.run(main())
+    assert [n for chat_id, n in log if chat_id == 1] == list(range(5))
+    assert [n for chat_id, n in log if chat_id == 2] == list(range(5))
+    assert sorted(results) == sorted(log)
+
+
+def test_queued_edits_of_one_message_coalesce(fast_lanes):
+    log = []
+
+    async def main():
+        scheduler = bot.OutboundScheduler(global_rate=1e6)
+        first = asyncio.ensure_future(scheduler.edit(1, 10, recorder(log, 0)))
+        await asyncio.sleep(0)
+        # Первая правка уже ушла, следующие три ждут в очереди и склеиваются
+        rest = [scheduler.edit(1, 10, recorder(log, n)) for n in range(1, 4)]
+        return scheduler, await asyncio.gather(first, *rest)
+
+    scheduler, results = asyncio.run(main())
+    assert log == [0, 3]
+    assert results == [0, 3, 3, 3]
+    assert (scheduler.sent, scheduler.coalesced) == (2, 2)
+
+
+def test_retry_after_is_retried(fast_lanes, monkeypatch):
+    attempts = []
+
+    async def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise RetryAfter(0)
+        return 'ok'
+
+    async def main():
+        scheduler = bot.OutboundScheduler(global_rate=1e6, max_retries=2)
+        return scheduler, await scheduler.send(1, flaky)
+
+    scheduler, result = asyncio.run(main())
+    assert result == 'ok'
+    assert scheduler.retried == 2
+
+
+def test_retries_run_out(fast_lanes):
+    async def always_limited():
+        raise RetryAfter(0)
+
+    async def main():
+        scheduler = bot.OutboundScheduler(global_rate=1e6, max_retries=1)
+        await scheduler.send(1, always_limited)
+
+    with pytest.raises(RetryAfter):
+        asyncio.run(main())
+
+
+def test_idle_lanes_are_pruned_past_threshold(fast_lanes):
+    async def main():
+        scheduler = bot.OutboundScheduler(global_rate=1e6)
+        await asyncio.gather(*(scheduler.send(chat_id, recorder([], chat_id)) for chat_id in range(1001)))
+        assert len(scheduler._lanes) == 1001
+        # Новый чат сверх порога вычищает простаивающие очереди
+        assert await scheduler.send(5000, recorder([], 'new')) == 'new'
+        return scheduler
+
+    scheduler = asyncio.run(main())
+    assert list(scheduler._lanes) == [5000]
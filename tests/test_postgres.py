@@ -0,0 +1,129 @@
+"""PostgresStorage на живой базе: TEST_DATABASE_URL, без неё тесты пропускаются.
+
+Схема создаётся заново в отдельной схеме fairflat_test этой базы.
+"""
+import os
+
+import pytest
+
+import bot
+
+DSN = os.getenv('TEST_DATABASE_URL')
+SCHEMA = 'fairflat_test'
+
+
+@pytest.fixture(scope='module')
+def pg():
+    if not DSN:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    if bot.psycopg2 is None:
+        pytest.skip("psycopg2 is not installed")
+    conn = bot.psycopg2.connect(DSN)
+    conn.autocommit = True
+    with conn.cursor() as c:
+        c.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        c.execute(f"CREATE SCHEMA {SCHEMA}")
+    storage = bot.PostgresStorage(
+        bot.psycopg2.extensions.make_dsn(DSN, options=f'-c search_path={SCHEMA}'), pool_size=2
+    )
+    storage.init()
+    yield storage
+    storage._get_pool().closeall()
+    with conn.cursor() as c:
+        c.execute(f"DROP SCHEMA {SCHEMA} CASCADE")
+    conn.close()
+
+
+chat_ids = iter(range(-5000, -6000, -1))
+
+@pytest.fixture
+def household(pg):
+    household_id = pg.create_household('Тест', next(chat_ids), 1, '@admin', 'Админ')
+    pg.add_member(household_id, '@a', 'Аня')
+    pg.add_member(household_id, '@b', 'Боря')
+    return bot.Household(household_id, *pg.get_household(household_id))
+
+
+def confirm(pg, household, user, points, date, task='мусор'):
+    task_id = pg.add_task_record(household.id, task, user, user, points, date, None, points < 0)
+    assert pg.confirm_task(household, task_id, 'Админ')[0] == 'ok'
+    return task_id
+
+
+def test_pg_sql_translates_sqlite_parameters():
+    assert bot.pg_sql("SELECT ? WHERE a = :a AND b LIKE '5%'") == "SELECT %s WHERE a = %(a)s AND b LIKE '5%%'"
+    assert bot.pg_sql("SELECT ?::text[], x::bigint") == "SELECT %s::text[], x::bigint"
+
+
+def test_households_and_members(pg, household):
+    assert pg.create_household('Другая', household.chat_id, 2, '@x', 'Икс') is None
+    assert household.is_admin('@admin') and household.user_ids == {1: '@admin'}
+    assert list(household.members) == ['@admin', '@a', '@b']
+    assert 'мусор' in household.tasks
+
+    assert pg.find_household_id(household.chat_id, 99, '@zz') == household.id
+    assert pg.find_household_id(0, 99, '@a') == household.id
+    assert pg.claim_member(household.id, '@a', 10)
+    assert not pg.claim_member(household.id, '@a', 11)
+    assert not pg.claim_member(household.id, '@b', 10)
+    assert pg.find_household_id(0, 10, '@renamed') == household.id
+
+    pg.set_home(household.id, '@b', 0)
+    assert pg.get_home(household.id, '@b') == 0
+    assert pg.get_confirmers(household.id, '@a') == [('@admin', 'Админ')]
+    assert pg.remove_member(household.id, '@b')
+    assert not pg.remove_member(household.id, '@b')
+    assert pg.get_home(household.id, '@b') is None
+
+    pg.save_task(household.id, 'окна', 4, 'Помыть окна')
+    assert list(pg.get_household(household.id)[5])[-1] == 'окна'
+    assert pg.delete_task(household.id, 'окна')
+    assert not pg.delete_task(household.id, 'окна')
+
+
+def test_confirm_stats_and_history(pg, household):
+    now = bot.now_ts()
+    first = confirm(pg, household, '@a', 3, now - 2 * bot.DAY)
+    confirm(pg, household, '@a', 2, now - 10)
+    confirm(pg, household, '@b', -1, now - 5, task='штраф')
+    pending = pg.add_task_record(household.id, 'мусор', '@b', 'Боря', 2, now)
+
+    assert pg.confirm_task(household, first, 'Админ') == ('already', None)
+    assert pg.cancel_pending_task(household.id, first) == 'confirmed'
+    assert pg.cancel_pending_task(household.id, -1) == 'missing'
+    assert pg.count_pending() >= 1
+    assert pg.cancel_pending_task(household.id, pending) == 'ok'
+
+    balances = {telegram: balance for telegram, balance, _ in pg.get_balances(household.id)}
+    assert balances['@a'] == 5 and balances['@b'] == -1
+    assert pg.get_window_points(household.id, now - 7 * bot.DAY) == {'@a': 5, '@b': -1}
+    assert pg.get_window_top_tasks(household.id, now - 7 * bot.DAY) == [('мусор', 2)]
+    assert pg.get_user_totals(household.id, '@a') == (5, 5, 5)
+    assert pg.get_window_expiry(household.id, now - 7 * bot.DAY) > now
+
+    rows, has_newer, has_older = pg.get_history_page(household.id, '@a', limit=1)
+    assert [row[0] for row in rows] != [first] and not has_newer and has_older
+    cursor = bot.encode_cursor(rows[-1][1], rows[-1][0])
+    rows, has_newer, has_older = pg.get_history_page(household.id, '@a', 'a', 'n', cursor, limit=1)
+    assert [row[0] for row in rows] == [first] and has_newer and not has_older
+
+    candidates, (last_user, _) = pg.get_rotation(household.id, 'мусор')
+    assert candidates[-1]['telegram'] == '@a' and last_user == '@a'
+    assert pg.get_rotation_overview(household.id)['мусор']['telegram'] != '@a'
+    assert pg.rebuild_rotation_state(household.id) == []
+    assert pg.recompute_balances(household) == []
+
+
+def test_archive_and_reset(pg, household):
+    now = bot.now_ts()
+    for i in range(3):
+        confirm(pg, household, '@a', 1, now - 400 * bot.DAY + i)
+    confirm(pg, household, '@a', 1, now)
+
+    assert pg.archive_history(180, chunk=2) >= 3
+    assert pg.rebuild_rotation_state(household.id) == []
+    assert pg.recompute_balances(household) == []
+
+    assert pg.reset_household(household.id, chunk=2) == 4
+    assert pg.get_history_page(household.id, '@a') == ([], False, False)
+    assert dict((t, b) for t, b, _ in pg.get_balances(household.id))['@a'] == 0
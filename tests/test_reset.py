@@ -0,0 +1,59 @@
+import bot
+
+
+def confirm(household, user, points, date):
+    task_id = bot.storage.add_task_record(household.id, 'мусор', user, user, points, date,
+                                          None, points < 0)
+    bot.storage.confirm_task(household, task_id, 'Админ')
+    return task_id
+
+
+def count(table, household):
+    return bot.execute_query(f"SELECT COUNT(*) FROM {table} WHERE household_id = ?", (household.id,))[0][0]
+
+
+def test_reset_with_empty_archive_deletes_history(household):
+    now = bot.now_ts()
+    for i in range(7):
+        confirm(household, '@a', 2, now - i)
+    assert count('tasks_done_archive', household) == 0
+
+    assert bot.storage.reset_household(household.id, chunk=3) == 7
+    assert count('tasks_done', household) == 0
+    assert count('history_purge', household) == 0
+    assert dict((t, b) for t, b, _ in bot.storage.get_balances(household.id))['@a'] == 0
+    assert bot.storage.recompute_balances(household) == []
+
+
+def test_reset_moves_archived_history_too(household):
+    now = bot.now_ts()
+    for i in range(4):
+        task_id = confirm(household, '@b', 1, now)
+        bot.execute_query("UPDATE tasks_done SET date = ? WHERE id = ?", (now - 400 * bot.DAY + i, task_id))
+    confirm(household, '@b', 1, now)
+    assert bot.archive_history(180) >= 4
+
+    assert bot.storage.reset_household(household.id) == 5
+    assert count('tasks_done', household) + count('tasks_done_archive', household) == 0
+
+
+def test_readers_skip_history_until_purge_finishes(household):
+    now = bot.now_ts()
+    old = [confirm(household, '@a', 3, now - 10 + i) for i in range(3)]
+    # Прерванное удаление: граница записана, записи остались
+    bot.execute_query("UPDATE users SET balance = 0 WHERE household_id = ?", (household.id,))
+    bot.execute_query("DELETE FROM rotation_state WHERE household_id = ?", (household.id,))
+    bot.execute_query("DELETE FROM daily_rollup WHERE household_id = ?", (household.id,))
+    bot.execute_query("INSERT INTO history_purge (household_id, up_to_id) VALUES (?, ?)",
+                      (household.id, old[-1]))
+    new = confirm(household, '@a', 1, now)
+
+    rows, _, _ = bot.storage.get_history_page(household.id, '@a')
+    assert [row[0] for row in rows] == [new]
+    assert bot.storage.get_window_points(household.id, now - 7 * bot.DAY) == {'@a': 1}
+    assert bot.storage.recompute_balances(household) == []
+    assert [(task, user) for task, user, _, _ in bot.storage.rebuild_rotation_state(household.id)] == []
+
+    bot.archive_history()
+    assert count('history_purge', household) == 0
+    assert count('tasks_done', household) == 1
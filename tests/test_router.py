@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+import bot
+
+
+def make_router(calls):
+    async def handler(update, context, household, *args):
+        calls.append(args)
+
+    async def broken(update, context, household, *args):
+        raise RuntimeError("сбой обработчика")
+
+    router = bot.CallbackRouter()
+    router.exact('menu', handler, 'меню')
+    router.prefix('a_', handler)
+    router.prefix('a_b_', handler, bot.parse_int)
+    router.prefix('boom_', broken)
+    return router
+
+
+def test_exact_match_wins_over_prefix():
+    assert bot.callback_router.resolve('who_overview')[0].name == 'who_overview'
+    assert bot.callback_router.resolve('who_мусор')[0].name == 'who_*'
+
+
+def test_longest_prefix_and_arguments():
+    router = make_router([])
+    assert router.resolve('menu')[1] == ('меню',)
+    assert router.resolve('a_xyz')[1] == ('xyz',)
+    route, args = router.resolve('a_b_42')
+    assert route.name == 'a_b_*' and args == (42,)
+    assert router.resolve('nothing') == (None, None)
+    with pytest.raises(ValueError):
+        router.resolve('a_b_notanumber')
+
+
+def test_bot_parsers():
+    assert bot.parse_confirm('17_Борода_Младший') == (17, 'Борода_Младший')
+    assert bot.parse_history('@user_name_a_n_') == ('@user_name', 'a', 'n', '')
+    with pytest.raises(ValueError):
+        bot.parse_history('@user_a_x_')
+
+
+def test_dispatch_counts_calls_and_errors():
+    calls = []
+    router = make_router(calls)
+
+    route, args = router.resolve('a_b_7')
+    asyncio.run(router.dispatch(route, None, None, None, args))
+    assert calls == [(7,)]
+
+    route, args = router.resolve('boom_1')
+    with pytest.raises(RuntimeError):
+        asyncio.run(router.dispatch(route, None, None, None, args))
+
+    stats = {name: (hits, errors) for name, hits, errors, _, _ in router.stats()}
+    assert stats['a_b_*'] == (1, 0)
+    assert stats['boom_*'] == (1, 1)
+    assert stats['menu'] == (0, 0)
@@ -0,0 +1,121 @@
+import pytest
+
+import bot
+import shard_split
+
+
+@pytest.fixture
+def router(db, tmp_path, monkeypatch):
+    """Четыре шарда рядом с тестовой основной базой"""
+    router = bot.ShardRouter(str(tmp_path / 'shards'), 4)
+    monkeypatch.setattr(bot, 'DATABASE', db.database)
+    yield router
+    for pool in router._pools.values():
+        pool.close_all()
+
+def count(pool, table, household_id):
+    return pool.get().execute(
+        f"SELECT COUNT(*) FROM {table} WHERE household_id = ?", (household_id,)
+    ).fetchone()[0]
+
+def add_history(household_id, n):
+    with bot.household_db(household_id), bot.transaction() as c:
+        c.executemany(
+            '''INSERT INTO tasks_done (household_id, task, user_telegram, user_name, points, date, is_confirmed)
+               VALUES (?, 'мусор', '@a', 'А', 1, ?, 1)''',
+            [(household_id, day * bot.DAY) for day in range(n)]
+        )
+
+
+def test_new_shard_has_no_directory_and_no_foreign_default(router):
+    assert router.shard_of(6) == 2
+    assert router.path(2).endswith('shard_0002.db')
+
+    foreign, home = router.pool(6), router.pool(1)
+    for pool in (foreign, home):
+        for table in bot.DIRECTORY_TABLES:
+            assert not pool.get().execute(f"SELECT 1 FROM {table}").fetchone()
+    assert count(foreign, 'household_tasks', 1) == 0
+    assert count(home, 'household_tasks', 1) == len(bot.DEFAULT_TASKS)
+    assert sorted(router.existing()) == [1, 2]
+
+
+def test_household_db_routes_to_its_shard(router, monkeypatch):
+    monkeypatch.setattr(bot, 'shards', router)
+    household_id = bot.create_household('Шард', 100, 1, '@a', 'А')
+    add_history(household_id, 3)
+
+    assert count(router.pool(household_id), 'tasks_done', household_id) == 3
+    assert count(bot.db_pool, 'tasks_done', household_id) == 0
+    assert bot.db_pool.get().execute(
+        "SELECT title FROM households WHERE id = ?", (household_id,)
+    ).fetchone() == ('Шард',)
+
+
+def test_thread_keeps_at_most_max_open_shards(router):
+    router.max_open = 2
+    for shard in (0, 1, 2):
+        router.shard_pool(shard)
+    assert list(router._local.recent) == [1, 2]
+    # Вытесненный пул закрыл соединение, но открывается снова
+    assert router.shard_pool(0).get().execute("SELECT 1").fetchone() == (1,)
+
+
+def test_split_copies_each_household_once(router, monkeypatch):
+    household_id = bot.create_household('Перенос', 200, 1, '@a', 'А')
+    add_history(household_id, 5)
+    source = bot.db_pool.get().execute(
+        "SELECT * FROM tasks_done WHERE household_id = ? ORDER BY id", (household_id,)
+    ).fetchall()
+
+    monkeypatch.setattr(bot, 'shards', router)
+    counts, skipped = shard_split.split_household(bot, household_id, force=False)
+    assert skipped is None
+    assert counts['tasks_done'] == 5
+    assert counts['household_tasks'] == len(bot.DEFAULT_TASKS)
+    shard = router.pool(household_id).get()
+    assert shard.execute(
+        "SELECT * FROM tasks_done WHERE household_id = ? ORDER BY id", (household_id,)
+    ).fetchall() == source
+
+    # Повторный запуск пропускает квартиру, --force переносит заново без дублей
+    assert shard_split.split_household(bot, household_id, force=False)[0] is None
+    assert shard_split.split_household(bot, household_id, force=True)[0]['tasks_done'] == 5
+    assert count(router.pool(household_id), 'tasks_done', household_id) == 5
+
+    shard_split.prune(bot)
+    assert count(bot.db_pool, 'tasks_done', household_id) == 0
+    assert bot.db_pool.get().execute("SELECT COUNT(*) FROM households").fetchone()[0] == 2
+
+    # После --prune даже --force не стирает шард: в основной базе данных уже нет
+    counts, skipped = shard_split.split_household(bot, household_id, force=True)
+    assert counts is None and skipped
+    assert count(router.pool(household_id), 'tasks_done', household_id) == 5
+
+
+def test_split_matches_columns_by_name(router, monkeypatch):
+    household_id = bot.create_household('Порядок', 201, 1, '@a', 'А')
+    source = bot.db_pool.get().execute(
+        "SELECT task, points, rules, position FROM household_tasks WHERE household_id = ? ORDER BY task",
+        (household_id,)
+    ).fetchall()
+
+    # В шарде та же таблица, но столбцы объявлены в другом порядке
+    monkeypatch.setattr(bot, 'shards', router)
+    shard = router.pool(household_id).get()
+    with shard:
+        shard.execute("DROP TABLE household_tasks")
+        shard.execute('''CREATE TABLE household_tasks
+                         (position INTEGER NOT NULL DEFAULT 0,
+                          rules TEXT NOT NULL DEFAULT '',
+                          points INTEGER NOT NULL,
+                          task TEXT NOT NULL,
+                          household_id INTEGER NOT NULL,
+                          PRIMARY KEY (household_id, task)) WITHOUT ROWID''')
+
+    counts, skipped = shard_split.split_household(bot, household_id, force=True)
+    assert counts['household_tasks'] == len(bot.DEFAULT_TASKS)
+    assert shard.execute(
+        "SELECT task, points, rules, position FROM household_tasks WHERE household_id = ? ORDER BY task",
+        (household_id,)
+    ).fetchall() == source
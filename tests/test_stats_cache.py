@@ -0,0 +1,27 @@
+import bot
+
+
+def test_put_after_invalidate_is_dropped():
+    cache = bot.StatsCache()
+    expires_at = bot.now_ts() + 60
+
+    generation = cache.generation(1)
+    cache.invalidate(1)  # запись пришла, пока текст строился
+    cache.put(1, 'старый текст', expires_at, generation)
+    assert cache.get(1) is None
+
+    generation = cache.generation(1)
+    cache.invalidate()
+    cache.put(1, 'старый текст', expires_at, generation)
+    assert cache.get(1) is None
+
+    cache.put(1, 'свежий текст', expires_at, cache.generation(1))
+    assert cache.get(1) == 'свежий текст'
+
+
+def test_other_household_invalidation_keeps_entry():
+    cache = bot.StatsCache()
+    generation = cache.generation(1)
+    cache.invalidate(2)
+    cache.put(1, 'текст', bot.now_ts() + 60, generation)
+    assert cache.get(1) == 'текст'
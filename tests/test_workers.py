@@ -0,0 +1,67 @@
+import asyncio
+
+from telegram import Update
+
+import bot
+
+
+def message_update(update_id, chat_id):
+    return Update.de_json({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': 0, 'text': '/start',
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'А'},
+        },
+    }, None)
+
+
+def run_updates(processor, plan):
+    """plan: [(update_id, chat_id, секунд)]; возвращает события ('start'|'end', update_id)"""
+    events = []
+
+    async def handle(update_id, delay):
+        events.append(('start', update_id))
+        await asyncio.sleep(delay)
+        events.append(('end', update_id))
+
+    async def main():
+        await asyncio.gather(*(
+            processor.process_update(message_update(update_id, chat_id), handle(update_id, delay))
+            for update_id, chat_id, delay in plan
+        ))
+
+    asyncio.run(main())
+    return events
+
+
+def test_one_chat_in_order_other_chats_in_parallel():
+    events = run_updates(bot.ChatOrderedUpdateProcessor(8), [
+        (1, 100, 0.03), (2, 100, 0), (3, 200, 0.01), (4, 100, 0),
+    ])
+    # Чат 100 — строго по очереди, даже если позже пришедшие быстрее
+    chat = [event for event in events if event[1] in (1, 2, 4)]
+    assert chat == [('start', 1), ('end', 1), ('start', 2), ('end', 2), ('start', 4), ('end', 4)]
+    # Чат 200 не ждёт чат 100
+    assert events.index(('end', 3)) < events.index(('end', 1))
+
+
+def test_chat_key_and_worker_of():
+    assert bot.chat_key(message_update(1, 42)) == 42
+    assert {bot.worker_of(chat_id, 4) for chat_id in range(100)} == {0, 1, 2, 3}
+    assert bot.worker_of(-1001234, 4) == bot.worker_of(-1001234, 4)
+
+
+def test_merge_metrics_labels_workers():
+    texts = [
+        (None, '# HELP up Жив\n# TYPE up gauge\nup 1\n'),
+        (0, '# HELP hits Нажатия\n# TYPE hits counter\nhits{route="stats"} 2\n'),
+        (1, '# HELP hits Нажатия\n# TYPE hits counter\nhits{route="stats"} 3\nhits{route="rules"} 1\n'),
+    ]
+    assert bot.merge_metrics(texts).splitlines() == [
+        '# HELP up Жив', '# TYPE up gauge', 'up 1',
+        '# HELP hits Нажатия', '# TYPE hits counter',
+        'hits{worker="0",route="stats"} 2',
+        'hits{worker="1",route="stats"} 3',
+        'hits{worker="1",route="rules"} 1',
+    ]